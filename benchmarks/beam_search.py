@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Latency of a beam search step of DiffTranslator at -max_length 30 and 100, with and without the attention
+kept for -attn_debug. The end token is blocked until max_length so that every hypothesis reaches it,
+the cost of the steps that grow with the length of the hypotheses shows in the last ones.
+Takes the usual translate.py options, e.g. on the top1000 test set:
+
+    python -m benchmarks.beam_search -model models/CoRec_1000_step_100000.pt \\
+        -src data/top1000/cleaned_test.diff -tgt data/top1000/cleaned_test.msg \\
+        -src_vocab data/top1000/vocab.pt -output data/output/bench.out -batch_size 30 -batches 5
+"""
+import time
+
+import configargparse
+import torch
+
+import onmt.opts as opts
+from diff_trans import build_translator
+from onmt.inputters.input_aux import build_dataset_iter
+from onmt.utils.logging import init_logger
+
+
+def main():
+    parser = configargparse.ArgumentParser(description=__doc__, formatter_class=configargparse.RawDescriptionHelpFormatter)
+    opts.config_opts(parser)
+    opts.translate_opts(parser)
+    parser.add('--batches', '-batches', type=int, default=5, help="Number of test batches decoded per setting")
+    opt = parser.parse_args()
+    init_logger(opt.log_file)
+
+    translator = build_translator(opt, report_score=False)
+    vocab = translator.src_vocab
+    loader = build_dataset_iter(translator.test_dataset, vocab, opt.batch_size, gpu=opt.gpu, shuffle_batches=False)
+    batches = []
+    for batch in loader:
+        if len(batches) == opt.batches:
+            break
+        batches.append(batch)
+
+    # time every decoding step, from one call of the decoder to the next
+    step_times = []
+    decode_and_generate = translator._decode_and_generate
+
+    def timed_decode_and_generate(*args, **kwargs):
+        if opt.gpu:
+            torch.cuda.synchronize()
+        step_times.append(time.perf_counter())
+        return decode_and_generate(*args, **kwargs)
+
+    translator._decode_and_generate = timed_decode_and_generate
+
+    print("%-12s %-12s %16s %16s" % ("max_length", "attn_debug", "ms / step", "ms / last step"))
+    for max_length in [30, 100]:
+        translator.opt.max_length = max_length
+        translator.opt.min_length = max_length
+        for attn_debug in [False, True]:
+            latencies = []
+            for batch in batches:
+                del step_times[:]
+                translator._process_batch(batch, len(batch["indexes"]), None, vocab["tgt"], attn_debug=attn_debug)
+                if opt.gpu:
+                    torch.cuda.synchronize()
+                step_times.append(time.perf_counter())
+                # the first call scores the gold target, when there is one
+                starts = step_times[1:] if batch["tgt_batch"] is not None else step_times
+                latencies.append([end - start for start, end in zip(starts, starts[1:])])
+            mean = sum(sum(l) for l in latencies) / sum(len(l) for l in latencies)
+            last = sum(l[-1] for l in latencies) / len(latencies)
+            print("%-12d %-12s %16.2f %16.2f" % (max_length, attn_debug, 1000 * mean, 1000 * last))
+
+
+if __name__ == "__main__":
+    main()
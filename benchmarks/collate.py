@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of `Collator` against the per-example padding and concatenation previously done by
+`build_dataset_iter`, on random batches shaped like the top1000 data (diffs up to -src_len tokens,
+messages up to -tgt_len tokens), for text examples and for pre-numericalized ones.
+
+Run from the repository root: python -m benchmarks.collate
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from onmt.inputters.input_aux import Collator
+from onmt.inputters.vocabulary import BOS_WORD, EOS_WORD, PAD_WORD, UNK_WORD, Vocab, get_indices
+
+
+def previous_generate_batch(vocabs, data_batch):
+    """The collate function of the previous implementation"""
+    _, _, _, src_len, tgt_len = zip(*data_batch)
+    max_src_len = max(src_len)
+    max_tgt_len = max(tgt_len)
+    src_batch, tgt_batch, indexes = [], [], []
+    for (src_item, tgt_item, index, src_item_len, tgt_item_len) in data_batch:
+        indexes.append(index)
+        src_tensor = torch.tensor(get_indices(vocabs["src"], src_item + [EOS_WORD]))
+        if src_item_len != max_src_len:
+            padding = torch.full((1, max_src_len - src_item_len), vocabs["src"][PAD_WORD], dtype=torch.int)
+            src_tensor = torch.cat((src_tensor, padding[0]))
+        tgt_tensor = torch.tensor(get_indices(vocabs["tgt"], [BOS_WORD] + tgt_item + [EOS_WORD]))
+        if tgt_item_len != max_tgt_len:
+            padding = torch.full((1, max_tgt_len - tgt_item_len), vocabs["tgt"][PAD_WORD], dtype=torch.int)[0]
+            tgt_tensor = torch.cat((tgt_tensor, padding))
+        src_batch.append(src_tensor)
+        tgt_batch.append(tgt_tensor)
+    src_batch = torch.cat([tensor.unsqueeze(1) for tensor in src_batch], 1).unsqueeze(2)
+    tgt_batch = torch.cat([tensor.unsqueeze(1) for tensor in tgt_batch], 1).unsqueeze(2)
+    return {"src_batch": src_batch, "src_len": torch.tensor(src_len), "tgt_batch": tgt_batch,
+            "tgt_len": torch.tensor(tgt_len), "indexes": torch.tensor(indexes)}
+
+
+def make_vocab(words, specials):
+    v = Vocab(specials + words)
+    v.set_default_index(v[UNK_WORD])
+    return v
+
+
+def timed(fn, batches, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            result = fn(batch)
+    return result, (time.perf_counter() - start) / (repeat * len(batches))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-batch_size", type=int, default=64)
+    parser.add_argument("-batches", type=int, default=50)
+    parser.add_argument("-src_len", type=int, default=100)
+    parser.add_argument("-tgt_len", type=int, default=30)
+    parser.add_argument("-vocab_size", type=int, default=20000)
+    parser.add_argument("-repeat", type=int, default=3)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    words = ["w%d" % i for i in range(opt.vocab_size)]
+    vocabs = {"src": make_vocab(words, [UNK_WORD, PAD_WORD, EOS_WORD]),
+              "tgt": make_vocab(words, [UNK_WORD, PAD_WORD, BOS_WORD, EOS_WORD])}
+
+    def example(i):
+        src = [words[w] for w in rng.randint(0, opt.vocab_size, rng.randint(1, opt.src_len + 1))]
+        tgt = [words[w] for w in rng.randint(0, opt.vocab_size, rng.randint(1, opt.tgt_len + 1))]
+        return src, tgt, i, len(src), len(tgt)
+
+    text_batches = [[example(b * opt.batch_size + i) for i in range(opt.batch_size)] for b in range(opt.batches)]
+    numeric_batches = [[(np.array(get_indices(vocabs["src"], src), dtype=np.int32),
+                         np.array(get_indices(vocabs["tgt"], tgt), dtype=np.int32), i, src_len, tgt_len)
+                        for src, tgt, i, src_len, tgt_len in batch] for batch in text_batches]
+
+    collator = Collator(vocabs)
+    reference, reference_s = timed(lambda batch: previous_generate_batch(vocabs, batch), text_batches, opt.repeat)
+    text, text_s = timed(collator, text_batches, opt.repeat)
+    numeric, numeric_s = timed(collator, numeric_batches, opt.repeat)
+    same = all(torch.equal(reference[name].long(), text[name].long()) and torch.equal(text[name], numeric[name])
+               for name in reference)
+    print("batch %d, src <= %d, tgt <= %d tokens, same batches: %s" % (opt.batch_size, opt.src_len, opt.tgt_len, same))
+    print("%-28s %12s" % ("collate", "ms / batch"))
+    print("%-28s %12.3f" % ("previous, text", reference_s * 1000))
+    print("%-28s %12.3f" % ("Collator, text", text_s * 1000))
+    print("%-28s %12.3f" % ("Collator, numeric", numeric_s * 1000))
+
+
+if __name__ == "__main__":
+    main()
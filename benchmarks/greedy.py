@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Latency of DiffTranslator with -beam_size 1: the greedy search against the beam search with a single beam,
+and the random sampling of the greedy search. Greedy translations are compared with the beam ones.
+Takes the usual translate.py options, e.g. on the top1000 test set:
+
+    python -m benchmarks.greedy -model models/CoRec_1000_step_100000.pt \\
+        -src data/top1000/cleaned_test.diff -tgt data/top1000/cleaned_test.msg \\
+        -src_vocab data/top1000/vocab.pt -output data/output/bench.out -batch_size 30 -batches 10
+"""
+import time
+
+import configargparse
+import torch
+
+import onmt.opts as opts
+from diff_trans import build_translator
+from onmt.inputters.input_aux import build_dataset_iter
+from onmt.utils.logging import init_logger
+
+
+def main():
+    parser = configargparse.ArgumentParser(description=__doc__, formatter_class=configargparse.RawDescriptionHelpFormatter)
+    opts.config_opts(parser)
+    opts.translate_opts(parser)
+    parser.add('--batches', '-batches', type=int, default=10, help="Number of test batches decoded per setting")
+    opt = parser.parse_args()
+    init_logger(opt.log_file)
+    opt.beam_size = 1
+    opt.n_best = 1
+
+    translator = build_translator(opt, report_score=False)
+    vocab = translator.src_vocab
+    loader = build_dataset_iter(translator.test_dataset, vocab, opt.batch_size, gpu=opt.gpu, shuffle_batches=False)
+    batches = []
+    for batch in loader:
+        if len(batches) == opt.batches:
+            break
+        batches.append(batch)
+
+    greedy_search = translator._greedy_search
+    modes = [("beam search", translator._beam_search, 1),
+             ("greedy", greedy_search, 1),
+             ("sampling top 10", greedy_search, 10)]
+    reference = None
+    print("%-16s %14s %10s %10s" % ("mode", "ms / batch", "sents/s", "same out"))
+    for name, search, sampling_topk in modes:
+        translator._greedy_search = search
+        translator.opt.random_sampling_topk = sampling_topk
+        predictions = []
+        start = time.perf_counter()
+        for batch in batches:
+            results = translator._process_batch(batch, len(batch["indexes"]), None, vocab["tgt"], attn_debug=False)
+            predictions += [preds[0].tolist() for preds in results["predictions"]]
+        if opt.gpu:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = predictions
+        print("%-16s %14.2f %10.1f %10s" % (name, 1000 * elapsed / len(batches), len(predictions) / elapsed,
+                                            predictions == reference))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Recall vs latency of the retrieval indexes against the exact cosine search
+previously done by `DiffTranslator.offline_semantic_retrieval`.
+
+Features are either loaded from a saved tensor of training encodings
+(`-features`, `[n_train x hidden]`) or drawn from a gaussian mixture.
+
+Run from the repository root: python -m benchmarks.retrieval_index
+"""
+import argparse
+import time
+
+import torch
+
+from onmt.retrieval.index import build_index
+
+
+def exact_search(queries, train_encodings, k):
+    """The brute-force search the indexes replace"""
+    numerator = torch.mm(queries, train_encodings.transpose(0, 1))
+    denominator = torch.mm(queries.norm(2, 1).unsqueeze(1), train_encodings.norm(2, 1).unsqueeze(1).transpose(0, 1))
+    sims = torch.div(numerator, denominator)
+    return torch.topk(sims, k, dim=1)[1]
+
+
+def synthetic_features(n, dim, n_clusters, seed):
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(n_clusters, dim, generator=generator) * 3
+    assign = torch.randint(n_clusters, (n,), generator=generator)
+    return centers[assign] + torch.randn(n, dim, generator=generator)
+
+
+def recall(found, truth):
+    hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / truth.numel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-features", help="torch.save-d training encodings, synthetic data if not given")
+    parser.add_argument("-n_train", type=int, default=100000)
+    parser.add_argument("-n_queries", type=int, default=1000)
+    parser.add_argument("-dim", type=int, default=512)
+    parser.add_argument("-k", type=int, default=1)
+    parser.add_argument("-batch_size", type=int, default=32)
+    parser.add_argument("-seed", type=int, default=0)
+    opt = parser.parse_args()
+
+    if opt.features:
+        train_encodings = torch.load(opt.features, map_location="cpu").float()
+        generator = torch.Generator().manual_seed(opt.seed)
+        queries = train_encodings[torch.randint(len(train_encodings), (opt.n_queries,), generator=generator)]
+        queries = queries + 0.1 * queries.std() * torch.randn(queries.size(), generator=generator)
+    else:
+        data = synthetic_features(opt.n_train + opt.n_queries, opt.dim, 1024, opt.seed)
+        train_encodings, queries = data[:opt.n_train], data[opt.n_train:]
+
+    def timed_search(search):
+        results = []
+        start = time.perf_counter()
+        for i in range(0, len(queries), opt.batch_size):
+            results.append(search(queries[i:i + opt.batch_size]))
+        return torch.cat(results), (time.perf_counter() - start) * 1000 / len(queries)
+
+    truth, exact_ms = timed_search(lambda q: exact_search(q, train_encodings, opt.k))
+    print("%-28s %10s %12s %10s" % ("index", "build (s)", "query (ms)", "recall@%d" % opt.k))
+    print("%-28s %10s %12.3f %10.4f" % ("exact (current)", "-", exact_ms, 1.0))
+
+    configs = [("flat", {}),
+               ("ivfpq", {"nlist": 256, "nprobe": 8, "m": 16}),
+               ("ivfpq", {"nlist": 256, "nprobe": 32, "m": 16}),
+               ("hnsw", {"m": 16, "ef_search": 32}),
+               ("hnsw", {"m": 16, "ef_search": 128})]
+    for kind, params in configs:
+        if kind == "ivfpq" and train_encodings.size(1) % params["m"] != 0:
+            continue
+        start = time.perf_counter()
+        index = build_index(kind, train_encodings, **params)
+        build_s = time.perf_counter() - start
+        found, query_ms = timed_search(lambda q: index.search(q, opt.k)[1])
+        name = kind + "".join(" %s=%s" % item for item in sorted(params.items()) if item[0] != "m" or kind == "hnsw")
+        print("%-28s %10.1f %12.3f %10.4f" % (name, build_s, query_ms, recall(found, truth)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Per-epoch cost and padding of `MinPaddingSampler` against the previous implementation, which read the
+length of every example through `__getitem__` and sorted the dataset in Python, on random lengths shaped
+like the top1000 data (diffs up to -src_len tokens, messages up to -tgt_len tokens).
+Padding is the share of padded positions in the source batches.
+
+Run from the repository root: python -m benchmarks.sampler
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from onmt.inputters.input_aux import MinPaddingSampler
+
+
+class LengthDataset(object):
+    """Examples carrying only their lengths, laid out like the `TextDataset` ones"""
+    sort_index = 3
+
+    def __init__(self, lengths):
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        return None, None, idx, int(self.lengths[idx, 0]), int(self.lengths[idx, 1])
+
+
+def previous_batches(dataset, batch_size, shuffle_batches):
+    """The batches of the previous implementation, in sents mode"""
+    indices = [(i, s[dataset.sort_index]) for i, s in enumerate(dataset)]
+    if shuffle_batches:
+        sorted_indices = sorted(indices, key=lambda x: x[1], reverse=True)
+        batches = [[x[0] for x in sorted_indices[i:i + batch_size]] for i in range(0, len(sorted_indices), batch_size)]
+        random.shuffle(batches)
+        return batches
+    return [[x[0] for x in sorted(indices[i:i + batch_size], key=lambda x: x[1], reverse=True)]
+            for i in range(0, len(indices), batch_size)]
+
+
+def padding(lengths, batches):
+    src_lengths = lengths[:, 0]
+    padded = sum(int(src_lengths[batch].max()) * len(batch) for batch in batches)
+    return 1 - src_lengths.sum() / padded
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-examples", type=int, default=1000000)
+    parser.add_argument("-batch_size", type=int, default=64)
+    parser.add_argument("-src_len", type=int, default=100)
+    parser.add_argument("-tgt_len", type=int, default=30)
+    parser.add_argument("-repeat", type=int, default=3)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    lengths = np.stack([rng.randint(1, opt.src_len + 1, opt.examples),
+                        rng.randint(1, opt.tgt_len + 1, opt.examples)], 1).astype(np.int32)
+    dataset = LengthDataset(lengths)
+
+    print("%d examples, batch %d" % (opt.examples, opt.batch_size))
+    print("%-28s %12s %10s" % ("sampler", "s / epoch", "padding"))
+    for name, shuffle_batches, sort_globally in [("training", True, False), ("inference, windows", False, False),
+                                                 ("inference, sorted", False, True)]:
+        sampler = MinPaddingSampler(dataset, opt.batch_size, shuffle_batches, sort_globally)
+        batches, seconds = timed(lambda: list(sampler), opt.repeat)
+        if not sort_globally:
+            previous, previous_seconds = timed(lambda: previous_batches(dataset, opt.batch_size, shuffle_batches),
+                                               opt.repeat)
+            print("%-28s %12.3f %9.1f%%" % ("previous, " + name, previous_seconds, 100 * padding(lengths, previous)))
+        print("%-28s %12.3f %9.1f%%" % (name, seconds, 100 * padding(lengths, batches)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Benchmark of the batched sentence bleu against the per-pair `get_bleu` loop previously used to weight
+the semantic samples, on random sentences drawn from a small vocabulary so that n-grams do match.
+Also checks that both give the same scores once rounded to 4 decimals.
+
+Run from the repository root: python -m benchmarks.sentence_bleu
+"""
+import argparse
+import time
+
+import numpy as np
+
+from evaluate_res import batch_sentence_bleu, get_bleu
+
+
+def random_sentences(n, vocab_size, max_len, rng):
+    return [["w%d" % w for w in rng.randint(0, vocab_size, rng.randint(1, max_len + 1))] for _ in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=2000)
+    parser.add_argument("-vocab_size", type=int, default=50)
+    parser.add_argument("-max_len", type=int, default=100)
+    parser.add_argument("-workers", type=int, default=4)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    translations = random_sentences(opt.n, opt.vocab_size, opt.max_len, rng)
+    references = random_sentences(opt.n, opt.vocab_size, opt.max_len, rng)
+
+    start = time.perf_counter()
+    reference_scores = np.array([np.around(get_bleu([t], [r])[0], 4) for t, r in zip(translations, references)])
+    loop_s = time.perf_counter() - start
+    print("%-28s %10s %10s" % ("implementation", "time (s)", "mismatch"))
+    print("%-28s %10.3f %10s" % ("get_bleu loop", loop_s, "-"))
+    for workers in sorted({1, opt.workers}):
+        start = time.perf_counter()
+        scores = np.around(batch_sentence_bleu(translations, references, workers=workers), 4)
+        batch_s = time.perf_counter() - start
+        print("%-28s %10.3f %10d" % ("batched, %d workers" % workers, batch_s, (scores != reference_scores).sum()))
+
+
+if __name__ == "__main__":
+    main()
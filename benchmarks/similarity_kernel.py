@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the blocked cosine top-k kernel against the similarity computation
+previously done for every test batch by `DiffTranslator.offline_semantic_retrieval`.
+
+Run from the repository root: python -m benchmarks.similarity_kernel
+"""
+import argparse
+import time
+
+import torch
+
+from onmt.retrieval.similarity import blocked_cosine_topk, default_block_rows, normalize
+
+
+def reference_top1(feature, train_encodings_indexes):
+    """The per-batch similarity of the previous implementation"""
+    numerator = torch.mm(feature, train_encodings_indexes.transpose(0, 1))
+    denominator = torch.mm(feature.norm(2, 1).unsqueeze(1),
+                           train_encodings_indexes.norm(2, 1).unsqueeze(1).transpose(0, 1))
+    sims = torch.div(numerator, denominator)
+    return torch.topk(sims, 1, dim=1)[1]
+
+
+def blocked(queries, normalized_train, k):
+    block_rows = default_block_rows(queries.size(0), normalized_train.size(1))
+    blocks = ((start, normalized_train[start:start + block_rows], None)
+              for start in range(0, normalized_train.size(0), block_rows))
+    return blocked_cosine_topk(queries, blocks, k)[1]
+
+
+def timed(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n_train", type=int, default=200000)
+    parser.add_argument("-n_test", type=int, default=1024)
+    parser.add_argument("-dim", type=int, default=512)
+    parser.add_argument("-batch_size", type=int, default=32)
+    parser.add_argument("-repeat", type=int, default=3)
+    parser.add_argument("-gpu", action="store_true")
+    opt = parser.parse_args()
+
+    device = torch.device("cuda" if opt.gpu else "cpu")
+    generator = torch.Generator().manual_seed(0)
+    train = torch.randn(opt.n_train, opt.dim, generator=generator).to(device)
+    test = torch.randn(opt.n_test, opt.dim, generator=generator).to(device)
+    batches = test.split(opt.batch_size)
+
+    reference, reference_s = timed(lambda: torch.cat([reference_top1(b, train) for b in batches]), opt.repeat)
+    normalized_train, normalize_s = timed(lambda: normalize(train), 1)
+    print("train %d x %d, test %d, batch %d, device %s" % (opt.n_train, opt.dim, opt.n_test, opt.batch_size, device))
+    print("%-36s %10s %10s" % ("kernel", "time (s)", "top1 agree"))
+    print("%-36s %10.3f %10s" % ("reference, per batch, k=1", reference_s, "-"))
+    print("%-36s %10.3f %10s" % ("normalize train once", normalize_s, "-"))
+    for k in [1, 5]:
+        per_batch, per_batch_s = timed(lambda: torch.cat([blocked(b, normalized_train, k) for b in batches]), opt.repeat)
+        all_at_once, all_at_once_s = timed(lambda: blocked(test, normalized_train, k), opt.repeat)
+        agree = (per_batch[:, 0] == reference[:, 0]).float().mean().item()
+        print("%-36s %10.3f %10.4f" % ("blocked, per batch, k=%d" % k, per_batch_s, agree))
+        agree = (all_at_once[:, 0] == reference[:, 0]).float().mean().item()
+        print("%-36s %10.3f %10.4f" % ("blocked, whole test set, k=%d" % k, all_at_once_s, agree))
+
+
+if __name__ == "__main__":
+    main()
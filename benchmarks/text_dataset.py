@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Memory and pickling cost of the texts of `TextDataset` against the lists of lists of tokens previously kept,
+on a diff file (e.g. data/top1000/cleaned.train.diff) or on random tokens shaped like the top1000 diffs.
+
+Run from the repository root: python -m benchmarks.text_dataset [-src path]
+"""
+import argparse
+import codecs
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from onmt.inputters.text_dataset import TextDataset
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    texts = build()
+    seconds = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    size = len(pickle.dumps(texts, 2))
+    return memory, size, seconds, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-src", default=None)
+    parser.add_argument("-lines", type=int, default=100000)
+    parser.add_argument("-src_len", type=int, default=100)
+    parser.add_argument("-vocab_size", type=int, default=50000)
+    opt = parser.parse_args()
+
+    path = opt.src
+    if path is None:
+        rng = np.random.RandomState(0)
+        handle, path = tempfile.mkstemp(suffix=".diff")
+        with os.fdopen(handle, "w") as f:
+            for _ in range(opt.lines):
+                ids = rng.zipf(1.3, rng.randint(1, opt.src_len + 1)) % opt.vocab_size
+                f.write(" ".join("w%d" % i for i in ids) + "\n")
+
+    def previous():
+        with codecs.open(path, "r", "utf-8") as f:
+            return [line.strip().split() for line in f]
+
+    try:
+        print("%-12s %12s %12s %10s %10s" % ("texts", "memory (MB)", "pickle (MB)", "read (s)", "pickle (s)"))
+        for name, build in [("lists", previous), ("TextDataset", lambda: TextDataset(path).src_texts)]:
+            memory, size, read_s, pickle_s = measure(build)
+            print("%-12s %12.1f %12.1f %10.2f %10.2f" % (name, memory / 2 ** 20, size / 2 ** 20, read_s, pickle_s))
+    finally:
+        if opt.src is None:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Throughput of DiffTranslator.translate with the default windowed batching and with the
+test set sorted by length (-sort_by_length), in sentences and in tokens per batch.
+Takes the usual translate.py options, e.g. on the top1000 test set:
+
+    python -m benchmarks.translate_buckets -model models/CoRec_1000_step_100000.pt \\
+        -src data/top1000/cleaned_test.diff -tgt data/top1000/cleaned_test.msg \\
+        -src_vocab data/top1000/vocab.pt -output data/output/bench.out -batch_size 30
+
+The translations of every mode are written to <output>.<mode> and compared with the first one.
+"""
+import time
+
+import configargparse
+
+import onmt.opts as opts
+from diff_trans import build_translator
+from onmt.utils.logging import init_logger
+
+
+def main():
+    parser = configargparse.ArgumentParser(description=__doc__, formatter_class=configargparse.RawDescriptionHelpFormatter)
+    opts.config_opts(parser)
+    opts.translate_opts(parser)
+    parser.add('--token_batch_size', '-token_batch_size', type=int, default=None,
+               help="Source tokens per batch of the tokens mode, defaults to batch_size x max_sent_length / 4")
+    opt = parser.parse_args()
+    init_logger(opt.log_file)
+    token_batch_size = opt.token_batch_size or opt.batch_size * opt.max_sent_length // 4
+
+    modes = [("windows", False, "sents", opt.batch_size),
+             ("sorted", True, "sents", opt.batch_size),
+             ("sorted_tokens", True, "tokens", token_batch_size)]
+    translator = build_translator(opt, report_score=False)
+    n = len(translator.test_dataset)
+    reference = None
+    print("%-16s %10s %12s %10s" % ("mode", "time (s)", "sents/s", "same out"))
+    for name, sort_by_length, batch_type, batch_size in modes:
+        translator.opt.sort_by_length = sort_by_length
+        translator.opt.batch_type = batch_type
+        out_file = "%s.%s" % (opt.output, name)
+        start = time.perf_counter()
+        translator.translate(test_diff=opt.src, test_msg=opt.tgt, batch_size=batch_size, sem_path=opt.sem_path,
+                             out_file=out_file)
+        elapsed = time.perf_counter() - start
+        with open(out_file) as f:
+            predictions = f.read()
+        if reference is None:
+            reference = predictions
+        print("%-16s %10.2f %12.1f %10s" % (name, elapsed, n / elapsed, predictions == reference))
+
+
+if __name__ == "__main__":
+    main()
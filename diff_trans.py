@@ -8,15 +8,21 @@ import configargparse
 import numpy as np
 import torch
 
-from evaluate_res import get_bleu, evaluate_translations
+from evaluate_res import batch_sentence_bleu, evaluate_translations
 from onmt.helpers.report_manager import build_report_manager
 import onmt.opts as opts
 from onmt.inputters import vocabulary
 from onmt.helpers.model_builder import load_test_model
 from onmt.inputters.text_dataset import SemTextDataset, TextDataset
 from onmt.inputters.input_aux import build_dataset_iter, load_dataset, load_vocab
+from onmt.decoders.decoder import RNNDecoderBase
 from onmt.encoders.transformer import TransformerEncoder
+from onmt.retrieval import EmbeddingStore, StreamingFlatIndex, build_index, load_index
+from onmt.retrieval.encoding import encode_ranges, max_pool
+from onmt.retrieval.neighbours import read_neighbours, write_neighbours
+from onmt.utils.line_index import LineIndex
 from onmt.utils.misc import tile, read_file
+from onmt.translate.finished_hypotheses import FinishedHypotheses
 from onmt.translate.translation_wrapper import TranslationBuilder
 
 
@@ -40,9 +46,9 @@ class DiffTranslator(object):
                  model_details,
                  report_score=True):
 
-        self.shard_dir_default = "data/sem_shard/"
         self.sem_diff_default = "sem.diff"
         self.sem_msg_default = "sem.msg"
+        self.sem_topk_default = "sem.topk"
         self.test_dataset = TextDataset(opt.src, opt.tgt, opt.max_sent_length)
         self.src_vocab = load_vocab(opt.src_vocab)
 
@@ -51,8 +57,14 @@ class DiffTranslator(object):
                 os.mkdir(opt.sem_path)
             files = os.listdir(opt.sem_path)
             if len(files) > 0:
-                assert self.sem_msg_default in files and self.sem_diff_default in files, \
-                    "Empty the sem_path folder specified to recompute the data or check that all semantic files are present in the folder"
+                # the samples of every rank decoded, and their similarities when they weight the decoders
+                required = [self._sem_file(name, rank) for rank in range(opt.sem_topk)
+                            for name in [self.sem_diff_default, self.sem_msg_default]]
+                if opt.sem_score == "cosine":
+                    required.append(self.sem_topk_default)
+                missing = [name for name in required if name not in files]
+                assert not missing, "Empty the sem_path folder specified to recompute the data or check that all " \
+                                     "semantic files are present in the folder, missing: %s" % ", ".join(missing)
 
         self.opt = opt
         self.model = model
@@ -64,10 +76,18 @@ class DiffTranslator(object):
         self.report_score = report_score
         self.report_manager = build_report_manager(opt, "translate")
         self.report_manager.report_model_details(model_stats=model_train_stats, semantic=opt.sem_path is not None)
+        assert opt.batch_type == "sents" or opt.sort_by_length, "-batch_type tokens needs -sort_by_length"
 
         if not opt.semantic_only and opt.sem_path is not None:
             self.lam_sem = self.opt.lam_sem
-            self.sem_decoder = copy.deepcopy(self.model.decoder)
+            # number of semantic samples decoded along each source
+            self.sem_k = self.opt.sem_topk
+            if self.opt.fuse_sem_decoder:
+                # the semantic samples are decoded by the model decoder, along the sources
+                assert isinstance(self.model.decoder, RNNDecoderBase), "-fuse_sem_decoder needs a RNN decoder"
+                self.sem_decoder = None
+            else:
+                self.sem_decoder = copy.deepcopy(self.model.decoder)
 
     def _compute_bleu_score(self, sem_diff_path, test_diff_path):
         """
@@ -78,15 +98,102 @@ class DiffTranslator(object):
         """
         test_diffs = read_file(test_diff_path)
         sem_diffs = read_file(sem_diff_path)
-        sem_scores = []
-
-        for sem, test in zip(sem_diffs, test_diffs):
-            bleu_score_sem = np.around(get_bleu([sem.strip().lower().split(" ")], [test.strip().lower().split(" ")])[0], 4)
-            sem_scores.append(bleu_score_sem)
+        n = min(len(sem_diffs), len(test_diffs))
+        scores = batch_sentence_bleu([sem.strip().lower().split(" ") for sem in sem_diffs[:n]],
+                                     [test.strip().lower().split(" ") for test in test_diffs[:n]],
+                                     workers=self.opt.bleu_workers)
+        return list(np.around(scores, 4))
+
+    @staticmethod
+    def _sem_file(name, rank):
+        """File of the semantic samples of a given rank, the best ones are in `name` itself"""
+        return name if rank == 0 else "%s.%d" % (name, rank)
+
+    def _sem_scores(self, sem_path, test_diff):
+        """
+        Similarity of the test diffs with each of their `-sem_topk` semantic diffs, weighting the semantic decoders
+        :return: (`FloatTensor`) `[n_test x sem_topk]`
+        """
+        if self.opt.sem_score == "cosine":
+            _, scores = read_neighbours(os.path.join(sem_path, self.sem_topk_default))
+            assert scores.size(1) >= self.sem_k, "%s holds %d neighbours per diff, %d were requested" % (
+                self.sem_topk_default, scores.size(1), self.sem_k)
+            # a negative weight would remove probability mass from the mixture
+            return scores[:, :self.sem_k].clamp(min=0)
+        return torch.stack([torch.tensor(self._compute_bleu_score(
+            os.path.join(sem_path, self._sem_file(self.sem_diff_default, rank)), test_diff)) for rank in range(self.sem_k)], 1)
+
+    def _sem_index_path(self):
+        if self.opt.sem_index_path is not None:
+            return self.opt.sem_index_path
+        return "%s.%s.index" % (os.path.splitext(self.opt.models[0])[0], self.opt.sem_index)
+
+    def _sem_index_params(self):
+        """Parameters the index is built with, a saved index built with other ones is rebuilt"""
+        if self.opt.sem_index == "ivfpq":
+            return {"nlist": self.opt.sem_index_nlist, "m": self.opt.sem_index_pq_m}
+        if self.opt.sem_index == "hnsw":
+            return {"m": self.opt.sem_index_hnsw_m, "ef_construction": self.opt.sem_index_ef_construction}
+        return {}
+
+    def _sem_search_params(self):
+        """Parameters of the queries only, they are applied to the saved indexes as well"""
+        if self.opt.sem_index == "ivfpq":
+            return {"nprobe": self.opt.sem_index_nprobe}
+        if self.opt.sem_index == "hnsw":
+            return {"ef_search": self.opt.sem_index_ef_search}
+        return {}
+
+    def _encode_train_set(self, store, train_diff, batch_size, start_byte=0):
+        """
+        Encode the training diffs and max-pool the encoder outputs over time, the features are
+        added to the store in shards, in file order.
+        The diffs are split into ranges of 200 batches, encoded by `-encode_workers` processes.
+        :param store: (`EmbeddingStore`) where the features are saved
+        :param train_diff: (str) filepath of the training diffs
+        :param batch_size: (int) size of examples per mini-batch
+        :param start_byte: (int) offset of the first line of train_diff to encode
+        """
+        byte_ranges = LineIndex(train_diff).ranges(start_byte, lines_per_chunk=200 * batch_size)
+        for features in encode_ranges(self.model.encoder, self.src_vocab, train_diff, byte_ranges,
+                                      self.opt.max_sent_length, batch_size, gpu=self.gpu,
+                                      workers=self.opt.encode_workers, threads=self.opt.encode_threads):
+            store.add(features)
 
-        # write_file("data/new/syn_bleu.score", syn_scores)
-        # write_file("data/new/sem_bleu.score", sem_scores)
-        return sem_scores
+    def _load_or_build_index(self, store, cached_rows):
+        """
+        Load the approximate retrieval index of the store encodings, it is updated when the store
+        grew since it was saved and rebuilt when it belongs to another store or was built with other parameters.
+        The search parameters of the options are applied to the loaded index.
+        :param store: (`EmbeddingStore`) encodings of the training diffs
+        :param cached_rows: (int) number of encodings the store held before this run
+        """
+        index_path = self._sem_index_path()
+        params = self._sem_index_params()
+        index_meta = {"store": store.key, "train_digest": store.digest, "rows": store.rows,
+                      "kind": self.opt.sem_index, "params": params}
+        index = load_index(index_path) if os.path.isfile(index_path) else None
+        if index is not None and index.meta == index_meta:
+            print(f"Loading retrieval index {index_path}")
+            index.set_search_params(**self._sem_search_params())
+            return index
+
+        same_index = index is not None and all(index.meta.get(key) == index_meta[key] for key in ["store", "kind", "params"])
+        if same_index and index.meta.get("rows") == cached_rows and len(index) == cached_rows:
+            # the corpus grew, index only the new diffs
+            print(f"Adding {store.rows - cached_rows} training diffs to the retrieval index {index_path}")
+            for start, block in store.iter_blocks():
+                if start >= cached_rows:
+                    index.add(block)
+        else:
+            print(f"Building {self.opt.sem_index} retrieval index over {store.rows} training diffs")
+            index = build_index(self.opt.sem_index, (block for _, block in store.iter_blocks()),
+                                training_vectors=store.sample(262144), **params)
+        index.set_search_params(**self._sem_search_params())
+        index.meta = index_meta
+        index.save(index_path)
+        print(f"Saving retrieval index {index_path}")
+        return index
 
     def offline_semantic_retrieval(self, test_diff=None, train_diff=None, train_msg=None, batch_size=None, semantic_out_dir=None):
         """
@@ -95,6 +202,8 @@ class DiffTranslator(object):
            sem.msg
            sem.diff
            shared_sem_vocab.pt
+        With -sem_topk k > 1 the neighbours of rank n > 0 are saved in sem.msg.n and sem.diff.n.
+        The ids and cosine similarities of the k neighbours are saved in the binary file sem.topk.
         """
         if test_diff is None or train_diff is None or train_msg is None:
             raise AssertionError("data files paths [--test_diff, --train_diff, --train_msg] must be specified")
@@ -104,87 +213,68 @@ class DiffTranslator(object):
 
         max_sent_length = self.opt.max_sent_length
 
-        # load/create dataset and create iterator
-        ds = TextDataset(train_diff, src_max_len=max_sent_length)
-
-        data_iter = build_dataset_iter(ds, self.src_vocab, batch_size, gpu=self.gpu, shuffle_batches=False)
-
-        memories = []
-        shard = 0
-        if not os.path.exists(self.shard_dir_default):
-            os.makedirs(self.shard_dir_default)
-        # run encoder
-        for batch in data_iter:
-            src = batch["src_batch"]
-            source_lengths = batch["src_len"]
-            batch_indices = batch["indexes"]
-            enc_states, memory_bank, src_lengths = self.model.encoder(src, source_lengths)
-
-            feature = torch.max(memory_bank, 0)[0]
-            _, rank = torch.sort(batch_indices, descending=False)
-            feature = feature[rank]
-            memories.append(feature)
-            # consider the memory, must shard
-            if len(memories) % 200 == 0:  # save file
-                memories = torch.cat(memories)
-                torch.save(memories, self.shard_dir_default + "shard.%d" % shard)
-                print(f"Saving shard {self.shard_dir_default}shard.{shard}")
-                memories = []
-                shard += 1
-        if len(memories) > 0:
-            memories = torch.cat(memories)
-            torch.save(memories, self.shard_dir_default + "shard.%d" % shard)
-            print(f"Saving shard {self.shard_dir_default}shard.{shard}")
-            shard += 1
-
-        train_encodings_indexes = []
-        for i in range(shard):
-            shard_index = torch.load(self.shard_dir_default + "shard.%d" % i)
-            train_encodings_indexes.append(shard_index)
-        train_encodings_indexes = torch.cat(train_encodings_indexes)
-
-        # get ordered train diffs and msgs from source in order to make use of full length data
-        with open(train_msg, 'r') as tm:
-            train_msgs = tm.readlines()
-        with open(train_diff, 'r') as td:
-            train_diffs = td.readlines()
+        # encode only the training diffs which are not in the store yet
+        store = EmbeddingStore(self.opt.sem_cache_dir, self.opt.models[0], self.opt.src_vocab, max_sent_length,
+                               dtype=self.opt.sem_cache_dtype)
+        cached_rows = store.cached_rows(train_diff)
+        self._encode_train_set(store, train_diff, batch_size, start_byte=store.cached_bytes)
+        if store.rows > cached_rows or store.rows == 0:
+            store.commit(train_diff)
+            print(f"Encoded {store.rows - cached_rows} new training diffs, {store.rows} in {store.path}")
+        else:
+            print(f"Reusing the {store.rows} training diffs encodings in {store.path}")
+        if store.rows == 0:
+            raise ValueError("%s holds no training diffs to retrieve" % train_diff)
+
+        if self.opt.sem_index == "flat":
+            # exact search streams over the memory-mapped store, there is no separate index
+            index = StreamingFlatIndex(store.files)
+        else:
+            index = self._load_or_build_index(store, cached_rows)
+        if self.gpu:
+            index.to(torch.device("cuda"))
+
+        if self.opt.sem_topk > len(index):
+            raise ValueError("-sem_topk %d is larger than the %d training diffs" % (self.opt.sem_topk, len(index)))
 
         # search the best (most similar) correspondence of test set encodings with computed training set encodings
-        data_iter = build_dataset_iter(self.test_dataset, self.src_vocab, batch_size, gpu=self.gpu, shuffle_batches=False)
-
-        diffs = []
-        msgs = []
-        for batch in data_iter:
-            src = batch["src_batch"]
-            source_lengths = batch["src_len"]
-            batch_indices = batch["indexes"]
-            enc_states, memory_bank, src_lengths = self.model.encoder(src, source_lengths)
-            # get the token with maximum attention for all samples in batch
-            feature = torch.max(memory_bank, 0)[0]
+        data_iter = build_dataset_iter(self.test_dataset, self.src_vocab, batch_size, gpu=self.gpu, shuffle_batches=False,
+                                       sort_globally=True, num_workers=self.opt.num_workers,
+                                       pin_memory=self.opt.pin_memory, prefetch_factor=self.opt.prefetch_factor)
+
+        features, indexes = [], []
+        with torch.no_grad():
+            for batch in data_iter:
+                src = batch["src_batch"]
+                source_lengths = batch["src_len"]
+                enc_states, memory_bank, src_lengths = self.model.encoder(src, source_lengths)
+                # get the token with maximum attention for all samples in batch
+                features.append(max_pool(memory_bank, source_lengths))
+                indexes.append(batch["indexes"])
             # reorder attention results as the order of samples in dataset
-            _, rank = torch.sort(batch_indices, descending=False)
-            feature = feature[rank]
-            # compute similarities
-            numerator = torch.mm(feature, train_encodings_indexes.transpose(0, 1))
-            denominator = torch.mm(feature.norm(2, 1).unsqueeze(1),
-                                   train_encodings_indexes.norm(2, 1).unsqueeze(1).transpose(0, 1))
-            sims = torch.div(numerator, denominator)
-            # get indices of most similar
-            tops = torch.topk(sims, 1, dim=1)
-            idx = tops[1][:, -1].tolist()
-            for i in idx:
-                diffs.append(train_diffs[i].strip() + '\n')
-                msgs.append(train_msgs[i].strip() + '\n')
-
-        with open(os.path.join(semantic_out_dir, self.sem_msg_default), 'w') as sm:
-            for i in msgs:
-                sm.write(i)
-                sm.flush()
-
-        with open(os.path.join(semantic_out_dir, self.sem_diff_default), 'w') as of:
-            for i in diffs:
-                of.write(i)
-                of.flush()
+            _, rank = torch.sort(torch.cat(indexes))
+            # search all the test samples at once, so that the training encodings are scanned a single time
+            k = self.opt.sem_topk
+            scores, tops = index.search(torch.cat(features)[rank], k)
+        # approximate indexes may find less than k neighbours, repeat the best one
+        missing = tops < 0
+        if missing[:, 0].any():
+            raise ValueError(f"The {self.opt.sem_index} index found no neighbour for {int(missing[:, 0].sum())} test diffs, "
+                             "increase -sem_index_nprobe or -sem_index_ef_search")
+        if missing.any():
+            print(f"The {self.opt.sem_index} index found less than {k} neighbours for {int(missing.any(1).sum())} "
+                  f"test diffs, their best neighbour is repeated")
+        tops[missing] = tops[:, :1].expand_as(tops)[missing]
+        scores[missing] = scores[:, :1].expand_as(scores)[missing]
+        write_neighbours(os.path.join(semantic_out_dir, self.sem_topk_default), tops, scores)
+
+        # fetch only the retrieved lines, the training files are never loaded as a whole
+        for path, out_name in [(train_msg, self.sem_msg_default), (train_diff, self.sem_diff_default)]:
+            line_index = LineIndex(path)
+            for rank in range(k):
+                lines = line_index.read_lines(tops[:, rank].tolist())
+                with open(os.path.join(semantic_out_dir, self._sem_file(out_name, rank)), 'w') as out:
+                    out.writelines(line.decode("utf-8").strip() + '\n' for line in lines)
 
         return
 
@@ -218,14 +308,20 @@ class DiffTranslator(object):
             os.remove(out_log_filename)
 
         if sem_path is not None:
-            self.sem_score = torch.tensor(self._compute_bleu_score(os.path.join(sem_path, self.sem_diff_default), test_diff))
-            self.test_dataset = SemTextDataset(test_diff, test_msg, os.path.join(sem_path, self.sem_diff_default),
+            self.sem_score = self._sem_scores(sem_path, test_diff)
+            self.test_dataset = SemTextDataset(test_diff, test_msg,
+                                               [os.path.join(sem_path, self._sem_file(self.sem_diff_default, rank))
+                                                for rank in range(self.sem_k)],
                                                self.opt.max_sent_length)
 
         n_best = self.opt.n_best
         vocab = self.src_vocab
 
-        test_loader = build_dataset_iter(self.test_dataset, vocab, batch_size, gpu=self.gpu, shuffle_batches=False)
+        # with -sort_by_length batches are formed over the whole test set, and translations come out of order
+        test_loader = build_dataset_iter(self.test_dataset, vocab, batch_size, gpu=self.gpu, shuffle_batches=False,
+                                         sort_globally=self.opt.sort_by_length, batch_type=self.opt.batch_type,
+                                         num_workers=self.opt.num_workers, pin_memory=self.opt.pin_memory,
+                                         prefetch_factor=self.opt.prefetch_factor)
 
         translation_wrapper_builder = TranslationBuilder(self.test_dataset, vocab["tgt"], n_best, len(self.test_dataset.target_texts) > 0)
 
@@ -236,6 +332,8 @@ class DiffTranslator(object):
         all_scores = []
         all_predictions = []
         batch_counter = 0
+        # translations waiting for the ones before them in the test set, by index
+        pending = {}
 
         for batch in test_loader:
             # batch here contains {diff_batch, diff_length, msg_batch, msg_length, sem_batch, sem_length}
@@ -244,9 +342,8 @@ class DiffTranslator(object):
             batch_data = self._process_batch(batch, real_batch_size, sem_path, vocab["tgt"], attn_debug=attn_debug)
             # a batch of results returned from the model is obtained and processed to fit a TranslationWrapper object
             translations = translation_wrapper_builder.from_batch(batch_data, real_batch_size)
-            # iter over the objects to build the sentences
-            for i, trans in enumerate(translations):
-                all_scores += [trans.pred_scores[:n_best]]
+            # iter over the objects to build the sentences, they are sorted by index
+            for index, trans in zip(sorted(batch["indexes"].tolist()), translations):
                 pred_score_total += trans.pred_scores[0]
                 pred_words_total += len(trans.pred_sents[0])
                 if test_msg is not None:
@@ -254,28 +351,34 @@ class DiffTranslator(object):
                     gold_words_total += len(trans.gold_sent) + 1
 
                 n_best_preds = [" ".join(pred) for pred in trans.pred_sents[:n_best]]
-                all_predictions += [n_best_preds]
-                with open(out_file, 'a+') as of:
-                    of.write('\n'.join(n_best_preds) + '\n')
-                    of.flush()
 
                 hypothesis = [[token.lower() for token in sent] for sent in trans.pred_sents]
                 references = [[gold_token.lower() for gold_token in trans.gold_sent]]
                 results = evaluate_translations(hypothesis, references, ["Meteor", "Bleu"])
 
-                with open(out_log_filename, 'a+') as log_of:
-                    log_of.write('Prediction: ' + '\n'.join(n_best_preds) + '\n'
-                                 + 'Gold: ' + ' '.join(trans.gold_sent) + '\n'
-                                 + 'Bleu: ' + str(" ".join([str(bleu_ngram) for bleu_ngram in results["Bleu"][1]])) +'\n'
-                                 + 'Bleu mean: ' + str(results["Bleu"][0]) + '\n'
-                                 + 'Meteor: ' + str(results["Meteor"]) + '\n'
+                log = ('Prediction: ' + '\n'.join(n_best_preds) + '\n'
+                       + 'Gold: ' + ' '.join(trans.gold_sent) + '\n'
+                       + 'Bleu: ' + str(" ".join([str(bleu_ngram) for bleu_ngram in results["Bleu"][1]])) +'\n'
+                       + 'Bleu mean: ' + str(results["Bleu"][0]) + '\n'
+                       + 'Meteor: ' + str(results["Meteor"]) + '\n'
                 # commented out being very slow
-                #                 + 'Precision BertScore: ' + str(results["BertScore"][0]) + '\n'
-                #                 + 'Recall BertScore: ' + str(results["BertScore"][1]) + '\n'
-                #                 + 'F1 BertScore: ' + str(results["BertScore"][2]) + '\n'
-                                 + '\n\n')
-
-                    log_of.flush()
+                #      + 'Precision BertScore: ' + str(results["BertScore"][0]) + '\n'
+                #      + 'Recall BertScore: ' + str(results["BertScore"][1]) + '\n'
+                #      + 'F1 BertScore: ' + str(results["BertScore"][2]) + '\n'
+                       + '\n\n')
+                pending[index] = (trans.pred_scores[:n_best], n_best_preds, log)
+
+            # write the translations in the order of the test set
+            ready = []
+            while len(all_predictions) + len(ready) in pending:
+                ready.append(pending.pop(len(all_predictions) + len(ready)))
+            if ready:
+                with open(out_file, 'a+') as of, open(out_log_filename, 'a+') as log_of:
+                    for scores, n_best_preds, log in ready:
+                        all_scores += [scores]
+                        all_predictions += [n_best_preds]
+                        of.write('\n'.join(n_best_preds) + '\n')
+                        log_of.write(log)
 
             if self.report_score:
                 self.report_manager.report_trans_score('PRED', pred_score_total, pred_words_total)
@@ -288,7 +391,7 @@ class DiffTranslator(object):
 
     def _process_batch(self, batch, batch_size, sem_path, vocab, attn_debug):
         """
-        Translate a batch of sentences
+        Translate a batch of sentences, with a beam search or with the greedy search when beam_size is 1
         :param batch: (:obj:`Batch`) a batch from a dataset object
         :param batch_size: (int) size of the current batch
         :param sem_path: (String) path where to find the semantic files
@@ -296,29 +399,21 @@ class DiffTranslator(object):
         :param attn_debug: store in each result dictionary the cross attention used for decoding
         :return: a dictionary of lists with the results of decoding
         """
-
-        max_length = self.opt.max_length
-        min_length = self.opt.min_length
-        n_best = self.opt.n_best
-        return_attention = attn_debug
-        beam_size = self.opt.beam_size
-        start_token = vocab.vocab[vocabulary.BOS_WORD]
-        end_token = vocab.vocab[vocabulary.EOS_WORD]
-
         with torch.no_grad():
             # Encoder forward.
             src, enc_states, memory_bank, src_lengths = self._run_encoder(batch, batch_size)
             self.model.decoder.init_state(src, memory_bank, enc_states, with_cache=True)
             if sem_path:
                 sem, sem_states, sem_bank, sem_lengths = self._run_sem_encoder(batch, batch_size)
-                self.sem_decoder.init_state(sem, sem_bank, sem_states, with_cache=True)
+                if self.sem_decoder is not None:
+                    self.sem_decoder.init_state(sem, sem_bank, sem_states, with_cache=True)
+                # the sem_k samples of an example are consecutive
+                sem_sc = torch.index_select(self.sem_score.to(src.device), 0,
+                                            batch["indexes"].to(src.device)).view(-1)  ##simi score
             else:
-                sem, sem_states, sem_bank, sem_lengths = None, None, None, None
+                sem, sem_states, sem_bank, sem_lengths, sem_sc = None, None, None, None, None
 
             results = {}
-            results["predictions"] = [[] for _ in range(batch_size)]  # noqa: F812
-            results["scores"] = [[] for _ in range(batch_size)]  # noqa: F812
-            results["attention"] = [[] for _ in range(batch_size)]  # noqa: F812
             results["batch"] = batch
             if batch["tgt_batch"] is not None:
                 results["gold_score"] = self._score_target(batch, memory_bank, src_lengths, vocab)
@@ -326,168 +421,327 @@ class DiffTranslator(object):
             else:
                 results["gold_score"] = [0] * batch_size
 
-            # Tile states and memory beam_size times.
-            self.model.decoder.map_state(lambda state, dim: tile(state, beam_size, dim=dim))
-            if isinstance(memory_bank, tuple):
-                memory_bank = tuple(tile(x, beam_size, dim=1) for x in memory_bank)
-                mb_device = memory_bank[0].device
-            else:
-                memory_bank = tile(memory_bank, beam_size, dim=1)
-                mb_device = memory_bank.device
+            if sem_path and self.sem_decoder is None:
+                # one decoder state for both streams, the rows of the semantic samples follow the source rows
+                self.model.decoder.init_state(sem, sem_bank, sem_states, with_cache=True)
+                sem_state = dict(self.model.decoder.state)
+                self.model.decoder.init_state(src, memory_bank, enc_states, with_cache=True)
+                self.model.decoder.concat_state(sem_state)
+
+            search = self._greedy_search if self.opt.beam_size == 1 else self._beam_search
+            results.update(search(batch_size, vocab, memory_bank, src_lengths, sem_bank, sem_lengths, sem_sc, attn_debug))
+            return results
+
+    def _beam_search(self, batch_size, vocab, memory_bank, src_lengths, sem_bank, sem_lengths, sem_sc, return_attention):
+        """
+        Decode a batch with a beam search, once the decoder states are initialized
+        :param memory_bank: (`FloatTensor`) encoder outputs `[src_len x batch x hidden]`
+        :param src_lengths: (`LongTensor`) source lengths `[batch]`
+        :param sem_bank: (`FloatTensor`) encoder outputs of the semantic samples `[sem_len x batch*sem_k x hidden]`,
+            or None without semantic samples
+        :param sem_lengths: (`LongTensor`) lengths of the semantic samples `[batch*sem_k]`
+        :param sem_sc: (`FloatTensor`) similarity scores of the semantic samples `[batch*sem_k]`
+        :param return_attention: store in each result dictionary the cross attention used for decoding
+        :return: a dictionary of lists of the scores, predictions and attentions of every example
+        """
+        max_length = self.opt.max_length
+        min_length = self.opt.min_length
+        n_best = self.opt.n_best
+        beam_size = self.opt.beam_size
+        start_token = vocab.vocab[vocabulary.BOS_WORD]
+        end_token = vocab.vocab[vocabulary.EOS_WORD]
+        has_sem = sem_bank is not None
+        fuse_sem = has_sem and self.sem_decoder is None
+
+        # Tile states beam_size times. The attention of the RNN decoders folds the beams of an example into
+        # its queries, their memory is kept once per example and only changes when examples finish.
+        # The transformer decoder needs the memory tiled too, and reordered with the beams.
+        fold_beams = isinstance(self.model.decoder, RNNDecoderBase)
+        self.model.decoder.map_state(lambda state, dim: tile(state, beam_size, dim=dim))
+        mb_device = memory_bank[0].device if isinstance(memory_bank, tuple) else memory_bank.device
+        memory_lengths = src_lengths
+        if not fold_beams:
+            memory_bank = self._index_memory(memory_bank, None, beam_size)
             memory_lengths = tile(src_lengths, beam_size)
 
-            if sem_path:
-                sem_sc = torch.index_select(self.sem_score.to(src.device), 0,
-                                            batch["indexes"].to(src.device))  ##simi score
+        if has_sem:
+            # the sem_k samples of an example are consecutive, once tiled the rows are ordered (example, sample, beam)
+            if not fuse_sem:
                 self.sem_decoder.map_state(lambda state, dim: tile(state, beam_size, dim=dim))
-                if isinstance(sem_bank, tuple):
-                    sem_bank = tuple(tile(x, beam_size, dim=1) for x in sem_bank)
-                else:
-                    sem_bank = tile(sem_bank, beam_size, dim=1)
+            if not fold_beams:
+                sem_bank = self._index_memory(sem_bank, None, beam_size)
                 sem_lengths = tile(sem_lengths, beam_size)
-                sem_sc = tile(sem_sc, beam_size).view(-1, 1)
+                sem_sc = tile(sem_sc, beam_size)
+            sem_sc = sem_sc.view(-1, 1)
+        if fuse_sem:
+            fused_bank, fused_lengths = self._fuse_memory(memory_bank, memory_lengths, sem_bank, sem_lengths)
+        # beam search aim is to make n hypothesis at the same time:
+        #   1. expand the input data [1 x batch x 1] --> [1 x batch*beam x 1]
+        #   2. decode
+        #   3. take the 'beam' top values (instead of just one): their indices in mod vocab_size is the n° of token predicted
+        top_beam_finished = torch.zeros([batch_size], dtype=torch.bool, device=mb_device)
+        batch_offset = torch.arange(batch_size, dtype=torch.long, device=mb_device)
+        beam_offset = torch.arange(0, batch_size * beam_size, step=beam_size, dtype=torch.long, device=mb_device)
+        # Hypotheses are kept in buffers allocated once, their first `rows` rows hold the alive beams.
+        # Every step gathers the prefixes of the selected beams in place and writes the new tokens
+        # (and attentions) at the step pointer. Tokens start with start_token, step s writes column s + 1.
+        rows = batch_size * beam_size
+        alive_seq = torch.full([rows, max_length + 1], start_token, dtype=torch.long, device=mb_device)
+        alive_attn = None
+        src_len = None
+        if return_attention:
+            src_len = (memory_bank[0] if isinstance(memory_bank, tuple) else memory_bank).size(0)
+            alive_attn = torch.zeros([max_length, rows, src_len], device=mb_device)
+
+        # Give full probability to the first beam on the first step.
+        topk_log_probs = (
+            torch.tensor([0.0] + [float("-inf")] * (beam_size - 1), device=mb_device).repeat(batch_size))
+
+        # Structure that holds finished hypotheses, on the device until the batch is decoded.
+        hypotheses = FinishedHypotheses(batch_size, n_best, max_length, src_len, device=mb_device)
+        # examples of the alive rows, and the translated ones, on the host
+        alive_examples = list(range(batch_size))
+        translated = []
+
+        for step in range(max_length):
+            decoder_input = alive_seq[:rows, step].view(1, -1, 1)
+            if fuse_sem:
+                log_probs, attn = self._decode_and_generate(decoder_input, fused_bank,
+                                                            memory_lengths=fused_lengths,
+                                                            step=step,
+                                                            sem_sc=sem_sc)
             else:
-                sem_sc, sem_lengths, sem_bank = None, None, None
-            # beam search aim is to make n hypothesis at the same time:
-            #   1. expand the input data [1 x batch x 1] --> [1 x batch*beam x 1]
-            #   2. decode
-            #   3. take the 'beam' top values (instead of just one): their indices in mod vocab_size is the n° of token predicted
-            top_beam_finished = torch.zeros([batch_size], dtype=torch.uint8)
-            batch_offset = torch.arange(batch_size, dtype=torch.long)
-            beam_offset = torch.arange(0, batch_size * beam_size, step=beam_size, dtype=torch.long, device=mb_device)
-            alive_seq = torch.full([batch_size * beam_size, 1], start_token, dtype=torch.long, device=mb_device)
-            alive_attn = None
-
-            # Give full probability to the first beam on the first step.
-            topk_log_probs = (
-                torch.tensor([0.0] + [float("-inf")] * (beam_size - 1), device=mb_device).repeat(batch_size))
-
-            # Structure that holds finished hypotheses.
-            hypotheses = [[] for _ in range(batch_size)]  # noqa: F812
-
-            for step in range(max_length):
-                decoder_input = alive_seq[:, -1].view(1, -1, 1)
                 log_probs, attn = self._decode_and_generate(decoder_input, memory_bank,
                                                             memory_lengths=memory_lengths,
                                                             step=step,
                                                             sem_sc=sem_sc, sem_lengths=sem_lengths, sem_bank=sem_bank)
 
-                vocab_size = len(vocab)
-
-                if step < min_length:
-                    log_probs[:, end_token] = -1e20
-
-                # Multiply probs by the beam probability.
-                log_probs += topk_log_probs.view(-1).unsqueeze(1)
-
-                alpha = 0
-                length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
-
-                # Flatten probs into a list of possibilities.
-                curr_scores = log_probs / length_penalty
-                curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
-                # each array are 'beam_size' decoder results of a single batch (concatenated), where each decoder output is the logprobability referred to each token in vocabulary
-                topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
-
-                # Recover log probs.
-                topk_log_probs = topk_scores * length_penalty
-
-                # Resolve beam origin and true word ids. e.g.[00000] tells that the top5 values were found in the beam 0
-                topk_beam_index = torch.tensor(topk_ids.div(vocab_size), dtype=torch.int64)
-                topk_ids = topk_ids.fmod(vocab_size)  # specify the token index in the vocabulary
-
-                # Map beam_index to batch_index in the flat representation --> alive_seq has size beam*batch x seq_generation_step
-                batch_index = (topk_beam_index + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
+            vocab_size = len(vocab)
+
+            if step < min_length:
+                log_probs[:, end_token] = -1e20
+
+            # Multiply probs by the beam probability.
+            log_probs += topk_log_probs.view(-1).unsqueeze(1)
+
+            alpha = 0
+            length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
+
+            # Flatten probs into a list of possibilities.
+            curr_scores = log_probs / length_penalty
+            curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
+            # each array are 'beam_size' decoder results of a single batch (concatenated), where each decoder output is the logprobability referred to each token in vocabulary
+            topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
+
+            # Recover log probs.
+            topk_log_probs = topk_scores * length_penalty
+
+            # Resolve beam origin and true word ids. e.g.[00000] tells that the top5 values were found in the beam 0
+            topk_beam_index = torch.tensor(topk_ids.div(vocab_size), dtype=torch.int64)
+            topk_ids = topk_ids.fmod(vocab_size)  # specify the token index in the vocabulary
+
+            # Map beam_index to batch_index in the flat representation --> alive_seq has size beam*batch x seq_generation_step
+            batch_index = (topk_beam_index + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
+            select_indices = batch_index.view(-1)
+
+            # Append last prediction --> the vocabulary token of a beam is appended to it's input sequence which generated it.
+            # If in a batch a beam input sequence obtain all topk values (all token different but same beam_index),
+            # the alive_seq will be reassigned with all starting input sequence equal but last token generated.
+            prev_rows, rows = rows, select_indices.size(0)
+            alive_seq[:rows, :step + 1] = alive_seq[:prev_rows, :step + 1].index_select(0, select_indices)
+            alive_seq[:rows, step + 1] = topk_ids.view(-1)
+
+            if return_attention:
+                if step > 0:
+                    alive_attn[:step, :rows] = alive_attn[:step, :prev_rows].index_select(1, select_indices)
+                alive_attn[step, :rows] = attn[0, :, :src_len].index_select(0, select_indices)
+
+            is_finished = topk_ids.eq(end_token)
+            if step + 1 == max_length:
+                is_finished.fill_(1)
+
+            # Penalize beams that finished.
+            topk_log_probs.masked_fill_(is_finished, -1e10)
+            top_beam_finished |= is_finished[:, 0]
+            # With top beam finished as end condition we can return n_best hypotheses.
+            is_done = top_beam_finished & hypotheses.count(batch_offset, is_finished).ge(n_best)
+            # The only values of the step copied to the host: the translated examples, and the ones with finished beams.
+            is_done, has_finished = torch.stack([is_done, is_finished.any(1)]).cpu()
+
+            if has_finished.any():
+                # Save finished hypotheses, their tokens without start_token.
+                hypotheses.add(batch_offset, topk_scores, is_finished,
+                               alive_seq[:rows, 1:step + 2].view(-1, beam_size, step + 1),
+                               alive_attn[:step + 1, :rows].view(step + 1, -1, beam_size, src_len)
+                               if alive_attn is not None else None)
+
+            if is_done.any():
+                translated += [b for b, done in zip(alive_examples, is_done.tolist()) if done]
+                alive_examples = [b for b, done in zip(alive_examples, is_done.tolist()) if not done]
+                non_finished = (~is_done).nonzero().view(-1)
+                # If all sentences are translated, no need to go further.
+                if len(non_finished) == 0:
+                    break
+
+                # Remove finished batches for the next step.
+                non_finished = non_finished.to(topk_ids.device)
+                top_beam_finished = top_beam_finished.index_select(0, non_finished)
+                batch_offset = batch_offset.index_select(0, non_finished)
+                topk_log_probs = topk_log_probs.index_select(0, non_finished)
+                batch_index = batch_index.index_select(0, non_finished)
                 select_indices = batch_index.view(-1)
+                # move the beams of the remaining examples to the first rows of the buffers
+                keep = (non_finished.view(-1, 1) * beam_size +
+                        torch.arange(beam_size, device=non_finished.device)).view(-1)
+                alive_seq[:keep.size(0), :step + 2] = alive_seq[:rows, :step + 2].index_select(0, keep)
+                if alive_attn is not None:
+                    alive_attn[:step + 1, :keep.size(0)] = alive_attn[:step + 1, :rows].index_select(1, keep)
+                rows = keep.size(0)
+                if fold_beams:
+                    # drop the memory of the finished examples
+                    memory_bank = self._index_memory(memory_bank, non_finished)
+                    memory_lengths = memory_lengths.index_select(0, non_finished)
+                    if has_sem:
+                        sem_examples = (non_finished.view(-1, 1) * self.sem_k +
+                                        torch.arange(self.sem_k, device=non_finished.device)).view(-1)
+                        sem_bank = self._index_memory(sem_bank, sem_examples)
+                        sem_lengths = sem_lengths.index_select(0, sem_examples)
+                        sem_sc = sem_sc.index_select(0, sem_examples)
+                    if fuse_sem:
+                        fused_bank, fused_lengths = self._fuse_memory(memory_bank, memory_lengths, sem_bank, sem_lengths)
+
+            # Reorder states.
+            if not fold_beams:
+                memory_bank = self._index_memory(memory_bank, select_indices)
+                memory_lengths = memory_lengths.index_select(0, select_indices)
 
-                # Append last prediction --> the vocabulary token of a beam is appended to it's input sequence which generated it.
-                # If in a batch a beam input sequence obtain all topk values (all token different but same beam_index),
-                # the alive_seq will be reassigned with all starting input sequence equal but last token generated.
-                alive_seq = torch.cat([alive_seq.index_select(0, select_indices), topk_ids.view(-1, 1)], -1)
-
-                if return_attention:
-                    current_attn = attn.index_select(1, select_indices)
-                    if alive_attn is None:
-                        alive_attn = current_attn
-                    else:
-                        alive_attn = alive_attn.index_select(1, select_indices)
-                        alive_attn = torch.cat([alive_attn, current_attn], 0)
-
-                is_finished = topk_ids.eq(end_token)
-                if step + 1 == max_length:
-                    is_finished.fill_(1)
-
-                # Save finished hypotheses.
-                if is_finished.any():
-                    # Penalize beams that finished.
-                    topk_log_probs.masked_fill_(is_finished, -1e10)
-                    is_finished = is_finished.to('cpu')
-                    top_beam_finished |= is_finished[:, 0].eq(1)
-                    predictions = alive_seq.view(-1, beam_size, alive_seq.size(-1))
-                    attention = (
-                        alive_attn.view(
-                            alive_attn.size(0), -1, beam_size, alive_attn.size(-1))
-                        if alive_attn is not None else None)
-                    non_finished_batch = []
-                    for i in range(is_finished.size(0)):
-                        b = batch_offset[i]
-                        finished_hyp = is_finished[i].nonzero().view(-1)
-                        # Store finished hypotheses for this batch.
-                        for j in finished_hyp:
-                            hypotheses[b].append((
-                                topk_scores[i, j],
-                                predictions[i, j, 1:],  # ignore start_token
-                                attention[:, i, j, :memory_lengths[i]]
-                                if attention is not None else None))
-                        # With top beam finished as end condition we can return n_best hypotheses.
-                        if top_beam_finished[i] and len(hypotheses[b]) >= n_best:
-                            best_hyp = sorted(hypotheses[b], key=lambda x: x[0], reverse=True)
-                            for n, (score, pred, attn) in enumerate(best_hyp):
-                                if n >= n_best:
-                                    break
-                                results["scores"][b].append(score)
-                                results["predictions"][b].append(pred)
-                                results["attention"][b].append(attn if attn is not None else [])
-                        else:
-                            non_finished_batch.append(i)
-                    non_finished = torch.tensor(non_finished_batch)
-                    # If all sentences are translated, no need to go further.
-                    if len(non_finished) == 0:
-                        break
-
-                    # Remove finished batches for the next step.
-                    top_beam_finished = top_beam_finished.index_select(0, non_finished)
-                    batch_offset = batch_offset.index_select(0, non_finished)
-                    non_finished = non_finished.to(topk_ids.device)
-                    topk_log_probs = topk_log_probs.index_select(0, non_finished)
-                    batch_index = batch_index.index_select(0, non_finished)
-                    select_indices = batch_index.view(-1)
-                    alive_seq = predictions.index_select(0, non_finished).view(-1, alive_seq.size(-1))
-                    if alive_attn is not None:
-                        alive_attn = attention.index_select(1, non_finished).view(alive_attn.size(0), -1,
-                                                                                  alive_attn.size(-1))
-
-                # Reorder states.
-                if isinstance(memory_bank, tuple):
-                    memory_bank = tuple(x.index_select(1, select_indices) for x in memory_bank)
+            state_indices = select_indices
+            if has_sem:
+                sem_select_indices = self._sem_select_indices(select_indices, beam_size)
+                if not fold_beams:
+                    sem_bank = self._index_memory(sem_bank, sem_select_indices)
+                    sem_lengths = sem_lengths.index_select(0, sem_select_indices)
+                    sem_sc = sem_sc.index_select(0, sem_select_indices)
+                if fuse_sem:
+                    # the rows of the semantic samples follow the prev_rows source rows of the step
+                    state_indices = torch.cat([select_indices, sem_select_indices + prev_rows])
                 else:
-                    memory_bank = memory_bank.index_select(1, select_indices)
+                    self.sem_decoder.map_state(lambda state, dim: state.index_select(dim, sem_select_indices))
 
-                memory_lengths = memory_lengths.index_select(0, select_indices)
+            self.model.decoder.map_state(lambda state, dim: state.index_select(dim, state_indices))
+
+        return hypotheses.results(translated, src_lengths)
 
-                if sem_path:
-                    if isinstance(sem_bank, tuple):
-                        sem_bank = tuple(x.index_select(1, select_indices) for x in sem_bank)
-                    else:
-                        sem_bank = sem_bank.index_select(1, select_indices)
+    def _greedy_search(self, batch_size, vocab, memory_bank, src_lengths, sem_bank, sem_lengths, sem_sc,
+                       return_attention):
+        """
+        Decode a batch one token per step, the most likely one or one sampled among the `random_sampling_topk`
+        most likely ones. There is a single hypothesis per example: the decoder states are neither tiled nor
+        reordered, examples that finished keep being fed end tokens until the whole batch has finished.
+        Same arguments and results as `_beam_search`.
+        """
+        max_length = self.opt.max_length
+        min_length = self.opt.min_length
+        sampling_topk = self.opt.random_sampling_topk
+        sampling_temp = self.opt.random_sampling_temp
+        start_token = vocab.vocab[vocabulary.BOS_WORD]
+        end_token = vocab.vocab[vocabulary.EOS_WORD]
+        assert self.opt.n_best == 1, "-n_best larger than 1 needs -beam_size larger than 1"
 
-                    sem_lengths = sem_lengths.index_select(0, select_indices)
-                    sem_sc = sem_sc.index_select(0, select_indices)
-                    self.sem_decoder.map_state(lambda state, dim: state.index_select(dim, select_indices))
+        device = memory_bank[0].device if isinstance(memory_bank, tuple) else memory_bank.device
+        src_len = (memory_bank[0] if isinstance(memory_bank, tuple) else memory_bank).size(0)
+        memory_lengths = src_lengths
+        if sem_sc is not None:
+            sem_sc = sem_sc.view(-1, 1)
+        if sem_bank is not None and self.sem_decoder is None:
+            memory_bank, memory_lengths = self._fuse_memory(memory_bank, src_lengths, sem_bank, sem_lengths)
+            sem_bank, sem_lengths = None, None
+        # tokens start with start_token, step s writes column s + 1
+        seq = torch.full([batch_size, max_length + 1], start_token, dtype=torch.long, device=device)
+        attention = None
+        if return_attention:
+            attention = torch.zeros([max_length, batch_size, src_len], device=device)
+        scores = torch.zeros([batch_size], device=device)
+        lengths = torch.full([batch_size], max_length, dtype=torch.long, device=device)
+        is_finished = torch.zeros([batch_size], dtype=torch.bool, device=device)
+
+        for step in range(max_length):
+            log_probs, attn = self._decode_and_generate(seq[:, step].view(1, -1, 1), memory_bank,
+                                                        memory_lengths=memory_lengths,
+                                                        step=step,
+                                                        sem_sc=sem_sc, sem_lengths=sem_lengths, sem_bank=sem_bank)
+            if step < min_length:
+                log_probs[:, end_token] = -1e20
+
+            if sampling_topk == 1:
+                token_log_probs, tokens = log_probs.topk(1, dim=-1)
+            else:
+                logits = log_probs / sampling_temp
+                if sampling_topk > 0:
+                    kth_best = logits.topk(sampling_topk, dim=-1)[0][:, -1:]
+                    logits = logits.masked_fill(logits < kth_best, float("-inf"))
+                tokens = torch.multinomial(torch.softmax(logits, -1), 1)
+                token_log_probs = log_probs.gather(1, tokens)
+
+            tokens = tokens.view(-1).masked_fill(is_finished, end_token)
+            scores += token_log_probs.view(-1).masked_fill(is_finished, 0)
+            seq[:, step + 1] = tokens
+            if attention is not None:
+                attention[step] = attn[0, :, :src_len]
+            ends = tokens.eq(end_token) & ~is_finished
+            lengths.masked_fill_(ends, step + 1)
+            is_finished |= ends
+            if is_finished.all():
+                break
+
+        results = {"scores": [], "predictions": [], "attention": []}
+        scores, seq, lengths = scores.cpu(), seq.cpu(), lengths.tolist()
+        attention = attention.cpu() if attention is not None else None
+        for b, (length, src_length) in enumerate(zip(lengths, src_lengths.tolist())):
+            results["scores"].append([scores[b]])
+            results["predictions"].append([seq[b, 1:length + 1]])
+            results["attention"].append([attention[:length, b, :src_length] if attention is not None else []])
+        return results
+
+    @staticmethod
+    def _fuse_memory(memory_bank, memory_lengths, sem_bank, sem_lengths):
+        """
+        Stack the memory of the sources and the memory of the semantic samples along the batch, padded
+        to the longest of both, for a decoder state holding the rows of both streams
+        :return: (`FloatTensor`, `LongTensor`) memory bank `[len x batch + sem_batch x hidden]` and its lengths
+        """
+        assert not isinstance(memory_bank, tuple), "-fuse_sem_decoder does not support ensembles"
+        fused = memory_bank.new_zeros(max(memory_bank.size(0), sem_bank.size(0)), memory_bank.size(1) + sem_bank.size(1),
+                                      memory_bank.size(2))
+        fused[:memory_bank.size(0), :memory_bank.size(1)] = memory_bank
+        fused[:sem_bank.size(0), memory_bank.size(1):] = sem_bank
+        return fused, torch.cat([memory_lengths, sem_lengths])
+
+    @staticmethod
+    def _index_memory(memory_bank, indices, count=None):
+        """
+        Select the columns `indices` of a memory bank, or tile them `count` times when `indices` is None
+        :param memory_bank: (`FloatTensor`) `[src_len x batch x hidden]`, or a tuple of them
+        """
+        def index(x):
+            return tile(x, count, dim=1) if indices is None else x.index_select(1, indices)
 
-                self.model.decoder.map_state(lambda state, dim: state.index_select(dim, select_indices))
+        if isinstance(memory_bank, tuple):
+            return tuple(index(x) for x in memory_bank)
+        return index(memory_bank)
 
-            return results
+    def _sem_select_indices(self, select_indices, beam_size):
+        """
+        Reorder indices of the semantic rows, laid out (example, sample, beam), from the ones of the
+        source rows, laid out (example, beam): every sample of an example follows the beams of the source
+        """
+        if self.sem_k == 1:
+            return select_indices
+        select_indices = select_indices.view(-1, 1, beam_size)
+        samples = torch.arange(self.sem_k, device=select_indices.device).view(1, -1, 1)
+        prev_example = select_indices // beam_size
+        prev_beam = select_indices % beam_size
+        return ((prev_example * self.sem_k + samples) * beam_size + prev_beam).view(-1)
 
     def _run_encoder(self, batch, batch_size):
         src, src_lengths = batch["src_batch"], batch["src_len"]
@@ -521,22 +775,36 @@ class DiffTranslator(object):
 
     def _decode_and_generate(self, decoder_input, memory_bank, memory_lengths, step=None, sem_lengths=None, sem_sc=None,
                              sem_bank=None):
+        """
+        Decode a step, or a whole target, and mix the distribution of the semantic samples when `sem_sc` is given.
+        Without `sem_bank` the semantic samples are fused: the decoder state and `memory_bank` hold their rows
+        after the source rows (see `_fuse_memory`), both streams go through one decoder and one generator call.
+        """
 
         # Decoder forward, takes [tgt_len, batch, nfeats] as input
         # and [src_len, batch, hidden] as memory_bank
         # in case of inference tgt_len = 1, batch = beam times batch_size
         # in case of Gold Scoring tgt_len = actual length, batch = 1 batch
         self.model.decoder.test = 1
-        if self.opt.sem_path is not None:
+        if self.opt.sem_path is not None and self.sem_decoder is not None:
             self.sem_decoder.test = 1
+        rows = decoder_input.size(1)
+        fuse_sem = sem_sc is not None and sem_bank is None
+        if sem_sc is not None:
+            if self.sem_k > 1:
+                # feed the same token to the decoders of all the samples of an example
+                beam_size = self.opt.beam_size
+                sem_input = decoder_input.view(-1, 1, beam_size).expand(-1, self.sem_k, beam_size).reshape(1, -1, 1)
+            else:
+                sem_input = decoder_input
         dec_out, dec_attn = self.model.decoder(
-            decoder_input,
+            torch.cat([decoder_input, sem_input], 1) if fuse_sem else decoder_input,
             memory_bank,
             memory_lengths=memory_lengths,
             step=step)
         if sem_bank is not None:
             sem_out, sem_attn = self.sem_decoder(
-                decoder_input, sem_bank,
+                sem_input, sem_bank,
                 memory_lengths=sem_lengths,
                 step=step
             )
@@ -545,7 +813,19 @@ class DiffTranslator(object):
         attn = dec_attn["std"]
         log_probs = self.model.generator(dec_out.squeeze(0))
         if sem_sc is not None:
-            sem_probs = self.lam_sem * sem_sc.float() * torch.exp(self.model.generator(sem_out.squeeze(0)))
+            if fuse_sem:
+                attn = attn[:, :rows]
+                sem_probs = torch.exp(log_probs[rows:])
+                log_probs = log_probs[:rows]
+            else:
+                sem_probs = torch.exp(self.model.generator(sem_out.squeeze(0)))
+            vocab_size = sem_probs.size(-1)
+            # the scores have a row per (example, sample), or per (example, sample, beam) with a tiled memory
+            sem_probs = self.lam_sem * sem_sc.float().view(-1, 1, 1) * sem_probs.view(sem_sc.size(0), -1, vocab_size)
+            if self.sem_k > 1:
+                # average the weighted distributions of the samples of every (example, beam) row
+                sem_probs = sem_probs.view(-1, self.sem_k, self.opt.beam_size, vocab_size).mean(1)
+            sem_probs = sem_probs.view(-1, vocab_size)
             log_probs = torch.log(torch.tensor(torch.exp(log_probs)) + sem_probs)
         # returns [(batch_size x beam_size) , vocab ] when 1 step
         # or [ tgt_len, batch_size, vocab ] when full sentence
@@ -1,7 +1,10 @@
+import math
+from multiprocessing import Pool
+
 import numpy as np
+import torch
 from bert_score import BERTScorer
 from nltk.translate.meteor_score import single_meteor_score
-from torchtext.data import bleu_score
 
 from evaluation.rouge.rouge import Rouge
 
@@ -11,6 +14,11 @@ def _g_mean(x):
     return np.exp(a.mean())
 
 
+def _g_mean_rows(x):
+    a = np.log(x)
+    return np.exp(a.mean(1))
+
+
 def get_bleu(translations, references):
     """
     Compute the bleu score
@@ -18,6 +26,9 @@ def get_bleu(translations, references):
     :param references: list of targets sentences splitted
     :return: mean, array of 4 ngrams
     """
+    # torchtext is only imported when needed, it is slow to import
+    from torchtext.data import bleu_score
+
     references = [[r] for r in references]
     bleu1 = bleu_score(translations, references, max_n=1, weights=[0.25])
     bleu2 = bleu_score(translations, references, max_n=2, weights=[0.25, 0.25])
@@ -29,6 +40,85 @@ def get_bleu(translations, references):
     g_mean = _g_mean([bleu1, bleu2, bleu3, bleu4]) * brevity_penalty
     return g_mean, [bleu1, bleu2, bleu3, bleu4]
 
+def _ngram_counts(ids, n, base):
+    """
+    Distinct n-grams of a sentence and their counts
+    :param ids: (`np.ndarray`) integer ids of the tokens, all lower than `base`
+    :return: (`np.ndarray`, `np.ndarray`) ids of the distinct n-grams, counts
+    """
+    if len(ids) < n:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if base ** n < 2 ** 63:
+        # an n-gram is a number in base `base`, its n tokens being the digits
+        ngrams = ids[:len(ids) - n + 1].copy()
+        for i in range(1, n):
+            ngrams = ngrams * base + ids[i:len(ids) - n + 1 + i]
+        return np.unique(ngrams, return_counts=True)
+    ngrams, counts = np.unique(np.stack([ids[i:len(ids) - n + 1 + i] for i in range(n)], 1), axis=0, return_counts=True)
+    return ngrams.view([('', ngrams.dtype)] * n).ravel(), counts
+
+
+def _clipped_counts(pair, max_n=4):
+    """
+    Number of n-grams of the translation also in the reference, clipped to their count in the reference,
+    for every order from 1 to max_n
+    :param pair: (list, list) translation and reference tokens
+    :return: (`np.ndarray`) clipped counts `[max_n]`
+    """
+    translation, reference = pair
+    token_ids = {}
+    translation = np.array([token_ids.setdefault(t, len(token_ids)) for t in translation], dtype=np.int64)
+    reference = np.array([token_ids.setdefault(t, len(token_ids)) for t in reference], dtype=np.int64)
+    clipped = np.zeros(max_n, dtype=np.int64)
+    for n in range(1, max_n + 1):
+        translation_ngrams, translation_counts = _ngram_counts(translation, n, len(token_ids))
+        reference_ngrams, reference_counts = _ngram_counts(reference, n, len(token_ids))
+        _, t, r = np.intersect1d(translation_ngrams, reference_ngrams, assume_unique=True, return_indices=True)
+        clipped[n - 1] = np.minimum(translation_counts[t], reference_counts[r]).sum()
+    return clipped
+
+
+def batch_sentence_bleu(translations, references, workers=1, chunk_size=256):
+    """
+    Sentence bleu of every translation against its own reference, equal to
+    `get_bleu([translation], [reference])[0]` but counting the n-grams of a pair a single time
+    for all the orders, in a pool of `workers` processes.
+    The scores are combined with the float32 operations of torchtext `bleu_score`, on all the pairs at once.
+    :param translations: list of hypothesis sentences splitted
+    :param references: list of targets sentences splitted, one per hypothesis
+    :return: (`np.ndarray`) bleu of every pair
+    """
+    max_n = 4
+    pairs = list(zip(translations, references))
+    if len(pairs) == 0:
+        return np.zeros(0)
+    if workers > 1:
+        with Pool(workers) as pool:
+            clipped = pool.map(_clipped_counts, pairs, chunksize=chunk_size)
+    else:
+        clipped = [_clipped_counts(pair) for pair in pairs]
+    clipped = np.stack(clipped)
+    translation_len = np.array([len(t) for t in translations])
+    totals = np.maximum(translation_len[:, None] - np.arange(max_n)[None, :], 0)
+
+    # bleu_score returns 0 as soon as one order has no match, and so does the geometric mean
+    valid = (clipped > 0).all(1)
+    log_pn = torch.tensor([0.25] * max_n) * torch.log(torch.tensor(clipped[valid], dtype=torch.float32)
+                                                     / torch.tensor(totals[valid], dtype=torch.float32))
+    # sum the weighted orders one after the other, as bleu_score does for each max_n
+    cumulated = [log_pn[:, 0]]
+    for n in range(1, max_n):
+        cumulated.append(cumulated[-1] + log_pn[:, n])
+    ngram_scores = torch.exp(torch.stack(cumulated, 1)).double().numpy()
+    brevity = np.array([math.exp(min(1 - len(r) / len(t), 0))
+                        for t, r, ok in zip(translations, references, valid) if ok])
+    # the brevity penalty of get_bleu compares the number of references (1) to the translation length,
+    # it is 1 for every pair with a match
+    bleu = np.zeros(len(pairs))
+    bleu[valid] = _g_mean_rows(brevity[:, None] * ngram_scores)
+    return bleu
+
+
 def evaluate_translations(translations, references, metrics = None):
     """
     Evaluate translations
@@ -148,6 +148,12 @@ class RNNDecoderBase(nn.Module):
                                          self.state["hidden"]))
         self.state["input_feed"] = fn(self.state["input_feed"], 1)
 
+    def concat_state(self, state):
+        """ Append the rows of another decoder state along the batch """
+        self.state["hidden"] = tuple(torch.cat([hidden, other], 1)
+                                     for hidden, other in zip(self.state["hidden"], state["hidden"]))
+        self.state["input_feed"] = torch.cat([self.state["input_feed"], state["input_feed"]], 1)
+
     def detach_state(self):
         """ Need to document this """
         self.state["hidden"] = tuple([_.detach() for _ in self.state["hidden"]])
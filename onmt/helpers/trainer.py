@@ -10,6 +10,7 @@
 """
 import math
 import random
+import time
 
 import pandas as pd
 import torch
@@ -156,7 +157,10 @@ class Trainer(object):
         while step <= train_steps:
 
             reduce_counter = 0
+            # time waiting for the batches, the share of the input pipeline in the step time
+            input_start = time.time()
             for i, batch in enumerate(train_iter):
+                report_stats.input_time += time.time() - input_start
                 logger.info(f"Batch: {i} accum: {accum}") if self.gpu_verbose_level > 1 else None
                 true_batchs.append(batch)
 
@@ -186,6 +190,7 @@ class Trainer(object):
                     step += 1
                     if step > train_steps:
                         break
+                input_start = time.time()
             logger.info(f'Epoch completed at step {step}') if self.gpu_verbose_level > 0 else None
             train_iter = train_iter_fct()
 
@@ -395,7 +400,9 @@ class TransformerTrainer(Trainer):
         while step <= train_steps:
 
             # there should be only one loop
+            input_start = time.time()
             for i, batch in enumerate(train_iter):
+                report_stats.input_time += time.time() - input_start
                 logger.info(f"Batch: {i} accum: {accum}") if self.gpu_verbose_level > 1 else None
 
                 true_batchs.append(batch)
@@ -442,6 +449,7 @@ class TransformerTrainer(Trainer):
                     step += 1
                     if step > train_steps:
                         break
+                input_start = time.time()
             if self.gpu_verbose_level > 0:
                 logger.info('GpuRank : we completed an epoch \
                             at step %d' % step)
@@ -1,10 +1,10 @@
-﻿import torch, os, codecs
+﻿import torch, os, codecs, glob, random
+import numpy as np
 from torch.utils.data import DataLoader, Sampler
-from torchtext.data.utils import RandomShuffler
 from onmt.inputters.vocabulary import BOS_WORD, EOS_WORD, PAD_WORD
-from onmt.inputters.text_dataset import SemTextDataset
+from onmt.inputters.numeric_dataset import NumericDataset
 from onmt.utils.logging import logger
-from onmt.inputters.vocabulary import get_indices
+from onmt.inputters.vocabulary import as_vocab, get_indices
 
 def load_vocab(vocab_file, checkpoint=None):
     if checkpoint is not None:
@@ -12,12 +12,19 @@ def load_vocab(vocab_file, checkpoint=None):
         vocab = checkpoint['vocab']
     else:
         vocab = torch.load(vocab_file)
-    return vocab
+    # torchtext vocabularies of older files are converted
+    return {side: as_vocab(vocabulary) for side, vocabulary in vocab.items()}
+
+# datasets already loaded by this process, by path and modification time of the file loaded
+_loaded_datasets = {}
+
 
 def load_dataset(corpus_type, opt):
     """
     Dataset generator. Don't do extra stuff here, like printing,
     because they will be postponed to the first loading time.
+    A corpus is loaded once per process, the following calls return the same dataset
+    until its files are rewritten. A corpus written in a single shard is loaded as a whole.
 
     Args:
         corpus_type: 'train' or 'valid'
@@ -26,117 +33,247 @@ def load_dataset(corpus_type, opt):
     """
     assert corpus_type in ["train", "valid", "test"]
 
-    pt = opt.data + '.' + corpus_type + '.pt'
-    dataset = torch.load(pt)
-    logger.info('Loading %s dataset from %s, number of examples: %d' % (corpus_type, pt, len(dataset)))
-    return dataset
+    # numeric corpora written by preprocess.py, pickled datasets of older runs otherwise
+    shards = shard_paths(corpus_type, opt)
+    if len(shards) == 1:
+        path = shards[0]
+    elif os.path.isdir(opt.data + '.' + corpus_type + '.bin'):
+        path = opt.data + '.' + corpus_type + '.bin'
+    else:
+        path = opt.data + '.' + corpus_type + '.pt'
+    if os.path.isdir(path):
+        load, key = NumericDataset, (path, os.path.getmtime(os.path.join(path, "meta.pt")))
+    else:
+        load, key = torch.load, (path, os.path.getmtime(path))
+
+    if key not in _loaded_datasets:
+        # forget the previous version of the corpus
+        for previous in [k for k in _loaded_datasets if k[0] == path]:
+            del _loaded_datasets[previous]
+        _loaded_datasets[key] = load(path)
+        logger.info('Loading %s dataset from %s, number of examples: %d' % (corpus_type, path, len(_loaded_datasets[key])))
+    return _loaded_datasets[key]
+
+
+def shard_paths(corpus_type, opt):
+    """
+    Shards of a corpus written by preprocess.py with -shard_size, `<data>.<type>.N.bin` directories
+    (or `<data>.<type>.N.pt` files of older runs)
+
+    Returns:
+        The paths in shard order, empty if the corpus is not sharded.
+    """
+    prefix = opt.data + '.' + corpus_type + '.'
+    for ext in ['.bin', '.pt']:
+        paths = glob.glob(prefix + '[0-9]*' + ext)
+        if paths:
+            return sorted(paths, key=lambda p: int(p[len(prefix):-len(ext)]))
+    return []
+
+
+class ShardedIterator(object):
+    """
+    Batches of a sharded corpus, streamed one shard at a time so that a single shard is in memory.
+    Every pass visits the shards in a new random order, and the batches of a shard are shuffled.
+    Shards are not kept in the load cache, a shard is released when its batches are consumed:
+    a corpus of a single shard is better loaded with `load_dataset`.
+    :param paths: (list) shards of the corpus, see `shard_paths`
+    :param build_iter: (function) builds the batch iterator of a shard dataset
+    """
+
+    def __init__(self, paths, build_iter):
+        self.paths = paths
+        self.build_iter = build_iter
+
+    def __iter__(self):
+        for path in random.sample(self.paths, len(self.paths)):
+            dataset = NumericDataset(path) if os.path.isdir(path) else torch.load(path)
+            logger.info('Loading shard %s, number of examples: %d' % (path, len(dataset)))
+            for batch in self.build_iter(dataset):
+                yield batch
+            del dataset
+
+
+def dataset_lengths(dataset):
+    """
+    Source and target lengths of the examples of a dataset, from its `lengths` array, or read from every
+    example for datasets pickled by older versions
+    :return: (`np.ndarray`) `[n x 2]`
+    """
+    lengths = getattr(dataset, "lengths", None)
+    if lengths is None:
+        # the target length follows the source length in the examples
+        lengths = [(s[dataset.sort_index], s[dataset.sort_index + 1]) for s in dataset]
+    return np.asarray(lengths).reshape(-1, 2)
 
 
 class MinPaddingSampler(Sampler):
+    """
+    Batch sampler grouping examples of close lengths, from the length array of the dataset.
+    With `sort_globally` the whole dataset is sorted by decreasing source length and cut into batches, in that order.
+    With `shuffle_batches` the shuffled dataset is split into buckets of about `bucket_batches` batches, every bucket
+    is sorted by decreasing source length and cut into batches, and the batches are shuffled, so that batches change
+    every epoch while keeping close lengths.
+    Otherwise consecutive windows of `batch_size` examples are sorted, so that batches follow the order of the dataset.
+    Sorts are stable, and the examples of a batch are always in decreasing source length.
+    With `batch_type` "tokens", `batch_size` caps the padded source tokens and the padded target tokens of a batch
+    rather than its number of examples. Windows have a fixed number of examples, so it needs `sort_globally` or
+    `shuffle_batches`.
+    """
 
-    def __init__(self, data_source, batch_size, shuffle_batches):
+    def __init__(self, data_source, batch_size, shuffle_batches, sort_globally=False, batch_type="sents",
+                 bucket_batches=100):
 
         super().__init__(data_source)
+        if batch_type == "tokens" and not (sort_globally or shuffle_batches):
+            raise ValueError('batch_type "tokens" needs the batches to be sorted globally or shuffled')
         self.dataset = data_source
         self.batch_size = batch_size
         self.shuffle_batches = shuffle_batches
+        self.sort_globally = sort_globally
+        self.batch_type = batch_type
+        self.lengths = dataset_lengths(data_source)
+        if batch_type == "sents":
+            examples_per_batch = batch_size
+        else:
+            # padded source tokens of a batch of average examples
+            examples_per_batch = max(1, batch_size // (int(self.lengths[:, 0].mean()) + 1 if len(self.lengths) else 1))
+        self.bucket_size = bucket_batches * examples_per_batch
+
+    def _batches(self, order):
+        """Cut indices sorted by decreasing source length into batches of indices"""
+        if self.batch_type == "sents":
+            return [order[i:i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+        batches, start = [], 0
+        max_src_len, max_tgt_len = 0, 0
+        # padded lengths of the tensors, with EOS on the source and BOS, EOS on the target
+        src_lengths = (self.lengths[order, 0] + 1).tolist()
+        tgt_lengths = (self.lengths[order, 1] + 2).tolist()
+        for i, (src_len, tgt_len) in enumerate(zip(src_lengths, tgt_lengths)):
+            if i > start and max(max_src_len, src_len, max_tgt_len, tgt_len) * (i - start + 1) > self.batch_size:
+                batches.append(order[start:i].tolist())
+                start = i
+                max_src_len, max_tgt_len = 0, 0
+            max_src_len = max(max_src_len, src_len)
+            max_tgt_len = max(max_tgt_len, tgt_len)
+        if start < len(order):
+            batches.append(order[start:].tolist())
+        return batches
 
     def __iter__(self):
-        indices = [(i, s[self.dataset.sort_index]) for i, s in enumerate(self.dataset)]
-        # sort dataset indices by decreasing length, so that
-        # batches contain texts with close lengths, and low padding
-        if self.shuffle_batches:
-            sorted_indices = sorted(indices, key=lambda x: x[1], reverse=True)
-            # select only the actual indexes, not lengths
-            sorted_indices = [x[0] for x in sorted_indices]
-            for i in RandomShuffler()(range(0, len(indices), self.batch_size)):
-                yield sorted_indices[i:i + self.batch_size]
+        n = len(self.lengths)
+        src_lengths = self.lengths[:, 0]
+        if self.sort_globally:
+            batches = self._batches(np.argsort(-src_lengths, kind="stable"))
+        elif self.shuffle_batches:
+            # seeded from the random module, like the rest of the training
+            rng = np.random.RandomState(random.getrandbits(32))
+            permutation = rng.permutation(n)
+            # the last key of lexsort is the primary one: buckets, then decreasing source length
+            buckets = np.arange(n) // self.bucket_size
+            order = permutation[np.lexsort((-src_lengths[permutation], buckets))]
+            batches = []
+            for start in range(0, n, self.bucket_size):
+                batches.extend(self._batches(order[start:start + self.bucket_size]))
+            batches = [batches[i] for i in rng.permutation(len(batches))]
         else:
-            for i in range(0, len(indices), self.batch_size):
-                sorted_indices = sorted(indices[i:i + self.batch_size], key=lambda x: x[1], reverse=True)
-                yield [x[0] for x in sorted_indices]
+            windows = np.arange(n) // self.batch_size
+            order = np.lexsort((-src_lengths, windows))
+            batches = [order[i:i + self.batch_size].tolist() for i in range(0, n, self.batch_size)]
+        for batch in batches:
+            yield batch
 
     def __len__(self):
         # each time batch size elements are sampled
         return self.batch_size
 
 
-def build_dataset_iter(dataset, vocabs, batch_size, gpu=False, shuffle_batches=True):
-    device = torch.device("cuda" if gpu else "cpu")
-    def generate_batch(data_batch):
-        _, _, _, src_len, tgt_len = zip(*data_batch)
-        # for padding
-        max_src_len = max(src_len)
-        max_tgt_len = max(tgt_len)
-        src_batch, tgt_batch, indexes = [], [], []
-        for (src_item, tgt_item, index, src_item_len, tgt_item_len) in data_batch:
-
-            indexes.append(index)
-            # encode source
-            src_tensor = torch.tensor(get_indices(vocabs["src"], src_item+[EOS_WORD]))
-            if src_item_len != max_src_len:
-                # creates an array of "blank" tokens inside an array (we need padding[0] to get the actual padding)
-                padding = torch.full((1, max_src_len - src_item_len), vocabs["src"][PAD_WORD], dtype=torch.int)
-                src_tensor = torch.cat((src_tensor, padding[0]))
-
-            # encode target
-            if tgt_item is None:
-                tgt_tensor = torch.tensor([])
-            else:
-                tgt_tensor = torch.tensor(get_indices(vocabs["tgt"], [BOS_WORD]+tgt_item+[EOS_WORD]))
-                if tgt_item_len != max_tgt_len:
-                    # creates an array of "blank" tokens inside an array (we need padding[0] to get the actual padding)
-                    padding = torch.full((1, max_tgt_len - tgt_item_len), vocabs["tgt"][PAD_WORD], dtype=torch.int)[0]
-                    tgt_tensor = torch.cat((tgt_tensor, padding))
-            src_batch.append(src_tensor)
-            tgt_batch.append(tgt_tensor)
-        src_batch = torch.cat([tensor.unsqueeze(1) for tensor in src_batch], 1).unsqueeze(2)
-        tgt_batch = torch.cat([tensor.unsqueeze(1) for tensor in tgt_batch], 1).unsqueeze(2)
-        return {"src_batch": src_batch.to(device), "src_len": torch.tensor(src_len).to(device), "tgt_batch": tgt_batch.to(device),
-                "tgt_len": torch.tensor(tgt_len).to(device), "indexes": torch.tensor(indexes).to(device)}
-
-    def generate_batch_sem_dataset(data_batch):
-        _, _, _, _, src_len, tgt_len, sem_len = zip(*data_batch)
-        # for padding
-        max_src_len = max(src_len)
-        max_tgt_len = max(tgt_len)
-        max_sem_len = max(sem_len)
-        src_batch, tgt_batch, sem_batch, indexes = [], [], [], []
-        for (src_item, tgt_item, sem_item, index, src_item_len, tgt_item_len, sem_item_len) in data_batch:
-
-            indexes.append(index)
-            # encode source
-            src_tensor = torch.tensor(get_indices(vocabs["src"], src_item+[EOS_WORD]))
-            if src_item_len != max_src_len:
-                # creates an array of "blank" tokens inside an array (we need padding[0] to get the actual padding)
-                padding = torch.full((1, max_src_len - src_item_len), vocabs["src"][PAD_WORD], dtype=torch.int)[0]
-                src_tensor = torch.cat((src_tensor, padding))
-            if tgt_item is None:
-                tgt_tensor = torch.tensor([])
-            else:
-                tgt_tensor = torch.tensor(get_indices(vocabs["tgt"], [BOS_WORD]+tgt_item+[EOS_WORD]))
-                if tgt_item_len != max_tgt_len:
-                    # creates an array of "blank" tokens inside an array (we need padding[0] to get the actual padding)
-                    padding = torch.full((1, max_tgt_len - tgt_item_len), vocabs["tgt"][PAD_WORD], dtype=torch.int)[0]
-                    tgt_tensor = torch.cat((tgt_tensor, padding))
-            if sem_item is None:
-                sem_tensor = torch.tensor([])
-            else:
-                sem_tensor = torch.tensor(get_indices(vocabs["src"], sem_item+[EOS_WORD]))
-                if sem_item_len != max_sem_len:
-                    # creates an array of "blank" tokens inside an array (we need padding[0] to get the actual padding)
-                    padding = torch.full((1, max_sem_len - sem_item_len), vocabs["src"][PAD_WORD], dtype=torch.int)[0]
-                    sem_tensor = torch.cat((sem_tensor, padding))
-            src_batch.append(src_tensor)
-            tgt_batch.append(tgt_tensor)
-            sem_batch.append(sem_tensor)
-        src_batch = torch.cat([tensor.unsqueeze(1) for tensor in src_batch], 1).unsqueeze(2)
-        tgt_batch = torch.cat([tensor.unsqueeze(1) for tensor in tgt_batch], 1).unsqueeze(2)
-        sem_batch = torch.cat([tensor.unsqueeze(1) for tensor in sem_batch], 1).unsqueeze(2)
-        return {"src_batch": src_batch.to(device), "src_len": torch.tensor(src_len).to(device), "tgt_batch": tgt_batch.to(device), "tgt_len": torch.tensor(tgt_len).to(device),
-                "sem_batch": sem_batch.to(device), "sem_len": torch.tensor(sem_len).to(device), "indexes": torch.tensor(indexes)}
-
-    sampler = MinPaddingSampler(dataset, batch_size, shuffle_batches)
-    return DataLoader(dataset, batch_sampler=sampler, collate_fn=generate_batch_sem_dataset if type(dataset) is SemTextDataset else generate_batch)
+class Collator(object):
+    """
+    Collate function of `build_dataset_iter`, for examples of `TextDataset`, `SemTextDataset` and `NumericDataset`.
+    The ids of every field are written straight into one padded `[max_len x batch]` tensor, with EOS at the end of
+    the sources and semantic samples, and BOS, EOS around the targets. The k semantic samples of an example are
+    consecutive columns of the semantic batch.
+    Batches stay on CPU, `DeviceLoader` moves them to the device in the training process.
+    It is a module level class so that DataLoader workers can pickle it.
+    :param vocabs: (dict) source and target vocabularies
+    """
+
+    def __init__(self, vocabs):
+        self.vocabs = vocabs
+        self.src_pad, self.src_eos = vocabs["src"][PAD_WORD], vocabs["src"][EOS_WORD]
+        self.tgt_pad, self.tgt_bos, self.tgt_eos = vocabs["tgt"][PAD_WORD], vocabs["tgt"][BOS_WORD], vocabs["tgt"][EOS_WORD]
+
+    def _pad(self, examples, vocab, pad, bos=None, eos=None):
+        """
+        :param examples: lists of tokens or arrays of token ids, None when the field is missing
+        :return: (`LongTensor`) `[max_len x batch x 1]`
+        """
+        if examples[0] is None:
+            return torch.zeros(0, len(examples), 1)
+        examples = [ids if isinstance(ids, np.ndarray) else get_indices(vocab, ids) for ids in examples]
+        start = 1 if bos is not None else 0
+        max_len = max(len(ids) for ids in examples) + start + 1
+        padded = torch.full((max_len, len(examples)), pad, dtype=torch.long)
+        buffer = padded.numpy()
+        if bos is not None:
+            buffer[0] = bos
+        for b, ids in enumerate(examples):
+            buffer[start:start + len(ids), b] = ids
+            buffer[start + len(ids), b] = eos
+        return padded.unsqueeze(2)
+
+    def __call__(self, data_batch):
+        if len(data_batch[0]) == 7:
+            src, tgt, sem, indexes, src_len, tgt_len, sem_len = zip(*data_batch)
+        else:
+            src, tgt, indexes, src_len, tgt_len = zip(*data_batch)
+            sem = None
+        batch = {"src_batch": self._pad(src, self.vocabs["src"], self.src_pad, eos=self.src_eos),
+                 "src_len": torch.tensor(src_len),
+                 "tgt_batch": self._pad(tgt, self.vocabs["tgt"], self.tgt_pad, bos=self.tgt_bos, eos=self.tgt_eos),
+                 "tgt_len": torch.tensor(tgt_len),
+                 "indexes": torch.tensor(indexes)}
+        if sem is not None:
+            samples = [sample for samples in sem for sample in samples] if sem[0] is not None else [None] * len(sem)
+            batch["sem_batch"] = self._pad(samples, self.vocabs["src"], self.src_pad, eos=self.src_eos)
+            batch["sem_len"] = torch.tensor([l for lengths in sem_len for l in lengths])
+        return batch
+
+
+class DeviceLoader(object):
+    """
+    Moves the CPU batches of a DataLoader to the device. With pinned batches the copies to the GPU are
+    asynchronous, the training process does not wait for them before queueing the step.
+    :param loader: (`DataLoader`) batches of `Collator`
+    :param device: (`torch.device`) where the batches are moved
+    :param non_blocking: (bool) asynchronous copies, for batches in page-locked memory
+    """
 
+    def __init__(self, loader, device, non_blocking=False):
+        self.loader = loader
+        self.device = device
+        self.non_blocking = non_blocking
 
+    def __iter__(self):
+        for batch in self.loader:
+            if self.device.type != "cpu":
+                batch = {name: tensor.to(self.device, non_blocking=self.non_blocking) for name, tensor in batch.items()}
+            yield batch
+
+
+def build_dataset_iter(dataset, vocabs, batch_size, gpu=False, shuffle_batches=True, sort_globally=False, batch_type="sents",
+                       num_workers=0, pin_memory=False, prefetch_factor=2):
+    """
+    Batches of a dataset, see `MinPaddingSampler` for their composition
+    :param num_workers: (int) processes collating the batches in the background, 0 to collate in the calling process
+    :param pin_memory: (bool) allocate the batches in page-locked memory, for asynchronous copies to the GPU
+    :param prefetch_factor: (int) batches collated in advance by every worker
+    :return: (`DeviceLoader`) iterable of the batches on the device
+    """
+    pin_memory = pin_memory and gpu and torch.cuda.is_available()
+    sampler = MinPaddingSampler(dataset, batch_size, shuffle_batches, sort_globally, batch_type)
+    # the prefetch queue of the workers is bounded to num_workers x prefetch_factor batches
+    workers = {"num_workers": num_workers, "prefetch_factor": prefetch_factor} if num_workers > 0 else {}
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=Collator(vocabs), pin_memory=pin_memory, **workers)
+    return DeviceLoader(loader, torch.device("cuda" if gpu else "cpu"), non_blocking=pin_memory)
@@ -0,0 +1,129 @@
+""" Pre-numericalized datasets, stored as flat arrays of token ids and memory-mapped when loaded """
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from onmt.inputters.text_dataset import SemTextDataset, TokenSequences
+from onmt.inputters.vocabulary import as_vocab
+
+VERSION = 1
+
+
+def numericalize(examples, vocabulary):
+    """
+    :return: (`np.ndarray`, `np.ndarray`) int32 token ids of all the examples, int64 position of the first id
+        of every example, with one more offset than examples
+    """
+    if isinstance(examples, TokenSequences):
+        return examples.encode(vocabulary)
+    return as_vocab(vocabulary).encode_many(examples)
+
+
+def write_numeric_arrays(path, fields, lengths, sem_k=0):
+    """
+    Save the arrays of a numeric dataset
+    :param path: (str) directory, created if needed
+    :param fields: list of (name, int32 ids, int64 offsets) of the "src", "tgt" and "sem" fields
+    :param lengths: (`np.ndarray`) int32 source and target lengths of the examples `[n x 2]`
+    :param sem_k: (int) number of semantic samples per example
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, ids, offsets in fields:
+        np.save(os.path.join(path, name + ".ids.npy"), ids)
+        np.save(os.path.join(path, name + ".offsets.npy"), offsets)
+    np.save(os.path.join(path, "lengths.npy"), lengths)
+    torch.save({"version": VERSION, "examples": len(lengths), "fields": [name for name, _, _ in fields], "sem_k": sem_k},
+               os.path.join(path, "meta.pt"))
+
+
+def write_numeric_shards(prefix, fields, lengths, shard_size=0, sem_k=0):
+    """
+    Save the arrays of a numeric dataset in `<prefix>.N.bin` directories of `shard_size` examples,
+    or in a single `<prefix>.bin` directory when `shard_size` is not positive
+    :param fields: list of (name, int32 ids, int64 offsets) of the "src", "tgt" and "sem" fields
+    :param lengths: (`np.ndarray`) int32 source and target lengths of the examples `[n x 2]`
+    :return: list of the directories written
+    """
+    if shard_size <= 0:
+        write_numeric_arrays(prefix + ".bin", fields, lengths, sem_k)
+        return [prefix + ".bin"]
+    paths = []
+    for shard, start in enumerate(range(0, max(len(lengths), 1), shard_size)):
+        end = min(start + shard_size, len(lengths))
+        shard_fields = []
+        for name, ids, offsets in fields:
+            # semantic samples have sem_k entries per example
+            per_example = sem_k if name == "sem" else 1
+            first, last = start * per_example, end * per_example
+            shard_fields.append((name, ids[offsets[first]:offsets[last]], offsets[first:last + 1] - offsets[first]))
+        paths.append("%s.%d.bin" % (prefix, shard))
+        write_numeric_arrays(paths[-1], shard_fields, lengths[start:end], sem_k)
+    return paths
+
+
+def write_numeric_dataset(prefix, dataset, vocabs, shard_size=0):
+    """
+    Save a text dataset as directories of numpy arrays, see `write_numeric_shards`: the source, target and semantic
+    token ids (`<field>.ids.npy`), the position of the first id of every example (`<field>.offsets.npy`) and
+    the source and target lengths of the examples (`lengths.npy`, int32 `[n x 2]`).
+    Ids do not include the BOS and EOS tokens, which are added when batching.
+    :param prefix: (str) path prefix of the directories
+    :param dataset: (`TextDataset`) tokenized examples
+    :param vocabs: (dict) source and target vocabularies
+    :param shard_size: (int) number of examples per shard, a single directory if not positive
+    :return: list of the directories written
+    """
+    fields = [("src",) + numericalize(dataset.src_texts, vocabs["src"])]
+    has_tgt = dataset.target_path is not None
+    if has_tgt:
+        fields.append(("tgt",) + numericalize(dataset.target_texts, vocabs["tgt"]))
+    sem_k = 0
+    if type(dataset) is SemTextDataset and dataset.sem_path is not None:
+        # the k samples of an example are consecutive entries of the field
+        sem_k = len(dataset.sem_path)
+        fields.append(("sem",) + numericalize(dataset.sem_texts.samples, vocabs["src"]))
+
+    return write_numeric_shards(prefix, fields, dataset.lengths, shard_size, sem_k)
+
+
+class NumericDataset(Dataset):
+    """
+    Dataset of the token ids saved by `write_numeric_dataset`, or of one of its shards.
+    The arrays are memory-mapped, an example is read from disk only when it is accessed.
+    Examples are tuples like the ones of `TextDataset` (or `SemTextDataset` when the semantic samples are saved),
+    with arrays of token ids in place of the lists of tokens.
+    :param path: (str) directory of the dataset
+    """
+
+    def __init__(self, path):
+        super(NumericDataset, self).__init__()
+        self.path = path
+        self.meta = torch.load(os.path.join(path, "meta.pt"))
+        self.fields = {}
+        for name in self.meta["fields"]:
+            self.fields[name] = (np.load(os.path.join(path, name + ".ids.npy"), mmap_mode='r'),
+                                 np.load(os.path.join(path, name + ".offsets.npy"), mmap_mode='r'))
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode='r')
+        self.has_tgt = "tgt" in self.fields
+        self.has_sem = "sem" in self.fields
+        self.sem_k = self.meta["sem_k"]
+        self.sort_index = 4 if self.has_sem else 3
+
+    def _ids(self, name, i):
+        ids, offsets = self.fields[name]
+        return ids[offsets[i]:offsets[i + 1]]
+
+    def __len__(self):
+        return self.meta["examples"]
+
+    def __getitem__(self, idx):
+        src_len, tgt_len = (int(l) for l in self.lengths[idx])
+        src = self._ids("src", idx)
+        tgt = self._ids("tgt", idx) if self.has_tgt else None
+        if not self.has_sem:
+            return src, tgt, idx, src_len, tgt_len
+        sem = [self._ids("sem", idx * self.sem_k + j) for j in range(self.sem_k)]
+        return src, tgt, sem, idx, src_len, tgt_len, [len(ids) for ids in sem]
@@ -0,0 +1,91 @@
+""" Preprocessing of a parallel corpus split into ranges of lines, read by a pool of processes """
+import math
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+from onmt.inputters.numeric_dataset import numericalize, write_numeric_shards
+from onmt.inputters.text_dataset import TextDataset
+from onmt.inputters.vocabulary import build_vocabs
+from onmt.utils.line_index import LineIndex
+from onmt.utils.logging import logger
+
+
+def aligned_ranges(src_path, tgt_path, chunks):
+    """
+    Split a source and a target file into the same ranges of lines
+    :param chunks: (int) number of ranges
+    :return: list of (source byte range, target byte range)
+    """
+    src_index, tgt_index = LineIndex(src_path), LineIndex(tgt_path)
+    assert len(src_index) == len(tgt_index), "%s and %s have a different number of lines" % (src_path, tgt_path)
+    lines_per_chunk = max(1, math.ceil(len(src_index) / chunks))
+    return list(zip(src_index.ranges(0, lines_per_chunk), tgt_index.ranges(0, lines_per_chunk)))
+
+
+def _read_range(path, byte_range, max_len):
+    # the same reading and truncation as the serial TextDataset
+    return TextDataset(path, src_max_len=max_len, byte_range=byte_range).src_texts
+
+
+def _count_range(task):
+    src_path, src_range, src_max_len, tgt_path, tgt_range, tgt_max_len = task
+    return (Counter(_read_range(src_path, src_range, src_max_len).counts()),
+            Counter(_read_range(tgt_path, tgt_range, tgt_max_len).counts()))
+
+
+# vocabularies of the pool workers, set once by `_init_worker`
+_worker = {}
+
+
+def _init_worker(vocabs):
+    _worker["vocabs"] = vocabs
+
+
+def _numericalize_range(task):
+    src_path, src_range, src_max_len, tgt_path, tgt_range, tgt_max_len = task
+    src_texts = _read_range(src_path, src_range, src_max_len)
+    tgt_texts = _read_range(tgt_path, tgt_range, tgt_max_len)
+    src_ids, _ = numericalize(src_texts, _worker["vocabs"]["src"])
+    tgt_ids, _ = numericalize(tgt_texts, _worker["vocabs"]["tgt"])
+    return (src_ids, src_texts.lengths().astype(np.int32), tgt_ids, tgt_texts.lengths().astype(np.int32))
+
+
+def _offsets(lengths):
+    return np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths, dtype=np.int64)])
+
+
+def _tasks(opt, src_path, tgt_path, workers):
+    # a few ranges per worker to balance their load
+    return [(src_path, src_range, opt.src_seq_length, tgt_path, tgt_range, opt.tgt_seq_length)
+            for src_range, tgt_range in aligned_ranges(src_path, tgt_path, 4 * workers)]
+
+
+def preprocess_parallel(opt, workers, corpora):
+    """
+    Build the vocabularies of the training corpus and save the numeric datasets of all the corpora.
+    Workers count the tokens of their ranges, the counts are merged in the order of the ranges so that
+    words keep the order of their first occurrence, then workers numericalize their ranges with the
+    vocabularies. The result is the same as the serial preprocessing.
+    :param opt: program dictionary of parameters
+    :param workers: (int) number of processes
+    :param corpora: list of (corpus type, source path, target path, output prefix, shard size), training corpus first
+    :return: source and target vocabularies
+    """
+    _, train_src, train_tgt, _, _ = corpora[0]
+    counter_src, counter_tgt = Counter(), Counter()
+    with Pool(workers) as pool:
+        for range_src, range_tgt in pool.imap(_count_range, _tasks(opt, train_src, train_tgt, workers)):
+            counter_src.update(range_src)
+            counter_tgt.update(range_tgt)
+    vocab_src, vocab_tgt = build_vocabs(opt, counter_src, counter_tgt)
+
+    with Pool(workers, initializer=_init_worker, initargs=({"src": vocab_src, "tgt": vocab_tgt},)) as pool:
+        for corpus_type, src_path, tgt_path, prefix, shard_size in corpora:
+            ranges = pool.map(_numericalize_range, _tasks(opt, src_path, tgt_path, workers))
+            src_ids, src_lengths, tgt_ids, tgt_lengths = (np.concatenate(arrays) for arrays in zip(*ranges))
+            paths = write_numeric_shards(prefix, [("src", src_ids, _offsets(src_lengths)), ("tgt", tgt_ids, _offsets(tgt_lengths))],
+                                         np.stack([src_lengths, tgt_lengths], 1), shard_size)
+            logger.info(" * saved %s dataset to %s." % (corpus_type, ", ".join(paths)))
+    return vocab_src, vocab_tgt
@@ -1,60 +1,228 @@
 import codecs
+import io
+from array import array
+
+import numpy as np
 from torch.utils.data import Dataset
 
 
+class TokenTable(object):
+    """
+    Distinct tokens of a dataset, each stored once and numbered in order of first occurrence.
+    Only the list of tokens is pickled.
+    """
+    __slots__ = ("stoi", "_itos")
+
+    def __init__(self, itos=()):
+        self.stoi = {token: i for i, token in enumerate(itos)}
+        self._itos = None
+
+    def __getstate__(self):
+        return self.itos
+
+    def __setstate__(self, itos):
+        self.__init__(itos)
+
+    def __len__(self):
+        return len(self.stoi)
+
+    @property
+    def itos(self):
+        # ids follow the insertion order of the dict, the list is rebuilt when tokens were added
+        if self._itos is None or len(self._itos) != len(self.stoi):
+            self._itos = list(self.stoi)
+        return self._itos
+
+    def intern(self, tokens):
+        """
+        :return: the ids of the tokens, new tokens are added to the table
+        """
+        stoi = self.stoi
+        setdefault = stoi.setdefault
+        return [setdefault(token, len(stoi)) for token in tokens]
+
+    def decode(self, ids):
+        itos = self.itos
+        return [itos[i] for i in ids]
+
+
+class TokenSequences(object):
+    """
+    Lists of tokens stored as ids of a `TokenTable`, in one flat array with the offset of every list.
+    Lists are decoded to tokens only when accessed, it behaves like a list of lists of tokens.
+    """
+    __slots__ = ("table", "ids", "offsets")
+
+    def __init__(self, table):
+        self.table = table
+        self.ids = array('i')
+        self.offsets = array('q', [0])
+
+    def append(self, tokens):
+        self.ids.extend(self.table.intern(tokens))
+        self.offsets.append(len(self.ids))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.table.decode(self.ids[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def lengths(self):
+        """
+        :return: (`np.ndarray`) int64 number of tokens of every list
+        """
+        return np.diff(np.array(self.offsets, dtype=np.int64))
+
+    def counts(self):
+        """
+        :return: (dict) number of occurrences of the tokens, in order of first occurrence
+        """
+        counts = np.bincount(np.array(self.ids, dtype=np.int64), minlength=len(self.table)).tolist()
+        # the table may be shared with other sequences, which have tokens of their own
+        return {token: count for token, count in zip(self.table.itos, counts) if count > 0}
+
+    def encode(self, vocabulary):
+        """
+        Map the ids of the table to the ids of a vocabulary, every distinct token is looked up once
+        :return: (`np.ndarray`, `np.ndarray`) int32 vocabulary ids of all the lists, int64 position of the first
+            id of every list, with one more offset than lists
+        """
+        mapping = np.array(vocabulary.lookup_indices(self.table.itos), dtype=np.int32).reshape(-1)
+        return mapping[np.array(self.ids, dtype=np.int64)], np.array(self.offsets, dtype=np.int64)
+
+
+class SemSamples(object):
+    """
+    The k semantic samples of every example, consecutive lists of `samples`
+    """
+    __slots__ = ("samples", "k")
+
+    def __init__(self, samples, k):
+        self.samples = samples
+        self.k = k
+
+    def __len__(self):
+        return len(self.samples) // self.k if self.k else 0
+
+    def __getitem__(self, idx):
+        return [self.samples[idx * self.k + j] for j in range(self.k)]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
 class TextDataset(Dataset):
     """
     Dataset class from data files. Wrap sources and targets.
+    With `byte_range` (start, end) only the source lines in that part of the file are read, the
+    indexes of the examples start from 0 anyway. Both ends must be at the start of a line.
+    Texts are kept as `TokenSequences`, the source and target tokens are interned in one table each.
+    `lengths` holds the source and target lengths of the examples, int32 `[n x 2]`, for the batch samplers.
     """
-    def __init__(self, src_path, target_path=None, src_max_len=None, target_max_len=None, transform=None, target_transform=None):
+    def __init__(self, src_path, target_path=None, src_max_len=None, target_max_len=None, transform=None, target_transform=None,
+                 byte_range=None):
         super(TextDataset, self).__init__()
         self.transform = transform
         self.target_transform = target_transform
-        self.indexes = []
         self.sort_index = 3
 
         self.src_path = src_path
         self.target_path = target_path
 
-        self.src_texts = []
-        self.target_texts = []
-        with codecs.open(src_path, "r", "utf-8") as cf:
-            for i, line in enumerate(cf):
+        self.src_texts = TokenSequences(TokenTable())
+        self.target_texts = TokenSequences(TokenTable())
+        if byte_range is not None:
+            assert target_path is None, "byte_range is only supported for sources"
+            with open(src_path, "rb") as f:
+                f.seek(byte_range[0])
+                # same line splitting as codecs.open
+                src_file = codecs.getreader("utf-8")(io.BytesIO(f.read(byte_range[1] - byte_range[0])))
+        else:
+            src_file = codecs.open(src_path, "r", "utf-8")
+        with src_file as cf:
+            for line in cf:
                 self.src_texts.append(line.strip().split()[:src_max_len])
-                self.indexes.append(i)
         if target_path is not None:
             with codecs.open(target_path, "r", "utf-8") as cf:
                 for line in cf:
                     self.target_texts.append(line.strip().split()[:target_max_len])
+        self.indexes = range(len(self.src_texts))
+        self.lengths = self._compute_lengths()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # datasets pickled by older versions keep their texts as lists of lists of tokens, without lengths
+        if "lengths" not in state:
+            self.lengths = self._compute_lengths()
+
+    def _compute_lengths(self):
+        def lengths(texts):
+            return texts.lengths() if isinstance(texts, TokenSequences) else [len(tokens) for tokens in texts]
+
+        computed = np.ones((len(self.src_texts), 2), dtype=np.int32)
+        if len(self.src_texts):
+            computed[:, 0] = lengths(self.src_texts)
+            if self.target_path is not None:
+                computed[:, 1] = lengths(self.target_texts)
+        return computed
 
     def __len__(self):
         return len(self.src_texts)
 
     def __getitem__(self, idx):
         return self.src_texts[idx], self.target_texts[idx] if self.target_path is not None else None, self.indexes[idx], \
-               len(self.src_texts[idx]), len(self.target_texts[idx]) if self.target_path is not None else 1
+               int(self.lengths[idx, 0]), int(self.lengths[idx, 1])
 
 class SemTextDataset(TextDataset):
     """
     Dataset class from data files. Wrap sources, targets and semantic matching samples.
+    `sem_path` is a file of matching samples, or a list of files holding the k best matching samples
+    of each source, best first. The semantic item of an example is the list of its k samples.
+    The samples are diffs like the sources, and share their table of tokens.
     """
     def __init__(self, src_path, target_path=None, sem_path=None, src_max_len=None, target_max_len=None, transform=None, target_transform=None):
         super(SemTextDataset, self).__init__(src_path, target_path, src_max_len, target_max_len, transform, target_transform)
         self.sort_index = 4
 
+        if isinstance(sem_path, str):
+            sem_path = [sem_path]
         self.sem_path = sem_path
-        self.sem_texts = []
+        samples = TokenSequences(self.src_texts.table)
         if sem_path is not None:
-            with codecs.open(sem_path, "r", "utf-8") as cf:
-                for i, line in enumerate(cf):
-                    self.sem_texts.append(line.strip().split())
+            sem_files = [codecs.open(path, "r", "utf-8") for path in sem_path]
+            try:
+                for lines in zip(*sem_files):
+                    for line in lines:
+                        samples.append(line.strip().split())
+            finally:
+                for cf in sem_files:
+                    cf.close()
+        self.sem_texts = SemSamples(samples, len(sem_path) if sem_path is not None else 0)
+
+    def __setstate__(self, state):
+        super(SemTextDataset, self).__setstate__(state)
+        # older versions kept a single file of samples, as a list of lists of tokens
+        if isinstance(self.sem_path, str):
+            self.sem_path = [self.sem_path]
+        if not isinstance(self.sem_texts, SemSamples):
+            self.sem_texts = SemSamples(self.sem_texts, len(self.sem_path) if self.sem_path is not None else 0)
 
     def __getitem__(self, idx):
+        if self.sem_path is not None:
+            sem = self.sem_texts[idx]
+            sem_len = [len(tokens) for tokens in sem]
+        else:
+            sem, sem_len = None, [1]
         return self.src_texts[idx],\
                self.target_texts[idx] if self.target_path is not None else None,\
-               self.sem_texts[idx] if self.sem_path is not None else None,\
+               sem,\
                self.indexes[idx], \
-               len(self.src_texts[idx]), \
-               len(self.target_texts[idx]) if self.target_path is not None else 1, \
-               len(self.sem_texts[idx]) if self.sem_path is not None else 1
-
+               int(self.lengths[idx, 0]), \
+               int(self.lengths[idx, 1]), \
+               sem_len
@@ -1,7 +1,9 @@
-from torchtext.vocab import vocab
-from collections import Counter, OrderedDict
+from array import array
+from collections import Counter
 
-from onmt.inputters.text_dataset import SemTextDataset
+import numpy as np
+
+from onmt.utils.logging import logger
 
 
 PAD_WORD = '<blank>'
@@ -9,38 +11,161 @@ UNK_WORD = '<unk>'
 BOS_WORD = '<s>'
 EOS_WORD = '</s>'
 
+
+class Vocab(object):
+    """
+    Vocabulary of tokens: a dict from tokens to ids, and an array from ids to tokens.
+    It has the methods of the torchtext vocabulary used by the project, so that both can be used
+    in the same places, see `as_vocab` to convert the vocabularies of older vocab.pt files.
+    Only the tokens and the default index are pickled.
+    :param itos: list of the tokens, by id
+    :param default_index: (int) id of the unknown tokens, unknown tokens raise an error if None
+    """
+
+    def __init__(self, itos, default_index=None):
+        self.itos = np.array(itos, dtype=object)
+        self.stoi = {token: i for i, token in enumerate(itos)}
+        if len(self.stoi) != len(itos):
+            raise RuntimeError("Duplicate tokens in the vocabulary")
+        self.default_index = default_index
+
+    def __getstate__(self):
+        return {"itos": self.itos.tolist(), "default_index": self.default_index}
+
+    def __setstate__(self, state):
+        self.__init__(state["itos"], state["default_index"])
+
+    def __len__(self):
+        return len(self.itos)
+
+    def __contains__(self, token):
+        return token in self.stoi
+
+    def __getitem__(self, token):
+        index = self.stoi.get(token, self.default_index)
+        if index is None:
+            raise RuntimeError("Token %s not found and default index is not set" % token)
+        return index
+
+    @property
+    def vocab(self):
+        # the lookup table of a torchtext vocabulary
+        return self
+
+    def insert_token(self, token, index):
+        itos = self.itos.tolist()
+        itos.insert(index, token)
+        self.__init__(itos, self.default_index)
+
+    def set_default_index(self, index):
+        self.default_index = index
+
+    def get_default_index(self):
+        return self.default_index
+
+    def get_itos(self):
+        return self.itos.tolist()
+
+    def get_stoi(self):
+        return dict(self.stoi)
+
+    def lookup_token(self, index):
+        return self.itos[index]
+
+    def lookup_tokens(self, indices):
+        return self.itos[np.asarray(indices, dtype=np.int64)].tolist()
+
+    def lookup_indices(self, tokens):
+        if self.default_index is None:
+            return [self[token] for token in tokens]
+        stoi, default_index = self.stoi, self.default_index
+        return [stoi.get(token, default_index) for token in tokens]
+
+    def encode_many(self, examples):
+        """
+        :param examples: iterable of lists of tokens
+        :return: (`np.ndarray`, `np.ndarray`) int32 ids of all the examples, int64 position of the first id
+            of every example, with one more offset than examples
+        """
+        ids = array('i')
+        offsets = array('q', [0])
+        for tokens in examples:
+            ids.extend(self.lookup_indices(tokens))
+            offsets.append(len(ids))
+        return np.frombuffer(ids, dtype=np.int32) if ids else np.zeros(0, np.int32), np.frombuffer(offsets, dtype=np.int64)
+
+    def decode_many(self, sequences):
+        """
+        :param sequences: lists or arrays of ids
+        :return: list of the lists of tokens of the sequences
+        """
+        sequences = [np.asarray(ids, dtype=np.int64).reshape(-1) for ids in sequences]
+        if not sequences:
+            return []
+        # a single lookup for all the sequences
+        tokens = self.itos[np.concatenate(sequences)].tolist()
+        bounds = np.cumsum([0] + [len(ids) for ids in sequences]).tolist()
+        return [tokens[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def as_vocab(vocabulary):
+    """
+    :param vocabulary: `Vocab` or torchtext vocabulary, as saved by older versions
+    :return: (`Vocab`) the same tokens and default index
+    """
+    if isinstance(vocabulary, Vocab):
+        return vocabulary
+    return Vocab(vocabulary.get_itos(), vocabulary.get_default_index())
+
+
 def create_vocab(opt, *datasets):
     """
-    Creates a torchtext vocabulary of source and target
+    Creates a vocabulary of source and target
     datasets texts. Indices go from most to least frequent word
     :param opt: program dictionary of parameters
     :param datasets: (Dataset) data
     :return: Vocabulary class
     """
-    max_size_src = opt.src_vocab_size
-    max_size_tgt = opt.tgt_vocab_size
+    return build_vocabs(opt, *count_tokens(*datasets))
+
+
+def count_tokens(*datasets):
+    """
+    Count the source and target tokens of datasets
+    :param datasets: (Dataset) data
+    :return: (Counter, Counter) source and target counts, in order of first occurrence
+    """
     counter_src = Counter()
     counter_tgt = Counter()
     for dataset in datasets:
-        if type(dataset) is SemTextDataset:
-            for src_text, target_txt, _, _, _, _, _ in dataset:
-                counter_src.update(src_text)
-                counter_tgt.update(target_txt)
-        else:
-            for src_text, target_txt, _, _, _ in dataset:
-                counter_src.update(src_text)
-                counter_tgt.update(target_txt)
-    sorted_by_freq_words_src = sorted(counter_src.items(), key=lambda x: x[1], reverse=True)
-    sorted_by_freq_words_tgt = sorted(counter_tgt.items(), key=lambda x: x[1], reverse=True)
-    ordered_dict_words_src = OrderedDict(sorted_by_freq_words_src)
-    ordered_dict_words_tgt = OrderedDict(sorted_by_freq_words_tgt)
-    final_vocab_src = vocab(ordered_dict_words_src)
-    final_vocab_tgt = vocab(ordered_dict_words_tgt)
-
-    for i, t in enumerate([UNK_WORD, PAD_WORD, EOS_WORD]):
-        final_vocab_src.insert_token(t, i)
-    for i, t in enumerate([UNK_WORD, PAD_WORD, BOS_WORD, EOS_WORD]):
-        final_vocab_tgt.insert_token(t, i)
+        counter_src.update(dataset.src_texts.counts())
+        counter_tgt.update(dataset.target_texts.counts())
+    return counter_src, counter_tgt
+
+
+def build_vocabs(opt, counter_src, counter_tgt):
+    """
+    Creates the source and target vocabularies from token counts.
+    Words of equal frequency keep the order of the counters
+    :param opt: program dictionary of parameters
+    :param counter_src: (Counter) source token counts
+    :param counter_tgt: (Counter) target token counts
+    :return: Vocabulary class
+    """
+    max_size_src = opt.src_vocab_size
+    max_size_tgt = opt.tgt_vocab_size
+    sorted_by_freq_words_src = _prune(sorted(counter_src.items(), key=lambda x: x[1], reverse=True),
+                                      max_size_src, opt.src_words_min_frequency, "source")
+    sorted_by_freq_words_tgt = _prune(sorted(counter_tgt.items(), key=lambda x: x[1], reverse=True),
+                                      max_size_tgt, opt.tgt_words_min_frequency, "target")
+    # the generator projects every decoder output on the whole target vocabulary
+    pruned_tgt = len(counter_tgt) - len(sorted_by_freq_words_tgt)
+    if pruned_tgt > 0:
+        logger.info(" * generator output layer: %d rows less, %.1f%% fewer multiply-adds per decoded token"
+                    % (pruned_tgt, 100.0 * pruned_tgt / (len(counter_tgt) + 4)))
+    # special tokens first, then words by decreasing frequency
+    final_vocab_src = Vocab([UNK_WORD, PAD_WORD, EOS_WORD] + [word for word, _ in sorted_by_freq_words_src])
+    final_vocab_tgt = Vocab([UNK_WORD, PAD_WORD, BOS_WORD, EOS_WORD] + [word for word, _ in sorted_by_freq_words_tgt])
 
     final_vocab_src.set_default_index(final_vocab_src[UNK_WORD])
     final_vocab_tgt.set_default_index(final_vocab_tgt[UNK_WORD])
@@ -48,8 +173,26 @@ def create_vocab(opt, *datasets):
     return final_vocab_src, final_vocab_tgt
 
 
+def _prune(sorted_by_freq_words, max_size, min_frequency, side):
+    """
+    Keep the `max_size` most frequent words seen at least `min_frequency` times
+    :param sorted_by_freq_words: list of (word, count) by decreasing count
+    :param max_size: (int) maximum number of words, special tokens excluded, no limit if not positive
+    :param min_frequency: (int) minimum count of a word
+    :param side: (str) name of the vocabulary, for the report
+    :return: the kept (word, count)
+    """
+    kept = sorted_by_freq_words[:max_size] if max_size > 0 else sorted_by_freq_words
+    kept = [(word, count) for word, count in kept if count >= min_frequency]
+    total = sum(count for _, count in sorted_by_freq_words)
+    covered = sum(count for _, count in kept)
+    logger.info(" * %s vocabulary: %d of %d words, covering %.2f%% of the training tokens"
+                % (side, len(kept), len(sorted_by_freq_words), 100.0 * covered / max(total, 1)))
+    return kept
+
+
 def get_max_index(vocabulary):
-    return len(vocabulary.get_itos()) + 1
+    return len(vocabulary) + 1
 
 
 def get_indices(vocabulary, example):
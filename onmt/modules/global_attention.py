@@ -141,8 +141,10 @@ class GlobalAttention(nn.Module):
 
         Args:
           source (`FloatTensor`): query vectors `[batch x tgt_len x dim]`
-          memory_bank (`FloatTensor`): source vectors `[batch x src_len x dim]`
-          memory_lengths (`LongTensor`): the source context lengths `[batch]`
+          memory_bank (`FloatTensor`): source vectors `[batch x src_len x dim]`,
+            or `[batch / beams x src_len x dim]` when `beams` consecutive queries
+            share the same source, as the beams of an example when translating
+          memory_lengths (`LongTensor`): the source context lengths, one per source
           coverage (`FloatTensor`): None (not supported yet)
 
         Returns:
@@ -160,6 +162,14 @@ class GlobalAttention(nn.Module):
         else:
             one_step = False
 
+        # fold the queries sharing a source into its target length
+        assert source.size(0) % memory_bank.size(0) == 0, \
+            "%d queries cannot share %d sources" % (source.size(0), memory_bank.size(0))
+        beams = source.size(0) // memory_bank.size(0)
+        if beams > 1:
+            assert coverage is None, "coverage is not supported with a shared memory bank"
+            source = source.contiguous().view(memory_bank.size(0), beams * source.size(1), source.size(2))
+
         batch, source_l, dim = memory_bank.size()
         batch_, target_l, dim_ = source.size()
         aeq(batch, batch_)
@@ -200,6 +210,12 @@ class GlobalAttention(nn.Module):
         if self.attn_type in ["general", "dot"]:
             attn_h = torch.tanh(attn_h)
 
+        if beams > 1:
+            # unfold the queries
+            batch, target_l = batch * beams, target_l // beams
+            attn_h = attn_h.view(batch, target_l, dim)
+            align_vectors = align_vectors.view(batch, target_l, source_l)
+
         if one_step:
             attn_h = attn_h.squeeze(1)
             align_vectors = align_vectors.squeeze(1)
@@ -247,14 +247,20 @@ def preprocess_opts(parser):
     group.add('--save_data', '-save_data', required=True,
               help="Output file for the prepared data")
 
+    group.add('--preprocess_workers', '-preprocess_workers', type=int, default=1,
+              help="""Number of processes reading, counting and
+                       numericalizing ranges of lines of the corpora,
+                       the output is the same as with a single process""")
+
     group.add('--max_shard_size', '-max_shard_size', type=int, default=0,
               help="""Deprecated use shard_size instead""")
 
     group.add('--shard_size', '-shard_size', type=int, default=1000000,
-              help="""Divide src_corpus and tgt_corpus into
-                       smaller multiple src_copus and tgt corpus files, then
-                       build shards, each shard will have
+              help="""Divide the training corpus into shards
+                       <save_data>.train.N.bin, each shard will have
                        opt.shard_size samples except last shard.
+                       Training streams the shards one at a time in a
+                       random order.
                        shard_size=0 means no segmentation
                        shard_size>0 means segment dataset into multiple shards,
                        each shard has shard_size samples""")
@@ -273,16 +279,22 @@ def preprocess_opts(parser):
               type=str, default='',
               help="Path prefix to existing features vocabularies")
     group.add('--src_vocab_size', '-src_vocab_size', type=int, default=50000,
-              help="Size of the source vocabulary")
+              help="""Size of the source vocabulary, special tokens
+                       excluded. The most frequent words are kept, 0 keeps
+                       all of them""")
 
     group.add('--tgt_vocab_size', '-tgt_vocab_size', type=int, default=50000,
-              help="Size of the target vocabulary")
+              help="""Size of the target vocabulary, special tokens
+                       excluded. It sets the width of the generator output
+                       layer, 0 keeps all the words""")
 
     group.add('--src_words_min_frequency',
-              '-src_words_min_frequency', type=int, default=0)
+              '-src_words_min_frequency', type=int, default=0,
+              help="Minimum count of the source words kept in the vocabulary")
 
     group.add('--tgt_words_min_frequency',
-              '-tgt_words_min_frequency', type=int, default=0)
+              '-tgt_words_min_frequency', type=int, default=0,
+              help="Minimum count of the target words kept in the vocabulary")
 
     group.add('--dynamic_dict', '-dynamic_dict', action='store_true',
               help="Create dynamic dictionaries")
@@ -419,8 +431,10 @@ def train_opts(parser):
               help='Maximum batch size for training')
     group.add('--batch_type', '-batch_type', default='sents',
               choices=["sents", "tokens"],
-              help="""Batch grouping for batch_size. Standard
-                               is sents. Tokens will do dynamic batching""")
+              help="""Batch grouping for batch_size and
+                               valid_batch_size. Standard is sents. Tokens
+                               will do dynamic batching, capping the padded
+                               source and target tokens of every batch""")
     group.add('--normalization', '-normalization', default='sents',
               choices=["sents", "tokens"],
               help='Normalization method of the gradient.')
@@ -433,6 +447,16 @@ def train_opts(parser):
               help='Perfom validation every X steps')
     group.add('--valid_batch_size', '-valid_batch_size', type=int, default=32,
               help='Maximum batch size for validation')
+    group.add('--num_workers', '-num_workers', type=int, default=0,
+              help="""Worker processes collating the batches in the
+                       background, 0 collates them between the
+                       training steps""")
+    group.add('--pin_memory', '-pin_memory', action='store_true',
+              help="""Collate the batches in page-locked memory and
+                       copy them to the GPU asynchronously""")
+    group.add('--prefetch_factor', '-prefetch_factor', type=int, default=2,
+              help="""Batches collated in advance by every worker,
+                       bounding the prefetch queue""")
     group.add('--max_generator_batches', '-max_generator_batches',
               type=int, default=32,
               help="""Maximum batches of words in a sequence to run
@@ -585,6 +609,68 @@ def translate_opts(parser):
               help="choose retrieval or translate")
     group.add('--lam_sem', '-lam_sem', type=float, default=0.0,
               help="lam of sem")
+    group.add('--sem_topk', '-sem_topk', type=int, default=1,
+              help="""Number of training neighbours retrieved for every
+                       test diff, and of semantic samples decoded along it
+                       when translating""")
+    group.add('--fuse_sem_decoder', '-fuse_sem_decoder', action='store_true',
+              help="""Decode the semantic samples with the model decoder,
+                       stacked along the batch with the sources, instead of
+                       with a copy of the decoder. RNN decoders only""")
+    group.add('--sem_score', '-sem_score', default='bleu',
+              choices=['bleu', 'cosine'],
+              help="""Weight of the semantic samples: sentence BLEU with
+                       the test diff, or the cosine similarity saved by
+                       the retrieval in sem.topk""")
+    group.add('--bleu_workers', '-bleu_workers', type=int, default=1,
+              help="""Number of processes computing the sentence BLEU of
+                       the semantic samples with -sem_score bleu""")
+
+    group.add('--sem_cache_dir', '-sem_cache_dir', default='data/sem_cache/',
+              help="""Directory of the cached training diffs encodings,
+                       one sub-directory per model checkpoint, source
+                       vocabulary and max_sent_length""")
+    group.add('--sem_cache_dtype', '-sem_cache_dtype', default='float16',
+              choices=['float32', 'float16', 'int8'],
+              help="""Storage type of the cached encodings, which are
+                       memory-mapped and scanned in blocks when searching""")
+    group.add('--encode_workers', '-encode_workers', type=int, default=1,
+              help="""Number of processes encoding the training diffs on
+                       CPU, each one encodes contiguous ranges of lines""")
+    group.add('--encode_threads', '-encode_threads', type=int, default=None,
+              help="""Intra-op threads of every encoding process, defaults
+                       to the number of cores divided by encode_workers""")
+
+    group = parser.add_argument_group('Retrieval index')
+    group.add('--sem_index', '-sem_index', default='flat',
+              choices=['flat', 'ivfpq', 'hnsw'],
+              help="""Nearest neighbour index used to retrieve the most
+                       similar training diffs: exact search (flat), inverted
+                       file with product quantization (ivfpq) or navigable
+                       small world graph (hnsw). The hnsw graph is built in
+                       pure Python, about 3ms per training diff (an hour per
+                       million): prefer ivfpq for large training sets""")
+    group.add('--sem_index_path', '-sem_index_path', default=None,
+              help="""Where the retrieval index is saved and loaded from.
+                       Defaults to <model>.<sem_index>.index next to the
+                       checkpoint""")
+    group.add('--sem_index_nlist', '-sem_index_nlist', type=int, default=256,
+              help="Number of coarse clusters of the ivfpq index")
+    group.add('--sem_index_nprobe', '-sem_index_nprobe', type=int, default=16,
+              help="""Number of clusters visited per query by the ivfpq
+                       index, can be changed without rebuilding it""")
+    group.add('--sem_index_pq_m', '-sem_index_pq_m', type=int, default=16,
+              help="""Number of one byte codes per vector of the ivfpq
+                       index, must divide the encoder output size""")
+    group.add('--sem_index_hnsw_m', '-sem_index_hnsw_m', type=int, default=16,
+              help="Maximum number of links per node of the hnsw index")
+    group.add('--sem_index_ef_construction', '-sem_index_ef_construction',
+              type=int, default=100,
+              help="Search width of the hnsw index when inserting")
+    group.add('--sem_index_ef_search', '-sem_index_ef_search',
+              type=int, default=64,
+              help="""Search width of the hnsw index when querying, can be
+                       changed without rebuilding it""")
 
     group = parser.add_argument_group('Beam')
     group.add('--fast', '-fast', action="store_true",
@@ -598,6 +684,15 @@ def translate_opts(parser):
               help='Maximum prediction length.')
     group.add('--max_sent_length', '-max_sent_length', type=int, default=100,
               help="Maximum source length.")
+    group.add('--random_sampling_topk', '-random_sampling_topk',
+              type=int, default=1,
+              help="""With -beam_size 1, sample every token among the k most
+                       likely ones. 1 is greedy decoding, 0 samples from the
+                       whole vocabulary""")
+    group.add('--random_sampling_temp', '-random_sampling_temp',
+              type=float, default=1.0,
+              help="""Softmax temperature of the random sampling, lower
+                       values are closer to greedy decoding""")
 
     # Alpha and Beta values for Google Length + Coverage penalty
     # Described here: https://arxiv.org/pdf/1609.08144.pdf, Section 7
@@ -662,6 +757,24 @@ def translate_opts(parser):
     group = parser.add_argument_group('Efficiency')
     group.add('--batch_size', '-batch_size', type=int, default=30,
               help='Batch size')
+    group.add('--batch_type', '-batch_type', default='sents',
+              choices=["sents", "tokens"],
+              help="""Batch grouping for batch_size. Standard is sents.
+                       Tokens caps the padded source and target tokens of a
+                       batch, and needs -sort_by_length""")
+    group.add('--sort_by_length', '-sort_by_length', action='store_true',
+              help="""Sort the whole test set by source length before
+                       batching, translations are still written in the
+                       order of the test set""")
+    group.add('--num_workers', '-num_workers', type=int, default=0,
+              help="""Worker processes collating the batches in the
+                       background, 0 collates them between the batches""")
+    group.add('--pin_memory', '-pin_memory', action='store_true',
+              help="""Collate the batches in page-locked memory and
+                       copy them to the GPU asynchronously""")
+    group.add('--prefetch_factor', '-prefetch_factor', type=int, default=2,
+              help="""Batches collated in advance by every worker,
+                       bounding the prefetch queue""")
     group.add('--gpu', '-gpu', action="store_true",
                        help="Use gpu processor for the execution.")
 
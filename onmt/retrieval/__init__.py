@@ -0,0 +1,5 @@
+""" Nearest neighbour retrieval of training commits for semantic decoding """
+from onmt.retrieval.embedding_store import EmbeddingStore
+from onmt.retrieval.index import FlatIndex, StreamingFlatIndex, IVFPQIndex, HNSWIndex, build_index, load_index
+
+__all__ = ["EmbeddingStore", "FlatIndex", "StreamingFlatIndex", "IVFPQIndex", "HNSWIndex", "build_index", "load_index"]
@@ -0,0 +1,178 @@
+""" On-disk cache of the training set encodings used for semantic retrieval """
+import glob
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from onmt.retrieval.matrix_file import MatrixFile, write_matrix
+from onmt.utils.line_index import ends_line
+from onmt.utils.logging import logger
+
+# version of the encodings, bumped when the way they are computed changes: 2 leaves the padding out of the max-pool
+ENCODING_VERSION = 2
+
+
+def file_digest(path, length=None, chunk_size=1 << 20):
+    """
+    SHA-1 of the content of a file
+    :param path: (str) filepath
+    :param length: (int) only hash the first `length` bytes, whole file if None
+    :return: (str) hex digest
+    """
+    sha = hashlib.sha1()
+    remaining = length
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            sha.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return sha.hexdigest()
+
+
+class EmbeddingStore(object):
+    """
+    Content-addressed store of the max-pooled encoder features of a training corpus.
+
+    Encodings depend on the model weights, the source vocabulary and the truncation length, so
+    every (checkpoint, vocabulary, max_sent_length) triple gets its own directory under `root`.
+    They do not depend on the batches the diffs were encoded in, padded steps are left out of the max-pool.
+    Its manifest records how many lines of the training diffs are encoded and the digest of the
+    bytes they span: a corpus with the same digest is a cache hit, and a corpus that starts with
+    the same bytes only needs its new lines to be encoded and appended as new shards.
+
+    :param root: (str) directory holding the stores of all models
+    :param checkpoint_path: (str) filepath of the model checkpoint
+    :param vocab_path: (str) filepath of the source vocabulary
+    :param max_sent_length: (int) truncation length of the encoded diffs
+    :param dtype: (str) storage type of the shards, see `onmt.retrieval.matrix_file.DTYPES`
+    """
+
+    def __init__(self, root, checkpoint_path, vocab_path, max_sent_length, dtype="float16"):
+        self.dtype = dtype
+        self.key = "%s-%s-%d-%s-v%d" % (file_digest(checkpoint_path)[:16], file_digest(vocab_path)[:8], max_sent_length,
+                                         dtype, ENCODING_VERSION)
+        self.path = os.path.join(root, self.key)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        manifest_path = os.path.join(self.path, "manifest.pt")
+        if os.path.isfile(manifest_path):
+            self.manifest = torch.load(manifest_path)
+        else:
+            self.manifest = self._empty_manifest()
+        self._pending = []
+        self._files = None
+
+    @staticmethod
+    def _empty_manifest():
+        return {"train_bytes": 0, "train_digest": hashlib.sha1().hexdigest(), "rows": 0, "shards": []}
+
+    @property
+    def rows(self):
+        """Number of stored encodings, including the ones added but not committed yet"""
+        return self.manifest["rows"] + sum(rows for _, rows in self._pending)
+
+    def cached_rows(self, train_diff):
+        """
+        Number of leading lines of `train_diff` whose encodings are already stored.
+        The store is emptied when its content is not a prefix of `train_diff` anymore.
+        :param train_diff: (str) filepath of the training diffs
+        :return: (int) first line that still has to be encoded
+        """
+        train_bytes = self.manifest["train_bytes"]
+        if train_bytes == 0:
+            return 0
+        # the stored lines must end on a line boundary, or the last one may have been extended
+        if os.path.getsize(train_diff) >= train_bytes and ends_line(train_diff, train_bytes) \
+                and file_digest(train_diff, train_bytes) == self.manifest["train_digest"]:
+            return self.manifest["rows"]
+        logger.info("Training diffs changed, discarding the encodings stored in %s" % self.path)
+        self._discard()
+        return 0
+
+    def _discard(self):
+        """Empty the store and delete its shards, including the ones of interrupted runs that were never committed"""
+        self.manifest = self._empty_manifest()
+        self._files = None
+        # the empty manifest goes first, an interrupted run must not leave it pointing to deleted shards
+        self._save_manifest()
+        for path in glob.glob(os.path.join(self.path, "shard.*.mat")):
+            os.remove(path)
+
+    def add(self, features):
+        """
+        Write a shard of encodings that follows the ones already stored
+        :param features: (`FloatTensor`) encodings `[rows x hidden]`
+        """
+        name = "shard.%d.mat" % (len(self.manifest["shards"]) + len(self._pending))
+        write_matrix(os.path.join(self.path, name), features, self.dtype)
+        logger.info("Saving shard %s" % os.path.join(self.path, name))
+        self._pending.append((name, features.size(0)))
+
+    def commit(self, train_diff):
+        """
+        Record the added shards as the encodings of `train_diff`
+        :param train_diff: (str) filepath of the encoded training diffs
+        """
+        self.manifest = {"train_bytes": os.path.getsize(train_diff),
+                         "train_digest": file_digest(train_diff),
+                         "rows": self.rows,
+                         "shards": self.manifest["shards"] + self._pending}
+        self._pending = []
+        self._files = None
+        self._save_manifest()
+
+    def _save_manifest(self):
+        # replace the manifest atomically, an interrupted run leaves the previous one valid
+        tmp_path = os.path.join(self.path, "manifest.pt.tmp")
+        torch.save(self.manifest, tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, "manifest.pt"))
+
+    @property
+    def cached_bytes(self):
+        """Number of leading bytes of the training diffs whose encodings are committed"""
+        return self.manifest["train_bytes"]
+
+    @property
+    def digest(self):
+        return self.manifest["train_digest"]
+
+    @property
+    def files(self):
+        """Memory-mapped committed shards, in corpus order"""
+        if self._files is None:
+            self._files = [MatrixFile(os.path.join(self.path, name)) for name, _ in self.manifest["shards"]]
+        return self._files
+
+    def iter_blocks(self, block_rows=65536, normalize=False):
+        """
+        Yield (first row, `FloatTensor` `[<= block_rows x hidden]`) over the committed encodings,
+        only one block is converted to float32 at a time
+        """
+        offset = 0
+        for matrix in self.files:
+            for start, block in matrix.iter_blocks(block_rows, normalize):
+                yield offset + start, block
+            offset += len(matrix)
+
+    def sample(self, n, seed=0):
+        """
+        :return: (`FloatTensor`) at most n encodings drawn uniformly without replacement
+        """
+        if self.rows <= n:
+            return self.load()
+        ids = np.sort(np.random.RandomState(seed).choice(self.rows, n, replace=False))
+        bounds = np.cumsum([0] + [len(matrix) for matrix in self.files])
+        return torch.cat([matrix.take(torch.from_numpy(ids[(ids >= bounds[i]) & (ids < bounds[i + 1])] - bounds[i]))
+                          for i, matrix in enumerate(self.files)])
+
+    def load(self):
+        """
+        :return: (`FloatTensor`) all the committed encodings, in corpus order `[rows x hidden]`
+        """
+        blocks = [block for _, block in self.iter_blocks()]
+        return torch.cat(blocks) if blocks else torch.empty(0)
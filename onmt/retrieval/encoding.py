@@ -0,0 +1,91 @@
+""" Encoding of the training diffs for semantic retrieval, optionally split over several processes """
+import os
+
+import torch
+import torch.multiprocessing as mp
+
+from onmt.inputters.input_aux import build_dataset_iter
+from onmt.inputters.text_dataset import TextDataset
+from onmt.utils.misc import sequence_mask
+
+
+def max_pool(memory_bank, lengths):
+    """
+    Max-pool encoder outputs over the time steps of every sequence. Padded steps are left out, so that
+    the features of a diff do not depend on the other diffs of its batch.
+    :param memory_bank: (`FloatTensor`) encoder outputs `[src_len x batch x hidden]`
+    :param lengths: (`LongTensor`) lengths of the sequences `[batch]`
+    :return: (`FloatTensor`) `[batch x hidden]`
+    """
+    mask = sequence_mask(lengths, max_len=memory_bank.size(0)).t().unsqueeze(2)
+    return memory_bank.masked_fill(~mask, float("-inf")).max(0)[0]
+
+
+def encode_range(encoder, vocabs, path, byte_range, max_sent_length, batch_size, gpu=False):
+    """
+    Encode the diffs in a byte range of a file and max-pool the encoder outputs over time
+    :param encoder: (`EncoderBase`) encoder of the model
+    :param vocabs: (dict) vocabularies of the model
+    :param path: (str) filepath of the diffs
+    :param byte_range: (int, int) start and end of the range, both at the start of a line
+    :param max_sent_length: (int) truncation length of the diffs
+    :param batch_size: (int) size of examples per mini-batch
+    :param gpu: (bool) run the encoder on GPU
+    :return: (`FloatTensor`) features of the diffs on CPU, in file order `[lines x hidden]`
+    """
+    ds = TextDataset(path, src_max_len=max_sent_length, byte_range=byte_range)
+    # batches are formed over the whole range sorted by length, to minimize padding
+    data_iter = build_dataset_iter(ds, vocabs, batch_size, gpu=gpu, shuffle_batches=False, sort_globally=True)
+
+    memories, indexes = [], []
+    with torch.no_grad():
+        for batch in data_iter:
+            src = batch["src_batch"]
+            source_lengths = batch["src_len"]
+            enc_states, memory_bank, src_lengths = encoder(src, source_lengths)
+
+            memories.append(max_pool(memory_bank, source_lengths).cpu())
+            indexes.append(batch["indexes"].cpu())
+    if not memories:
+        return torch.empty(0)
+    # restore the order of the file
+    _, rank = torch.sort(torch.cat(indexes))
+    return torch.cat(memories)[rank]
+
+
+# state of the pool workers, set once by `_init_worker`
+_worker = {}
+
+
+def _init_worker(encoder, vocabs, path, max_sent_length, batch_size, threads):
+    torch.set_num_threads(threads)
+    _worker.update(encoder=encoder, vocabs=vocabs, path=path, max_sent_length=max_sent_length, batch_size=batch_size)
+
+
+def _encode_worker(byte_range):
+    return encode_range(_worker["encoder"], _worker["vocabs"], _worker["path"], byte_range,
+                        _worker["max_sent_length"], _worker["batch_size"])
+
+
+def encode_ranges(encoder, vocabs, path, byte_ranges, max_sent_length, batch_size, gpu=False, workers=1, threads=None):
+    """
+    Encode several byte ranges of a file, yielding the features of every range in the order of `byte_ranges`
+    whatever the order in which the workers finish them.
+    With more than one worker the ranges are encoded on CPU by a pool of processes sharing the encoder weights,
+    each limited to `threads` intra-op threads so that the pool does not oversubscribe the cores.
+    :param workers: (int) number of encoding processes, ignored on GPU
+    :param threads: (int) intra-op threads per process, defaults to the number of cores divided by `workers`
+    """
+    if workers <= 1 or gpu:
+        for byte_range in byte_ranges:
+            yield encode_range(encoder, vocabs, path, byte_range, max_sent_length, batch_size, gpu)
+        return
+
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    encoder.share_memory()
+    with mp.Pool(workers, initializer=_init_worker,
+                 initargs=(encoder, vocabs, path, max_sent_length, batch_size, threads)) as pool:
+        # imap returns the results in submission order
+        for features in pool.imap(_encode_worker, byte_ranges):
+            yield features
@@ -0,0 +1,477 @@
+""" Nearest neighbour indexes over encoder features, searched by cosine similarity """
+import heapq
+import math
+
+import numpy as np
+import torch
+
+from onmt.retrieval.similarity import blocked_cosine_topk, default_block_rows, normalize
+from onmt.utils.logging import logger
+
+
+def _nearest_centroid(x, centroids, block_size=65536):
+    """
+    Assign every row of x to its closest centroid in L2 distance
+    :param x: (`FloatTensor`) vectors `[n x dim]`
+    :param centroids: (`FloatTensor`) centroids `[k x dim]`
+    :param block_size: rows of x scored at once, bounds the `[block x k]` score matrix
+    :return: (`LongTensor`) centroid index of every row `[n]`
+    """
+    # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+    half_norms = centroids.pow(2).sum(1) / 2
+    assign = []
+    for start in range(0, x.size(0), block_size):
+        scores = torch.mm(x[start:start + block_size], centroids.t()) - half_norms
+        assign.append(scores.argmax(1))
+    return torch.cat(assign) if assign else torch.empty(0, dtype=torch.long)
+
+
+def _kmeans(x, n_clusters, n_iter=20, seed=0):
+    """
+    Lloyd's k-means on the rows of x, empty clusters are re-seeded with random points
+    :return: (`FloatTensor`) centroids `[n_clusters x dim]`
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(x.size(0), generator=generator)[:n_clusters]].clone()
+    for _ in range(n_iter):
+        assign = _nearest_centroid(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=n_clusters)
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+        empty = (counts == 0).nonzero().view(-1)
+        if len(empty) > 0:
+            centroids[empty] = x[torch.randint(x.size(0), (len(empty),), generator=generator)]
+    return centroids
+
+
+class NearestNeighbourIndex(object):
+    """
+    Base class of the retrieval indexes. Vectors are L2-normalized when added,
+    so `search` ranks them by cosine similarity with the (normalized) queries.
+
+    :param dim: (int) size of the indexed vectors
+    """
+    kind = None
+    # attributes that only change how the index is searched, see `set_search_params`
+    search_params = ()
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.meta = {}
+
+    def set_search_params(self, **params):
+        """
+        Change the parameters of the queries, they can differ from the ones the index was saved with
+        """
+        for name, value in params.items():
+            if name not in self.search_params:
+                raise ValueError("%s is not a search parameter of the %s index" % (name, self.kind))
+            setattr(self, name, value)
+
+    def train(self, vectors):
+        """Learn the index parameters from a sample of vectors, a no-op for indexes without parameters"""
+        pass
+
+    def add(self, vectors):
+        raise NotImplementedError
+
+    def search(self, queries, k=1):
+        """
+        :param queries: (`FloatTensor`) query vectors `[n_queries x dim]`
+        :param k: (int) number of neighbours
+        :return: (`FloatTensor`, `LongTensor`) cosine scores and ids of the neighbours, both `[n_queries x k]`
+        """
+        raise NotImplementedError
+
+    def to(self, device):
+        return self
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def state_dict(self):
+        raise NotImplementedError
+
+    @classmethod
+    def from_state_dict(cls, state):
+        raise NotImplementedError
+
+    def save(self, path):
+        torch.save({"kind": self.kind, "meta": self.meta, "state": self.state_dict()}, path)
+
+
+class FlatIndex(NearestNeighbourIndex):
+    """
+    Exact search: the queries are scored against every indexed vector, kept in memory.
+    """
+    kind = "flat"
+
+    def __init__(self, dim):
+        super(FlatIndex, self).__init__(dim)
+        self.vectors = torch.empty(0, dim)
+
+    def add(self, vectors):
+        self.vectors = torch.cat([self.vectors, normalize(vectors).to(self.vectors.device)])
+
+    def search(self, queries, k=1):
+        queries = queries.to(self.vectors.device)
+        block_rows = default_block_rows(queries.size(0), self.dim)
+        # vectors are normalized once when added
+        blocks = ((start, self.vectors[start:start + block_rows], None) for start in range(0, len(self), block_rows))
+        return blocked_cosine_topk(queries, blocks, k)
+
+    def to(self, device):
+        self.vectors = self.vectors.to(device)
+        return self
+
+    def __len__(self):
+        return self.vectors.size(0)
+
+    def state_dict(self):
+        return {"dim": self.dim, "vectors": self.vectors.cpu()}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        index = cls(state["dim"])
+        index.vectors = state["vectors"]
+        return index
+
+
+class StreamingFlatIndex(NearestNeighbourIndex):
+    """
+    Exact search over memory-mapped matrices (`onmt.retrieval.matrix_file.MatrixFile`), which are
+    scanned block by block with a running top-k: the whole matrix is never loaded in memory.
+    Blocks are copied to the device of the queries when they are scored.
+    The matrices are the index: they are read in place, there is nothing else to save.
+
+    :param matrices: list of `MatrixFile`, their rows are numbered consecutively
+    :param block_rows: (int) rows scored at once, sized after the number of queries if None
+    """
+    kind = "flat"
+
+    def __init__(self, matrices, block_rows=None):
+        super(StreamingFlatIndex, self).__init__(matrices[0].dim if matrices else 0)
+        self.matrices = matrices
+        self.block_rows = block_rows
+        self.device = torch.device("cpu")
+
+    def _blocks(self, block_rows):
+        offset = 0
+        for matrix in self.matrices:
+            for start in range(0, len(matrix), block_rows):
+                end = min(start + block_rows, len(matrix))
+                # dividing the scores by the stored norms is cheaper than normalizing the rows
+                yield offset + start, matrix.rows_slice(start, end), torch.from_numpy(matrix.norms[start:end])
+            offset += len(matrix)
+
+    def search(self, queries, k=1):
+        block_rows = self.block_rows or default_block_rows(queries.size(0), self.dim)
+        return blocked_cosine_topk(queries.to(self.device), self._blocks(block_rows), k)
+
+    def to(self, device):
+        self.device = device
+        return self
+
+    def __len__(self):
+        return sum(len(matrix) for matrix in self.matrices)
+
+    def save(self, path):
+        """No-op, a new StreamingFlatIndex over the same matrices is the same index"""
+        pass
+
+
+class IVFPQIndex(NearestNeighbourIndex):
+    """
+    Inverted file with product-quantized residuals.
+    A coarse k-means quantizer splits the vectors into `nlist` lists; inside each list the
+    residual to the list centroid is compressed into `m` one-byte codes. A query only visits
+    the `nprobe` lists whose centroids are most similar to it and scores their entries with
+    per-subspace lookup tables (asymmetric distance computation).
+
+    :param dim: (int) size of the indexed vectors, must be divisible by m
+    :param nlist: (int) number of coarse clusters
+    :param m: (int) number of sub-quantizers
+    :param nprobe: (int) number of lists visited per query
+    """
+    kind = "ivfpq"
+    search_params = ("nprobe",)
+
+    def __init__(self, dim, nlist=256, m=16, nprobe=16, n_iter=20, seed=0):
+        super(IVFPQIndex, self).__init__(dim)
+        assert dim % m == 0, "the vectors size (%d) must be divisible by the number of sub-quantizers (%d)" % (dim, m)
+        self.nlist = nlist
+        self.m = m
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.coarse = None
+        self.codebooks = None
+        # entries sorted by list, list l spans [offsets[l], offsets[l + 1])
+        self.codes = torch.empty(0, m, dtype=torch.uint8)
+        self.ids = torch.empty(0, dtype=torch.long)
+        self.offsets = torch.zeros(nlist + 1, dtype=torch.long)
+
+    @property
+    def is_trained(self):
+        return self.coarse is not None
+
+    def train(self, vectors, max_train_size=262144):
+        vectors = normalize(vectors).cpu()
+        if vectors.size(0) > max_train_size:
+            generator = torch.Generator().manual_seed(self.seed)
+            vectors = vectors[torch.randperm(vectors.size(0), generator=generator)[:max_train_size]]
+        self.nlist = min(self.nlist, vectors.size(0))
+        self.offsets = torch.zeros(self.nlist + 1, dtype=torch.long)
+        self.coarse = _kmeans(vectors, self.nlist, self.n_iter, self.seed)
+        residuals = vectors - self.coarse[_nearest_centroid(vectors, self.coarse)]
+        ksub = min(256, vectors.size(0))
+        sub_dim = self.dim // self.m
+        self.codebooks = torch.stack([_kmeans(residuals[:, i * sub_dim:(i + 1) * sub_dim], ksub, self.n_iter, self.seed)
+                                      for i in range(self.m)])
+
+    def _encode(self, residuals):
+        sub_dim = self.dim // self.m
+        codes = [_nearest_centroid(residuals[:, i * sub_dim:(i + 1) * sub_dim], self.codebooks[i])
+                 for i in range(self.m)]
+        return torch.stack(codes, 1).to(torch.uint8)
+
+    def add(self, vectors):
+        assert self.is_trained, "IVFPQIndex must be trained before adding vectors"
+        vectors = normalize(vectors).cpu()
+        lists = _nearest_centroid(vectors, self.coarse)
+        codes = self._encode(vectors - self.coarse[lists])
+        ids = torch.arange(len(self), len(self) + vectors.size(0))
+
+        # merge with the existing entries, keeping them grouped by list
+        old_lists = torch.repeat_interleave(torch.arange(self.nlist), self.offsets[1:] - self.offsets[:-1])
+        lists = torch.cat([old_lists, lists])
+        order = torch.sort(lists, stable=True)[1]
+        self.codes = torch.cat([self.codes, codes])[order]
+        self.ids = torch.cat([self.ids, ids])[order]
+        self.offsets = torch.cat([torch.zeros(1, dtype=torch.long),
+                                  torch.bincount(lists, minlength=self.nlist).cumsum(0)])
+
+    def search(self, queries, k=1):
+        queries = normalize(queries).cpu()
+        sub_dim = self.dim // self.m
+        coarse_sims = torch.mm(queries, self.coarse.t())
+        probe_sims, probes = torch.topk(coarse_sims, min(self.nprobe, self.nlist), dim=1)
+        all_scores = torch.full((queries.size(0), k), -float('inf'))
+        all_ids = torch.full((queries.size(0), k), -1, dtype=torch.long)
+        sub_range = torch.arange(self.m).unsqueeze(0)
+        for q in range(queries.size(0)):
+            # lookup table of the inner products between query sub-vectors and sub-centroids [m x ksub]
+            lut = torch.bmm(self.codebooks, queries[q].view(self.m, sub_dim, 1)).squeeze(2)
+            scores, ids = [], []
+            for sim, l in zip(probe_sims[q].tolist(), probes[q].tolist()):
+                start, end = self.offsets[l].item(), self.offsets[l + 1].item()
+                if start == end:
+                    continue
+                codes = self.codes[start:end].long()
+                scores.append(sim + lut[sub_range, codes].sum(1))
+                ids.append(self.ids[start:end])
+            if not scores:
+                continue
+            scores, ids = torch.cat(scores), torch.cat(ids)
+            top_scores, top = torch.topk(scores, min(k, scores.size(0)))
+            all_scores[q, :top.size(0)] = top_scores
+            all_ids[q, :top.size(0)] = ids[top]
+        return all_scores, all_ids
+
+    def __len__(self):
+        return self.ids.size(0)
+
+    def state_dict(self):
+        return {"dim": self.dim, "nlist": self.nlist, "m": self.m, "nprobe": self.nprobe, "n_iter": self.n_iter,
+                "seed": self.seed, "coarse": self.coarse, "codebooks": self.codebooks, "codes": self.codes,
+                "ids": self.ids, "offsets": self.offsets}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        index = cls(state["dim"], state["nlist"], state["m"], state["nprobe"], state["n_iter"], state["seed"])
+        for key in ["coarse", "codebooks", "codes", "ids", "offsets"]:
+            setattr(index, key, state[key])
+        return index
+
+
+class HNSWIndex(NearestNeighbourIndex):
+    """
+    Hierarchical navigable small world graph (Malkov and Yashunin, 2016).
+    Every vector is a node linked to its `m` most similar nodes on each of the layers it
+    belongs to; the upper, sparser layers are used to greedily reach the neighbourhood of
+    the query, which is then explored with a best-first search of width `ef_search`.
+    The graph is built and searched one vector at a time in Python: inserting takes a few
+    milliseconds per vector, hours for millions of them, where ivfpq is built in minutes.
+
+    :param dim: (int) size of the indexed vectors
+    :param m: (int) maximum number of links per node (2 * m on the bottom layer)
+    :param ef_construction: (int) search width when inserting
+    :param ef_search: (int) search width when querying
+    """
+    kind = "hnsw"
+    search_params = ("ef_search",)
+
+    def __init__(self, dim, m=16, ef_construction=100, ef_search=64, seed=0):
+        super(HNSWIndex, self).__init__(dim)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+        self.level_mult = 1 / math.log(m)
+        self.rng = np.random.RandomState(seed)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        # graph[level] maps a node to the list of its neighbours on that level
+        self.graph = []
+        self.entry_point = None
+
+    def _max_links(self, level):
+        return 2 * self.m if level == 0 else self.m
+
+    def _search_layer(self, query, entry_points, ef, level):
+        """
+        Best-first search of one layer
+        :return: list of (similarity, node) of the ef most similar nodes found, best first
+        """
+        visited = set(entry_points)
+        sims = self.vectors[entry_points] @ query
+        candidates = [(-s, n) for s, n in zip(sims.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        results = [(s, n) for s, n in zip(sims.tolist(), entry_points)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        links = self.graph[level]
+        while candidates:
+            neg_sim, node = heapq.heappop(candidates)
+            if len(results) >= ef and -neg_sim < results[0][0]:
+                break
+            neighbours = [n for n in links.get(node, ()) if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for s, n in zip((self.vectors[neighbours] @ query).tolist(), neighbours):
+                if len(results) < ef or s > results[0][0]:
+                    heapq.heappush(candidates, (-s, n))
+                    heapq.heappush(results, (s, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _shrink(self, node, level):
+        """Keep only the most similar links of a node that exceeds the maximum number of links"""
+        links = self.graph[level][node]
+        if len(links) > self._max_links(level):
+            sims = self.vectors[links] @ self.vectors[node]
+            keep = np.argsort(-sims, kind="stable")[:self._max_links(level)]
+            self.graph[level][node] = [links[i] for i in keep]
+
+    def _insert(self, node):
+        query = self.vectors[node]
+        level = int(-math.log(1.0 - self.rng.random_sample()) * self.level_mult)
+        while len(self.graph) <= level:
+            self.graph.append({})
+        if self.entry_point is None:
+            for lc in range(level + 1):
+                self.graph[lc][node] = []
+            self.entry_point = node
+            return
+
+        top_level = self._node_level(self.entry_point)
+        entry_points = [self.entry_point]
+        for lc in range(top_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, lc)[0][1]]
+        for lc in range(min(level, top_level), -1, -1):
+            found = self._search_layer(query, entry_points, self.ef_construction, lc)
+            neighbours = [n for _, n in found[:self._max_links(lc)]]
+            self.graph[lc][node] = neighbours
+            for n in neighbours:
+                self.graph[lc][n].append(node)
+                self._shrink(n, lc)
+            entry_points = [n for _, n in found]
+        for lc in range(top_level + 1, level + 1):
+            self.graph[lc][node] = []
+        if level > top_level:
+            self.entry_point = node
+
+    def _node_level(self, node):
+        level = 0
+        while level + 1 < len(self.graph) and node in self.graph[level + 1]:
+            level += 1
+        return level
+
+    def add(self, vectors):
+        vectors = normalize(vectors).cpu().numpy()
+        first = len(self)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        for node in range(first, len(self)):
+            self._insert(node)
+            if (node + 1) % 10000 == 0:
+                logger.info("HNSW index: inserted %d/%d vectors" % (node + 1, len(self)))
+
+    def search(self, queries, k=1):
+        queries = normalize(queries).cpu().numpy()
+        all_scores = torch.full((queries.shape[0], k), -float('inf'))
+        all_ids = torch.full((queries.shape[0], k), -1, dtype=torch.long)
+        if self.entry_point is None:
+            return all_scores, all_ids
+        for q, query in enumerate(queries):
+            entry_points = [self.entry_point]
+            for lc in range(self._node_level(self.entry_point), 0, -1):
+                entry_points = [self._search_layer(query, entry_points, 1, lc)[0][1]]
+            found = self._search_layer(query, entry_points, max(self.ef_search, k), 0)[:k]
+            all_scores[q, :len(found)] = torch.tensor([s for s, _ in found])
+            all_ids[q, :len(found)] = torch.tensor([n for _, n in found])
+        return all_scores, all_ids
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def state_dict(self):
+        return {"dim": self.dim, "m": self.m, "ef_construction": self.ef_construction, "ef_search": self.ef_search,
+                "seed": self.seed, "vectors": self.vectors, "graph": self.graph, "entry_point": self.entry_point,
+                "rng": self.rng.get_state()}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        index = cls(state["dim"], state["m"], state["ef_construction"], state["ef_search"], state["seed"])
+        index.vectors = state["vectors"]
+        index.graph = state["graph"]
+        index.entry_point = state["entry_point"]
+        index.rng.set_state(state["rng"])
+        return index
+
+
+INDEX_TYPES = {index_type.kind: index_type for index_type in [FlatIndex, IVFPQIndex, HNSWIndex]}
+
+
+def build_index(kind, vectors, training_vectors=None, **kwargs):
+    """
+    Build and fill an index of the given kind
+    :param kind: (str) one of `INDEX_TYPES`
+    :param vectors: (`FloatTensor`) vectors to index `[n x dim]`, their row number is their id,
+        or an iterable of consecutive blocks of vectors
+    :param training_vectors: (`FloatTensor`) sample used to train the index, defaults to `vectors`
+    :param kwargs: parameters of the index class
+    :return: the index
+    """
+    blocks = [vectors] if torch.is_tensor(vectors) else vectors
+    if training_vectors is None:
+        blocks = list(blocks)
+        training_vectors = torch.cat(blocks) if blocks else torch.empty(0)
+    if training_vectors.numel() == 0:
+        raise ValueError("cannot build a %s index without vectors" % kind)
+    index = INDEX_TYPES[kind](training_vectors.size(1), **kwargs)
+    index.train(training_vectors)
+    for block in blocks:
+        index.add(block)
+    return index
+
+
+def load_index(path):
+    """
+    Load an index saved with `NearestNeighbourIndex.save`
+    """
+    saved = torch.load(path)
+    index = INDEX_TYPES[saved["kind"]].from_state_dict(saved["state"])
+    index.meta = saved["meta"]
+    return index
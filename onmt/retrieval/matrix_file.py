@@ -0,0 +1,112 @@
+""" Flat, memory-mapped on-disk format for matrices of encoder features """
+import struct
+
+import numpy as np
+import torch
+
+MAGIC = b"CRMX"
+VERSION = 1
+# magic, version, dtype code, rows, dim, data offset, norms offset, scales offset
+HEADER = struct.Struct("<4sIIQIQQQ")
+HEADER_SIZE = 64
+
+DTYPES = {"float32": (0, np.float32), "float16": (1, np.float16), "int8": (2, np.int8)}
+DTYPE_NAMES = {code: name for name, (code, _) in DTYPES.items()}
+
+
+def write_matrix(path, matrix, dtype="float16"):
+    """
+    Save a matrix as a header, the rows in the storage dtype, their L2 norms and (int8 only)
+    their quantization scales. The norms are the ones of the stored rows, so that cosine
+    similarities computed on the file are consistent.
+    :param path: (str) filepath
+    :param matrix: (`FloatTensor`) `[rows x dim]`
+    :param dtype: (str) storage type, one of `DTYPES`
+    """
+    code, np_dtype = DTYPES[dtype]
+    matrix = matrix.detach().float().cpu().numpy()
+    rows, dim = matrix.shape
+    if dtype == "int8":
+        # symmetric per-row quantization
+        scales = np.abs(matrix).max(1) / 127
+        scales[scales == 0] = 1
+        data = np.rint(matrix / scales[:, None]).astype(np.int8)
+        norms = np.linalg.norm(data.astype(np.float32), axis=1) * scales
+    else:
+        scales = None
+        data = matrix.astype(np_dtype)
+        norms = np.linalg.norm(data.astype(np.float32), axis=1)
+
+    data_offset = HEADER_SIZE
+    norms_offset = data_offset + data.nbytes
+    scales_offset = norms_offset + rows * 4 if scales is not None else 0
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, code, rows, dim, data_offset, norms_offset, scales_offset)
+                .ljust(HEADER_SIZE, b'\0'))
+        f.write(data.tobytes())
+        f.write(norms.astype(np.float32).tobytes())
+        if scales is not None:
+            f.write(scales.astype(np.float32).tobytes())
+
+
+class MatrixFile(object):
+    """
+    Read-only, memory-mapped view of a file written by `write_matrix`.
+    Nothing is read from disk until rows are accessed; `iter_blocks` converts one block
+    of rows at a time to float32, so scanning the file keeps a bounded memory footprint.
+    :param path: (str) filepath
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        magic, version, code, rows, dim, data_offset, norms_offset, scales_offset = HEADER.unpack_from(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a matrix file" % path)
+        self.dtype = DTYPE_NAMES[code]
+        self.rows = rows
+        self.dim = dim
+        # copy-on-write maps are seen as writable by torch.from_numpy, the file is never modified
+        np_dtype = DTYPES[self.dtype][1]
+        self.data = np.memmap(path, dtype=np_dtype, mode='c', offset=data_offset, shape=(rows, dim)) \
+            if rows > 0 else np.empty((0, dim), dtype=np_dtype)
+        self.norms = np.memmap(path, dtype=np.float32, mode='c', offset=norms_offset, shape=(rows,)) \
+            if rows > 0 else np.empty(0, dtype=np.float32)
+        self.scales = np.memmap(path, dtype=np.float32, mode='c', offset=scales_offset, shape=(rows,)) \
+            if scales_offset > 0 and rows > 0 else None
+
+    def __len__(self):
+        return self.rows
+
+    def rows_slice(self, start, end, normalize=False):
+        """
+        :return: (`FloatTensor`) rows [start, end) as float32, L2-normalized if `normalize`
+        """
+        # out of place: float32 blocks are views of the map
+        block = torch.from_numpy(self.data[start:end]).float()
+        if self.scales is not None:
+            block = block * torch.from_numpy(self.scales[start:end]).unsqueeze(1)
+        if normalize:
+            block = block / torch.from_numpy(self.norms[start:end]).clamp(min=1e-12).unsqueeze(1)
+        return block
+
+    def take(self, ids, normalize=False):
+        """
+        :param ids: (`LongTensor`) row numbers
+        :return: (`FloatTensor`) the selected rows as float32 `[len(ids) x dim]`
+        """
+        ids = ids.cpu().numpy()
+        block = torch.from_numpy(np.asarray(self.data[ids])).float()
+        if self.scales is not None:
+            block = block * torch.from_numpy(np.asarray(self.scales[ids])).unsqueeze(1)
+        if normalize:
+            block = block / torch.from_numpy(np.asarray(self.norms[ids])).clamp(min=1e-12).unsqueeze(1)
+        return block
+
+    def iter_blocks(self, block_rows, normalize=False):
+        """
+        Yield (first row, `FloatTensor` `[<= block_rows x dim]`) over the whole matrix
+        """
+        for start in range(0, self.rows, block_rows):
+            yield start, self.rows_slice(start, min(start + block_rows, self.rows), normalize)
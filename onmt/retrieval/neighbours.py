@@ -0,0 +1,41 @@
+""" Binary file of the nearest training neighbours of every test sample and their cosine similarities """
+import struct
+
+import numpy as np
+import torch
+
+MAGIC = b"CRTK"
+VERSION = 1
+# magic, version, number of samples, neighbours per sample
+HEADER = struct.Struct("<4sIQI")
+HEADER_SIZE = 32
+
+
+def write_neighbours(path, ids, scores):
+    """
+    Save the neighbours as a header, the int64 ids `[n x k]` and the float32 scores `[n x k]`, row-major
+    :param path: (str) filepath
+    :param ids: (`LongTensor`) training line numbers of the neighbours, best first `[n x k]`
+    :param scores: (`FloatTensor`) cosine similarities of the neighbours `[n x k]`
+    """
+    ids = ids.detach().cpu().numpy().astype(np.int64)
+    scores = scores.detach().float().cpu().numpy()
+    n, k = ids.shape
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, n, k).ljust(HEADER_SIZE, b'\0'))
+        f.write(ids.tobytes())
+        f.write(scores.tobytes())
+
+
+def read_neighbours(path):
+    """
+    :param path: (str) filepath of a file written by `write_neighbours`
+    :return: (`LongTensor`, `FloatTensor`) ids and scores of the neighbours `[n x k]`
+    """
+    with open(path, 'rb') as f:
+        magic, version, n, k = HEADER.unpack(f.read(HEADER_SIZE)[:HEADER.size])
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a neighbours file" % path)
+        ids = np.fromfile(f, dtype=np.int64, count=n * k).reshape(n, k)
+        scores = np.fromfile(f, dtype=np.float32, count=n * k).reshape(n, k)
+    return torch.from_numpy(ids), torch.from_numpy(scores)
@@ -0,0 +1,62 @@
+""" Blocked cosine similarity top-k search """
+import torch
+
+
+def normalize(vectors):
+    """L2-normalize the rows of `vectors` so that inner product equals cosine similarity"""
+    vectors = vectors.float()
+    return vectors / vectors.norm(2, 1, keepdim=True).clamp(min=1e-12)
+
+
+def default_block_rows(n_queries, dim, budget_bytes=1 << 25):
+    """
+    Number of rows per block so that a block and its `[n_queries x block]` float32 scores fit in `budget_bytes`
+    """
+    return max(256, budget_bytes // (4 * (n_queries + dim)))
+
+
+class RunningTopK(object):
+    """
+    Top-k of the scores of every query, merged block after block.
+    Queries with less than k scored candidates get -inf scores and -1 ids in the remaining slots.
+
+    :param n_queries: (int) number of queries
+    :param k: (int) number of results per query
+    :param device: (`torch.device`) device of the scores
+    """
+
+    def __init__(self, n_queries, k, device=None):
+        self.k = k
+        self.scores = torch.full((n_queries, k), -float('inf'), device=device)
+        self.ids = torch.full((n_queries, k), -1, dtype=torch.long, device=device)
+
+    def update(self, scores, offset):
+        """
+        :param scores: (`FloatTensor`) scores of a block of candidates `[n_queries x block]`
+        :param offset: (int) id of the first candidate of the block
+        """
+        block_scores, block_ids = torch.topk(scores, min(self.k, scores.size(1)), dim=1)
+        merged_scores = torch.cat([self.scores, block_scores], 1)
+        merged_ids = torch.cat([self.ids, block_ids + offset], 1)
+        self.scores, top = torch.topk(merged_scores, self.k, dim=1)
+        self.ids = merged_ids.gather(1, top)
+
+
+def blocked_cosine_topk(queries, blocks, k=1):
+    """
+    Cosine top-k of the queries against blocks of candidates, without ever building the full
+    `[n_queries x n_candidates]` similarity matrix.
+    :param queries: (`FloatTensor`) `[n_queries x dim]`
+    :param blocks: iterable of (offset, `FloatTensor` block `[rows x dim]`, `FloatTensor` row norms `[rows]` or None),
+        blocks without norms are taken as already normalized
+    :param k: (int) number of results per query
+    :return: (`FloatTensor`, `LongTensor`) scores and ids of the k most similar candidates `[n_queries x k]`
+    """
+    queries = normalize(queries)
+    top = RunningTopK(queries.size(0), k, queries.device)
+    for offset, block, norms in blocks:
+        scores = torch.mm(queries, block.to(queries.device).t())
+        if norms is not None:
+            scores.div_(norms.to(queries.device).clamp(min=1e-12).unsqueeze(0))
+        top.update(scores, offset)
+    return top.scores, top.ids
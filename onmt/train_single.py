@@ -12,7 +12,7 @@ import onmt.opts as opts
 from onmt.helpers.model_saver import build_model_saver
 from onmt.helpers.trainer import build_trainer
 from onmt.helpers.model_builder import build_model
-from onmt.inputters.input_aux import load_dataset, build_dataset_iter, load_vocab
+from onmt.inputters.input_aux import load_dataset, build_dataset_iter, load_vocab, shard_paths, ShardedIterator
 from onmt.utils.logging import init_logger, logger
 from onmt.utils.optimizers import build_optim
 
@@ -108,10 +108,21 @@ def main(opt, device_id):
     trainer = build_trainer(opt, model, vocab, optim, model_saver)
 
     def train_iter_fct():
-        return build_dataset_iter(load_dataset("train", opt), vocab, opt.batch_size, gpu=opt.gpu)
+        def build_iter(dataset):
+            return build_dataset_iter(dataset, vocab, opt.batch_size, gpu=opt.gpu, batch_type=opt.batch_type,
+                                      num_workers=opt.num_workers, pin_memory=opt.pin_memory,
+                                      prefetch_factor=opt.prefetch_factor)
+
+        shards = shard_paths("train", opt)
+        # a single shard is loaded once, like an unsharded corpus
+        if len(shards) > 1:
+            return ShardedIterator(shards, build_iter)
+        return build_iter(load_dataset("train", opt))
 
     def valid_iter_fct():
-        return build_dataset_iter(load_dataset("valid", opt), vocab, opt.valid_batch_size, gpu=opt.gpu)
+        return build_dataset_iter(load_dataset("valid", opt), vocab, opt.valid_batch_size, gpu=opt.gpu,
+                                  batch_type=opt.batch_type, num_workers=opt.num_workers, pin_memory=opt.pin_memory,
+                                  prefetch_factor=opt.prefetch_factor)
 
     # Do training.
     if opt.gpu:
@@ -0,0 +1,86 @@
+""" Finished hypotheses of a beam search, kept on the device """
+import torch
+
+
+class FinishedHypotheses(object):
+    """
+    The `n_best` best finished hypotheses of every example of a batch, in fixed-size tables of scores, tokens
+    and attentions that stay on the device. Hypotheses are merged into the tables with tensor operations,
+    and counted apart: the counts are enough to know when to stop decoding an example.
+    Ties keep the order in which hypotheses finished.
+    :param batch_size: (int) number of examples
+    :param n_best: (int) number of hypotheses kept per example
+    :param max_length: (int) maximum number of tokens of a hypothesis
+    :param src_len: (int) length of the attention distributions, or None to keep no attention
+    """
+
+    def __init__(self, batch_size, n_best, max_length, src_len=None, device=None):
+        self.n_best = n_best
+        self.scores = torch.full([batch_size, n_best], float("-inf"), device=device)
+        self.tokens = torch.zeros([batch_size, n_best, max_length], dtype=torch.long, device=device)
+        self.lengths = torch.zeros([batch_size, n_best], dtype=torch.long, device=device)
+        self.attention = (torch.zeros([batch_size, n_best, max_length, src_len], device=device)
+                          if src_len is not None else None)
+        # number of hypotheses finished by every example, including the ones that did not make the tables
+        self.counts = torch.zeros([batch_size], dtype=torch.long, device=device)
+
+    def add(self, examples, scores, is_finished, tokens, attention=None):
+        """
+        Merge the finished hypotheses of a step into the tables
+        :param examples: (`LongTensor`) example of every row `[m]`
+        :param scores: (`FloatTensor`) scores of the hypotheses `[m x beam]`
+        :param is_finished: (`BoolTensor`) hypotheses that finished `[m x beam]`
+        :param tokens: (`LongTensor`) tokens of the hypotheses, without the start token `[m x beam x length]`
+        :param attention: (`FloatTensor`) attention of the hypotheses `[length x m x beam x src_len]`
+        """
+        length = tokens.size(-1)
+        scores = scores.masked_fill(~is_finished, float("-inf"))
+        # stable: the hypotheses already in the tables come first among equal scores
+        merged_scores = torch.cat([self.scores.index_select(0, examples), scores], 1)
+        merged_scores, order = merged_scores.sort(dim=1, descending=True, stable=True)
+        order = order[:, :self.n_best]
+        self.scores.index_copy_(0, examples, merged_scores[:, :self.n_best].contiguous())
+
+        def merge(table, new, size):
+            # table `[batch x n_best x size...]`, new `[m x beam x size...]`
+            merged = torch.cat([table.index_select(0, examples), new], 1)
+            index = order.view(order.size() + (1,) * (merged.dim() - 2)).expand((-1, -1) + size)
+            table.index_copy_(0, examples, merged.gather(1, index))
+
+        merge(self.lengths, is_finished.new_full(is_finished.size(), length, dtype=torch.long), ())
+        # the hypotheses in the tables are not longer than the new ones
+        merge(self.tokens[:, :, :length], tokens, (length,))
+        if self.attention is not None:
+            merge(self.attention[:, :, :length], attention.permute(1, 2, 0, 3), (length, self.attention.size(-1)))
+
+    def count(self, examples, is_finished):
+        """
+        Count the hypotheses finished at a step
+        :param examples: (`LongTensor`) example of every row `[m]`
+        :param is_finished: (`BoolTensor`) hypotheses that finished `[m x beam]`
+        :return: (`LongTensor`) number of hypotheses finished by every example so far `[m]`
+        """
+        counts = self.counts.index_select(0, examples) + is_finished.sum(1)
+        self.counts.index_copy_(0, examples, counts)
+        return counts
+
+    def results(self, examples, src_lengths):
+        """
+        Copy the tables to the host once and split them into hypotheses
+        :param examples: (list) examples that finished decoding
+        :param src_lengths: (`LongTensor`) source length of every example
+        :return: (dict) lists of `n_best` scores, predictions and attentions of every example, empty for the others
+        """
+        batch_size = self.scores.size(0)
+        results = {name: [[] for _ in range(batch_size)] for name in ["scores", "predictions", "attention"]}
+        scores, tokens, lengths = self.scores.cpu(), self.tokens.cpu(), self.lengths.tolist()
+        attention = self.attention.cpu() if self.attention is not None else None
+        src_lengths = src_lengths.tolist()
+        for b in examples:
+            for n in range(self.n_best):
+                length = lengths[b][n]
+                results["scores"][b].append(scores[b, n])
+                results["predictions"][b].append(tokens[b, n, :length])
+                results["attention"][b].append(attention[b, n, :length, :src_lengths[b]]
+                                               if attention is not None else [])
+        return results
@@ -25,17 +25,23 @@ class TranslationBuilder(object):
         self.n_best = n_best
         self.has_tgt = has_tgt
 
-    def _build_target_tokens(self, pred):
-        tokens = []
-        for index in pred:
-            if index < len(self.vocab):
-                tokens.append(self.vocab.lookup_token(index))
-            else:
-                tokens.append(" ")
-            if tokens[-1] == EOS_WORD:
-                tokens = tokens[:-1]
-                break
-        return tokens
+    def _build_target_tokens(self, preds):
+        """
+        :param preds: sequences of ids, lists or tensors
+        :return: the tokens of every sequence up to its first EOS, ids out of the vocabulary give " "
+        """
+        eos = self.vocab[EOS_WORD]
+        size = len(self.vocab)
+        sequences = []
+        for pred in preds:
+            pred = pred.reshape(-1).tolist() if torch.is_tensor(pred) else list(pred)
+            if eos in pred:
+                pred = pred[:pred.index(eos)]
+            sequences.append(pred)
+        # one lookup for all the sequences, ids out of the vocabulary are replaced afterwards
+        decoded = self.vocab.decode_many([[min(index, size - 1) for index in pred] for pred in sequences])
+        return [[token if index < size else " " for index, token in zip(pred, tokens)]
+                for pred, tokens in zip(sequences, decoded)]
 
     def from_batch(self, translation_batch, batch_size):
         batch = translation_batch["batch"]
@@ -61,10 +67,10 @@ class TranslationBuilder(object):
         translations = []
         for b in range(batch_size):
             src_raw = self.dataset[inds[b]][0]
-            pred_sents = [self._build_target_tokens(preds[b][n]) for n in range(self.n_best)]
+            pred_sents = self._build_target_tokens([preds[b][n] for n in range(self.n_best)])
             gold_sent = None
             if tgt is not None:
-                gold_sent = self._build_target_tokens(tgt[1:, b] if tgt is not None else None)
+                gold_sent = self._build_target_tokens([tgt[1:, b]])[0]
 
             translation = TranslationWrapper(src[:, b] if src is not None else None,
                                              src_raw, pred_sents,
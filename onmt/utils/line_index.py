@@ -0,0 +1,163 @@
+""" Byte offsets of the lines of a text file, to read single lines without loading the whole file """
+import os
+import struct
+
+import numpy as np
+
+from onmt.utils.logging import logger
+
+MAGIC = b"CRLI"
+# version 2 splits lines like str.splitlines, version 1 only split them on '\n'
+VERSION = 2
+# magic, version, size and mtime of the indexed file, number of lines
+HEADER = struct.Struct("<4sIQQQ")
+HEADER_SIZE = 64
+
+# last bytes of the UTF-8 line breaks of str.splitlines, which the codecs readers of TextDataset split lines with:
+# '\n', '\v', '\f', '\r', '\x1c', '\x1d', '\x1e', and the last byte of U+0085 (c2 85), U+2028 (e2 80 a8), U+2029 (e2 80 a9)
+_BREAK_LAST_BYTES = np.zeros(256, dtype=bool)
+_BREAK_LAST_BYTES[[0x0a, 0x0b, 0x0c, 0x0d, 0x1c, 0x1d, 0x1e, 0x85, 0xa8, 0xa9]] = True
+
+
+def _line_ends(data, lo, hi):
+    """
+    Offsets just after the line breaks of data that end in (lo, hi], a '\\r\\n' being a single line break.
+    :param data: (bytes) UTF-8 text, with at least 2 bytes before lo and a byte after hi, when the text has them
+    :return: (`np.ndarray`) sorted offsets
+    """
+    b = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(_BREAK_LAST_BYTES[b[lo:hi]]) + (lo + 1)
+    last = b[ends - 1]
+    before = np.where(ends >= 2, b[np.maximum(ends - 2, 0)], 0)
+    before2 = np.where(ends >= 3, b[np.maximum(ends - 3, 0)], 0)
+    keep = last < 0x80
+    # continuation bytes are only line breaks as the end of their code point
+    keep |= (last == 0x85) & (before == 0xc2)
+    keep |= (last >= 0xa8) & (before == 0x80) & (before2 == 0xe2)
+    # the line of a '\r' followed by '\n' ends after the '\n'
+    next_byte = np.where(ends < len(b), b[np.minimum(ends, len(b) - 1)], 0)
+    keep &= ~((last == 0x0d) & (next_byte == 0x0a))
+    return ends[keep]
+
+
+def ends_line(path, offset):
+    """
+    Whether a line of a file ends at a byte offset, with the line breaks of `LineIndex`.
+    The end of the file ends its last line, with or without a line break.
+    :param path: (str) filepath
+    :param offset: (int) byte offset, between 0 and the size of the file
+    """
+    if offset == 0 or offset == os.path.getsize(path):
+        return True
+    start = max(0, offset - 3)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        # the bytes of the line break, and the next one to tell '\r' from '\r\n'
+        data = f.read(offset + 1 - start)
+    return len(_line_ends(data, offset - 1 - start, offset - start)) > 0
+
+
+class LineIndex(object):
+    """
+    Offsets of the starts of the lines of a UTF-8 file. Lines are split like TextDataset reads them,
+    on '\\n' as well as on the other line breaks of `str.splitlines`, such as '\\r' or U+2028.
+    The offsets are saved beside the file as `<path>.idx` and reused as long as the size and
+    modification time of the file are the ones they were computed for.
+    :param path: (str) filepath of the indexed file
+    :param index_path: (str) filepath of the offsets, `<path>.idx` if None
+    """
+
+    def __init__(self, path, index_path=None, chunk_size=1 << 24):
+        self.path = path
+        self.index_path = index_path if index_path is not None else path + ".idx"
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.starts = self._load()
+        if self.starts is None:
+            self.starts = self._build(chunk_size)
+            self._save()
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            return None
+        with open(self.index_path, 'rb') as f:
+            magic, version, size, mtime, lines = HEADER.unpack(f.read(HEADER_SIZE)[:HEADER.size])
+        if magic != MAGIC or version != VERSION or size != self.size or mtime != self.mtime:
+            return None
+        if lines == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.memmap(self.index_path, dtype=np.int64, mode='r', offset=HEADER_SIZE, shape=(lines,))
+
+    def _build(self, chunk_size):
+        logger.info("Indexing the lines of %s" % self.path)
+        starts = [np.zeros(1, dtype=np.int64)] if self.size > 0 else []
+        # buf holds the file from offset, the line breaks that end up to offset + lo are already found
+        buf, offset, lo = b"", 0, 0
+        with open(self.path, 'rb') as f:
+            while True:
+                block = f.read(chunk_size)
+                buf += block
+                # the last byte is kept for the next block, it may be a '\r' followed by '\n'
+                hi = len(buf) if not block else len(buf) - 1
+                starts.append(_line_ends(buf, lo, hi).astype(np.int64) + offset)
+                if not block:
+                    break
+                # keep the 2 bytes that may start a line break ending in the next block
+                keep = max(0, hi - 2)
+                buf, offset, lo = buf[keep:], offset + keep, hi - keep
+        starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        # a final newline does not start another line
+        return starts[starts < self.size]
+
+    def _save(self):
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, self.size, self.mtime, len(self.starts)).ljust(HEADER_SIZE, b'\0'))
+                f.write(self.starts.tobytes())
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # read-only corpus directory, the offsets are recomputed next time
+            logger.info("Cannot save the line index %s: %s" % (self.index_path, e))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def span(self, i):
+        """
+        :return: (int, int) start and end offsets of line i, the end including its newline
+        """
+        end = self.starts[i + 1] if i + 1 < len(self.starts) else self.size
+        return int(self.starts[i]), int(end)
+
+    def ranges(self, start=0, lines_per_chunk=1):
+        """
+        Split the lines after byte `start` into chunks of consecutive lines
+        :param start: (int) offset of the first line of the first chunk
+        :param lines_per_chunk: (int) number of lines per chunk, the last one may be shorter
+        :return: list of (start, end) byte ranges
+        """
+        first = int(np.searchsorted(self.starts, start))
+        bounds = [int(offset) for offset in self.starts[first::lines_per_chunk]] + [self.size]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def read_lines(self, ids):
+        """
+        Read some lines of the file, seeking them in offset order
+        :param ids: (iterable of int) line numbers, repetitions allowed
+        :return: (list of bytes) the lines in the order of `ids`, with their newline
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        lines = [None] * len(ids)
+        previous, line = -1, None
+        with open(self.path, 'rb') as f:
+            for position in np.argsort(ids, kind='stable'):
+                i = int(ids[position])
+                if i != previous:
+                    start, end = self.span(i)
+                    f.seek(start)
+                    line = f.read(end - start)
+                    previous = i
+                lines[position] = line
+        return lines
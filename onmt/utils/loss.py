@@ -73,7 +73,7 @@ class LossComputeBase(nn.Module):
              module that maps the output of the decoder to a
              distribution over the target vocabulary.
         tgt_vocab (:obj:`Vocab`) :
-             torchtext vocab object representing the target output
+             vocabulary object representing the target output
         normalzation (str): normalize by "sents" or "tokens"
     """
 
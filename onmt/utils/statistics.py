@@ -18,6 +18,7 @@ class Statistics(object):
     * perplexity
     * xent loss
     * elapsed time
+    * time spent waiting for the input batches
     """
 
     def __init__(self, loss=0, n_words=0, n_correct=0):
@@ -25,6 +26,7 @@ class Statistics(object):
         self.n_words = n_words
         self.n_correct = n_correct
         self.n_src_words = 0
+        self.input_time = 0
         self.start_time = time.time()
 
     @staticmethod
@@ -81,6 +83,7 @@ class Statistics(object):
         self.loss += stat.loss
         self.n_words += stat.n_words
         self.n_correct += stat.n_correct
+        self.input_time += stat.input_time
 
         if update_n_src_words:
             self.n_src_words += stat.n_src_words
@@ -101,6 +104,10 @@ class Statistics(object):
         """ compute elapsed time """
         return time.time() - self.start_time
 
+    def input_share(self):
+        """ compute the share of the elapsed time spent waiting for the input batches """
+        return 100 * self.input_time / (self.elapsed_time() + 1e-5)
+
     def output(self, step, num_steps, learning_rate, start):
         """Write out statistics to stdout.
 
@@ -112,7 +119,7 @@ class Statistics(object):
         t = self.elapsed_time()
         logger.info(
             ("Step %2d/%5d; acc: %6.2f; ppl: %5.2f; xent: %4.2f; " +
-             "lr: %7.5f; %3.0f/%3.0f tok/s; %6.0f sec")
+             "lr: %7.5f; %3.0f/%3.0f tok/s; input: %4.1f%%; %6.0f sec")
             % (step, num_steps,
                self.accuracy(),
                self.ppl(),
@@ -120,6 +127,7 @@ class Statistics(object):
                learning_rate,
                self.n_src_words / (t + 1e-5),
                self.n_words / (t + 1e-5),
+               self.input_share(),
                time.time() - start))
         sys.stdout.flush()
 
@@ -130,5 +138,6 @@ class Statistics(object):
         writer.add_scalar(prefix + "/ppl", self.ppl(), step)
         writer.add_scalar(prefix + "/accuracy", self.accuracy(), step)
         writer.add_scalar(prefix + "/wrdpersec", self.n_words / t, step)
+        writer.add_scalar(prefix + "/input_share", self.input_share(), step)
         if learning_rate is not None: writer.add_scalar(prefix + "/lr", learning_rate, step)
         if teacher_forcing_factor is not None: writer.add_scalar(prefix + "/teach_factor", teacher_forcing_factor, step)
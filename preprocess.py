@@ -5,6 +5,8 @@ import sys, os
 # local imports
 from onmt.utils.logging import init_logger, logger
 from onmt import opts
+from onmt.inputters.numeric_dataset import write_numeric_dataset
+from onmt.inputters.parallel_preprocess import preprocess_parallel
 from onmt.inputters.text_dataset import TextDataset
 from onmt.inputters.vocabulary import create_vocab
 
@@ -19,6 +21,11 @@ def check_existing_pt_files(opt):
         if glob.glob(pattern):
             sys.stderr.write("Please backup existing pt file: %s, to avoid tampering!\n" % pattern)
             sys.exit(1)
+    for t in ['train', 'valid']:
+        pattern = opt.save_data + '.' + t + '*.bin'
+        if glob.glob(pattern):
+            sys.stderr.write("Please backup existing bin directory: %s, to avoid tampering!\n" % pattern)
+            sys.exit(1)
 
 
 def parse_args():
@@ -57,17 +64,21 @@ def main():
     if not os.path.exists("data/preprocessed/"):
         os.makedirs("data/preprocessed")
 
-    train_dataset = TextDataset(opt.train_src, opt.train_tgt, opt.src_seq_length, opt.tgt_seq_length)
-    train_pt_file = "{:s}.{:s}.pt".format(opt.save_data, "train")
-    logger.info(" * saving %s dataset to %s." % ("train", train_pt_file))
-    torch.save(train_dataset, train_pt_file)
-
-    valid_dataset = TextDataset(opt.valid_src, opt.valid_tgt, opt.src_seq_length, opt.tgt_seq_length)
-    valid_pt_file = "{:s}.{:s}.pt".format(opt.save_data, "valid")
-    logger.info(" * saving %s dataset to %s." % ("valid", valid_pt_file))
-    torch.save(valid_dataset, valid_pt_file)
+    # the training corpus is split in shards of -shard_size examples, streamed one at a time when training
+    corpora = [("train", opt.train_src, opt.train_tgt, "{:s}.train".format(opt.save_data), opt.shard_size),
+               ("valid", opt.valid_src, opt.valid_tgt, "{:s}.valid".format(opt.save_data), 0)]
+    if opt.preprocess_workers > 1:
+        vocab_src, vocab_tgt = preprocess_parallel(opt, opt.preprocess_workers, corpora)
+    else:
+        train_dataset = TextDataset(opt.train_src, opt.train_tgt, opt.src_seq_length, opt.tgt_seq_length)
+        valid_dataset = TextDataset(opt.valid_src, opt.valid_tgt, opt.src_seq_length, opt.tgt_seq_length)
+        vocab_src, vocab_tgt = create_vocab(opt, train_dataset)
+
+        # datasets are saved as token ids, numericalized once with the vocabulary
+        for (corpus_type, _, _, prefix, shard_size), dataset in zip(corpora, [train_dataset, valid_dataset]):
+            paths = write_numeric_dataset(prefix, dataset, {"src": vocab_src, "tgt": vocab_tgt}, shard_size)
+            logger.info(" * saved %s dataset to %s." % (corpus_type, ", ".join(paths)))
 
-    vocab_src, vocab_tgt = create_vocab(opt, train_dataset)
     vocab_pt_file = "{:s}.{:s}.pt".format(opt.save_data, "vocab")
     logger.info(" * saving vocabulary to %s." % (vocab_pt_file, ))
     torch.save({"src": vocab_src, "tgt": vocab_tgt}, vocab_pt_file)
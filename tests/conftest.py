@@ -0,0 +1,54 @@
+import configargparse
+import pytest
+import torch
+
+import onmt.opts as opts
+from diff_trans import build_translator
+from onmt.helpers.model_builder import build_model
+from onmt.inputters.vocabulary import Vocab
+from onmt.train_single import training_opt_parsing
+
+WORDS = ["<unk>", "<blank>", "<s>", "</s>", "a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+def _write(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture
+def translator_factory(tmp_path):
+    """
+    Build DiffTranslators of a tiny randomly initialized RNN model on a few test diffs,
+    with the translate options given as arguments
+    """
+    vocab = {"src": Vocab(WORDS, 0), "tgt": Vocab(WORDS, 0)}
+    torch.save(vocab, str(tmp_path / "vocab.pt"))
+    parser = configargparse.ArgumentParser()
+    opts.model_opts(parser)
+    opts.train_opts(parser)
+    model_opt = parser.parse_known_args(["-data", "data", "-rnn_size", "8", "-word_vec_size", "8", "-layers", "1",
+                                         "-encoder_type", "brnn", "-total", "6", "-param_init", "1"])[0]
+    training_opt_parsing(model_opt, -1)
+    torch.manual_seed(0)
+    model = build_model(model_opt, vocab, False)
+    # end hypotheses at different lengths
+    model.generator[0].bias.data[vocab["tgt"]["</s>"]] += 1
+    torch.save({"model": model.state_dict(), "generator": model.generator.state_dict(), "opt": model_opt},
+               str(tmp_path / "model.pt"))
+    _write(tmp_path / "test.diff", ["a b c", "d e", "f g h a b", "c", "h g f e d c b a", "b b"])
+    _write(tmp_path / "test.msg", ["a b", "c", "d e f", "g", "h a", "b"])
+    _write(tmp_path / "train.diff", ["a b d", "e f", "g h a", "c c b", "d d", "f e"])
+    _write(tmp_path / "train.msg", ["a", "b c", "d", "e f g", "h", "a b"])
+
+    def build(*args):
+        parser = configargparse.ArgumentParser()
+        opts.config_opts(parser)
+        opts.translate_opts(parser)
+        opt = parser.parse_args(["-model", str(tmp_path / "model.pt"), "-src", str(tmp_path / "test.diff"),
+                                 "-tgt", str(tmp_path / "test.msg"), "-src_vocab", str(tmp_path / "vocab.pt"),
+                                 "-output", str(tmp_path / "pred.txt"), "-sem_cache_dir", str(tmp_path / "cache"),
+                                 "-max_length", "6"] + list(args))
+        return build_translator(opt, report_score=False)
+
+    return build
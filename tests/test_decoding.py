@@ -0,0 +1,97 @@
+import os
+
+import pytest
+import torch
+
+from onmt.inputters.input_aux import build_dataset_iter
+from onmt.inputters.text_dataset import SemTextDataset
+
+
+def _decode(translator, batch_size, attn_debug=False, sem_path=None):
+    """Results of every test example, in test set order"""
+    results = {}
+    for batch in build_dataset_iter(translator.test_dataset, translator.src_vocab, batch_size, shuffle_batches=False):
+        n = len(batch["indexes"])
+        decoded = translator._process_batch(batch, n, sem_path, translator.src_vocab["tgt"], attn_debug=attn_debug)
+        for i, index in enumerate(batch["indexes"].tolist()):
+            results[index] = {key: decoded[key][i] for key in ["scores", "predictions", "attention"]}
+    return [results[index] for index in sorted(results)]
+
+
+def _assert_same_results(results, expected, attention=True):
+    for result, other in zip(results, expected):
+        assert [p.tolist() for p in result["predictions"]] == [p.tolist() for p in other["predictions"]]
+        assert torch.allclose(torch.stack(result["scores"]), torch.stack(other["scores"]), atol=1e-5)
+        if attention:
+            for attn, other_attn in zip(result["attention"], other["attention"]):
+                assert torch.allclose(attn, other_attn, atol=1e-5)
+
+
+def test_beam_search_scores_are_the_log_probs_of_the_hypotheses(translator_factory):
+    translator = translator_factory("-beam_size", "3", "-n_best", "3")
+    results = _decode(translator, 1, attn_debug=True)
+    start_token = translator.src_vocab["tgt"]["<s>"]
+    lengths = set()
+    for batch, result in zip(build_dataset_iter(translator.test_dataset, translator.src_vocab, 1,
+                                                shuffle_batches=False), results):
+        assert result["scores"] == sorted(result["scores"], reverse=True)
+        src, enc_states, memory_bank, src_lengths = translator._run_encoder(batch, 1)
+        for score, prediction, attention in zip(result["scores"], result["predictions"], result["attention"]):
+            lengths.add(len(prediction))
+            # the decoder fed with the hypothesis gives the same log probabilities and attention
+            translator.model.decoder.init_state(src, memory_bank, enc_states, with_cache=True)
+            decoder_input = torch.cat([torch.tensor([start_token]), prediction[:-1]]).view(-1, 1, 1)
+            log_probs, attn = translator._decode_and_generate(decoder_input, memory_bank, src_lengths)
+            log_probs = log_probs.view(len(prediction), -1)
+            assert torch.allclose(score, log_probs.gather(1, prediction.view(-1, 1)).sum(), atol=1e-5)
+            assert torch.allclose(attention, attn.view(len(prediction), -1), atol=1e-5)
+    # hypotheses that end with the end token at different steps, and at max_length
+    assert len(lengths) > 2 and 6 in lengths
+
+
+@pytest.mark.parametrize("attn_debug", [False, True])
+def test_beam_search_does_not_depend_on_the_batch(translator_factory, attn_debug):
+    translator = translator_factory("-beam_size", "3", "-n_best", "2")
+    # examples of a batch finish at different steps
+    _assert_same_results(_decode(translator, 6, attn_debug), _decode(translator, 1, attn_debug), attention=attn_debug)
+
+
+@pytest.mark.parametrize("options", [[], ["-min_length", "2"]])
+def test_greedy_search_matches_the_beam_search_of_one_beam(translator_factory, options):
+    translator = translator_factory("-beam_size", "1", *options)
+    greedy = _decode(translator, 6, attn_debug=True)
+    translator._greedy_search = translator._beam_search
+    _assert_same_results(greedy, _decode(translator, 6, attn_debug=True))
+    lengths = {len(result["predictions"][0]) for result in greedy}
+    # the end token is blocked for min_length steps
+    assert min(lengths) > 2 if options else len(lengths) > 1
+
+
+def _retrieve(translator_factory, tmp_path, sem_topk):
+    sem_path = str(tmp_path / "sem")
+    translator = translator_factory("-sem_path", sem_path, "-sem_topk", str(sem_topk))
+    translator.offline_semantic_retrieval(test_diff=translator.opt.src, train_diff=str(tmp_path / "train.diff"),
+                                          train_msg=str(tmp_path / "train.msg"), batch_size=4, semantic_out_dir=sem_path)
+    return sem_path
+
+
+def _semantic_translator(translator_factory, sem_path, *options):
+    """A translator with the semantic samples of sem_path, set up as in translate"""
+    translator = translator_factory("-sem_path", sem_path, "-sem_score", "cosine", *options)
+    translator.sem_score = translator._sem_scores(sem_path, translator.opt.src)
+    translator.test_dataset = SemTextDataset(translator.opt.src, translator.opt.tgt,
+                                             [os.path.join(sem_path, translator._sem_file("sem.diff", rank))
+                                              for rank in range(translator.sem_k)], translator.opt.max_sent_length)
+    return translator
+
+
+@pytest.mark.parametrize("sem_topk", ["1", "2"])
+@pytest.mark.parametrize("beam_size", ["1", "3"])
+def test_fused_semantic_decoder_matches_the_separate_one(translator_factory, tmp_path, sem_topk, beam_size):
+    sem_path = _retrieve(translator_factory, tmp_path, 2)
+    options = ["-sem_topk", sem_topk, "-beam_size", beam_size, "-n_best", beam_size, "-lam_sem", "0.8"]
+    separate = _decode(_semantic_translator(translator_factory, sem_path, *options), 4, attn_debug=True,
+                       sem_path=sem_path)
+    translator = _semantic_translator(translator_factory, sem_path, *options, "-fuse_sem_decoder")
+    assert translator.sem_decoder is None
+    _assert_same_results(_decode(translator, 4, attn_debug=True, sem_path=sem_path), separate)
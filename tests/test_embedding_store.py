@@ -0,0 +1,76 @@
+import os
+
+import torch
+
+from onmt.retrieval.embedding_store import EmbeddingStore
+
+
+def _store(tmp_path):
+    checkpoint, vocab = tmp_path / "model.pt", tmp_path / "vocab.pt"
+    checkpoint.write_bytes(b"weights")
+    vocab.write_bytes(b"vocab")
+    return EmbeddingStore(str(tmp_path / "cache"), str(checkpoint), str(vocab), 100)
+
+
+def test_changed_corpus_deletes_the_stored_shards(tmp_path):
+    train_diff = tmp_path / "train.diff"
+    train_diff.write_text("a b\nc d\ne f\n")
+    store = _store(tmp_path)
+    store.add(torch.ones(2, 4))
+    store.add(torch.ones(1, 4))
+    store.commit(str(train_diff))
+    assert sorted(os.listdir(store.path)) == ["manifest.pt", "shard.0.mat", "shard.1.mat"]
+
+    train_diff.write_text("g h\n")
+    store = _store(tmp_path)
+    assert store.cached_rows(str(train_diff)) == 0
+    assert os.listdir(store.path) == ["manifest.pt"]
+    # the emptied manifest is on disk before the shards are deleted
+    assert _store(tmp_path).rows == 0
+
+
+def test_appended_lines_keep_the_stored_shards(tmp_path):
+    train_diff = tmp_path / "train.diff"
+    train_diff.write_text("a b\nc d\n")
+    store = _store(tmp_path)
+    store.add(torch.arange(8, dtype=torch.float).view(2, 4))
+    store.commit(str(train_diff))
+
+    train_diff.write_text("a b\nc d\ne f\n")
+    store = _store(tmp_path)
+    assert store.cached_rows(str(train_diff)) == 2
+    store.add(torch.ones(1, 4))
+    store.commit(str(train_diff))
+    assert store.load().tolist() == [[0, 1, 2, 3], [4, 5, 6, 7], [1, 1, 1, 1]]
+
+
+def _cache(tmp_path, content, rows):
+    train_diff = tmp_path / "train.diff"
+    train_diff.write_bytes(content)
+    store = _store(tmp_path)
+    assert store.cached_rows(str(train_diff)) == 0
+    store.add(torch.ones(rows, 4))
+    store.commit(str(train_diff))
+    return train_diff
+
+
+def test_last_line_without_newline_is_reused(tmp_path):
+    train_diff = _cache(tmp_path, b"a b\nc d", 2)
+    assert _store(tmp_path).cached_rows(str(train_diff)) == 2
+
+    # the last line is extended, its encoding is stale
+    train_diff.write_bytes(b"a b\nc d e\n")
+    assert _store(tmp_path).cached_rows(str(train_diff)) == 0
+
+
+def test_lines_ending_in_other_line_breaks_are_reused(tmp_path):
+    train_diff = _cache(tmp_path, "a b\rc d\u2028".encode("utf-8"), 2)
+    train_diff.write_bytes("a b\rc d\u2028e f\n".encode("utf-8"))
+    assert _store(tmp_path).cached_rows(str(train_diff)) == 2
+
+
+def test_carriage_return_followed_by_newline_is_one_line_break(tmp_path):
+    # the stored last line did not end at the '\r' but at the '\n' that follows
+    train_diff = _cache(tmp_path, b"a b\r", 1)
+    train_diff.write_bytes(b"a b\r\ne f\n")
+    assert _store(tmp_path).cached_rows(str(train_diff)) == 0
@@ -0,0 +1,48 @@
+import torch
+
+from onmt.translate.finished_hypotheses import FinishedHypotheses
+
+
+def test_keeps_the_n_best_hypotheses_of_every_example():
+    hypotheses = FinishedHypotheses(batch_size=3, n_best=2, max_length=4, src_len=2)
+    # step 0: examples 0 and 2 are alive, 2 beams each
+    examples = torch.tensor([0, 2])
+    is_finished = torch.tensor([[True, False], [True, True]])
+    hypotheses.add(examples, torch.tensor([[-1.0, -2.0], [-3.0, -0.5]]), is_finished,
+                   torch.tensor([[[5], [6]], [[7], [8]]]), torch.full([1, 2, 2, 2], 0.5))
+    assert hypotheses.count(examples, is_finished).tolist() == [1, 2]
+
+    # step 1: example 0 finishes a better and a worse hypothesis, example 1 its first one
+    examples = torch.tensor([0, 1])
+    is_finished = torch.tensor([[True, True], [False, True]])
+    hypotheses.add(examples, torch.tensor([[-0.5, -4.0], [-9.0, -2.0]]), is_finished,
+                   torch.tensor([[[5, 9], [6, 9]], [[1, 2], [3, 4]]]), torch.full([2, 2, 2, 2], 0.25))
+    assert hypotheses.count(examples, is_finished).tolist() == [3, 1]
+
+    results = hypotheses.results([0, 1, 2], torch.tensor([2, 2, 1]))
+    assert [s.item() for s in results["scores"][0]] == [-0.5, -1.0]
+    assert [p.tolist() for p in results["predictions"][0]] == [[5, 9], [5]]
+    assert [s.item() for s in results["scores"][1]][:1] == [-2.0]
+    assert results["predictions"][1][0].tolist() == [3, 4]
+    assert [s.item() for s in results["scores"][2]] == [-0.5, -3.0]
+    assert [p.tolist() for p in results["predictions"][2]] == [[8], [7]]
+    # attention of the kept steps, cut to the source length
+    assert results["attention"][0][0].tolist() == [[0.25, 0.25], [0.25, 0.25]]
+    assert results["attention"][2][0].tolist() == [[0.5]]
+
+
+def test_ties_keep_the_order_in_which_hypotheses_finished():
+    hypotheses = FinishedHypotheses(batch_size=1, n_best=2, max_length=3)
+    examples = torch.tensor([0])
+    hypotheses.add(examples, torch.tensor([[-1.0]]), torch.tensor([[True]]), torch.tensor([[[4]]]))
+    hypotheses.add(examples, torch.tensor([[-1.0, -1.0]]), torch.tensor([[True, True]]), torch.tensor([[[5, 6], [7, 8]]]))
+    results = hypotheses.results([0], torch.tensor([3]))
+    assert [p.tolist() for p in results["predictions"][0]] == [[4], [5, 6]]
+    assert results["attention"][0] == [[], []]
+
+
+def test_examples_still_decoding_have_no_results():
+    hypotheses = FinishedHypotheses(batch_size=2, n_best=1, max_length=2)
+    hypotheses.add(torch.tensor([1]), torch.tensor([[-1.0]]), torch.tensor([[True]]), torch.tensor([[[4]]]))
+    results = hypotheses.results([1], torch.tensor([3, 3]))
+    assert results["predictions"][0] == [] and results["predictions"][1][0].tolist() == [4]
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from onmt.modules.global_attention import GlobalAttention
+from onmt.utils.misc import tile
+
+
+@pytest.mark.parametrize("attn_type", ["dot", "general", "mlp"])
+@pytest.mark.parametrize("tgt_len", [None, 3])
+def test_shared_memory_bank_matches_tiled(attn_type, tgt_len):
+    torch.manual_seed(0)
+    attention = GlobalAttention(8, attn_type=attn_type)
+    batch, beams = 2, 3
+    memory_bank = torch.randn(batch, 5, 8)
+    lengths = torch.tensor([5, 3])
+    queries = torch.randn(batch * beams, 8) if tgt_len is None else torch.randn(batch * beams, tgt_len, 8)
+
+    folded = attention(queries, memory_bank, memory_lengths=lengths)
+    tiled = attention(queries, tile(memory_bank, beams), memory_lengths=tile(lengths, beams))
+    for output, expected in zip(folded, tiled):
+        assert output.size() == expected.size()
+        assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_queries_not_a_multiple_of_the_sources():
+    attention = GlobalAttention(8)
+    with pytest.raises(AssertionError):
+        attention(torch.randn(5, 8), torch.randn(2, 4, 8))
@@ -0,0 +1,26 @@
+import codecs
+
+import pytest
+
+from onmt.inputters.text_dataset import TextDataset
+from onmt.utils.line_index import LineIndex
+
+# every line break of str.splitlines, '\r\n' counting as one
+TEXT = "a b\nc\rd\r\ne\x0bf\x0cg\x1ch\x1di\x1ej\x85k l m é\n\rn €"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 1 << 24])
+def test_lines_are_split_like_text_dataset(tmp_path, chunk_size):
+    path = tmp_path / "train.diff"
+    path.write_bytes(TEXT.encode("utf-8"))
+    with codecs.open(str(path), "r", "utf-8") as f:
+        expected = [line.encode("utf-8") for line in f]
+    assert len(expected) == 14
+
+    index = LineIndex(str(path), chunk_size=chunk_size)
+    assert index.read_lines(range(len(index))) == expected
+
+    # the ranges cut the file on the lines TextDataset reads
+    whole = TextDataset(str(path)).src_texts
+    ranges = [TextDataset(str(path), byte_range=byte_range).src_texts for byte_range in index.ranges(0, 3)]
+    assert [list(tokens) for texts in ranges for tokens in texts] == [list(tokens) for tokens in whole]
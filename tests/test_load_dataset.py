@@ -0,0 +1,26 @@
+import argparse
+
+from onmt.inputters.input_aux import load_dataset, shard_paths
+from onmt.inputters.numeric_dataset import write_numeric_dataset
+from onmt.inputters.text_dataset import TextDataset
+from onmt.inputters.vocabulary import Vocab
+
+
+def _preprocess(tmp_path, shard_size):
+    src, tgt = tmp_path / "train.diff", tmp_path / "train.msg"
+    src.write_text("a b\nc\nd e f\n")
+    tgt.write_text("x\ny z\nx y\n")
+    vocab = Vocab(["<unk>", "<blank>", "<s>", "</s>", "a", "b", "c", "d", "e", "f", "x", "y", "z"], 0)
+    write_numeric_dataset(str(tmp_path / "data.train"), TextDataset(str(src), str(tgt)),
+                          {"src": vocab, "tgt": vocab}, shard_size)
+    return argparse.Namespace(data=str(tmp_path / "data"))
+
+
+def test_single_shard_is_loaded_once(tmp_path):
+    opt = _preprocess(tmp_path, shard_size=1000)
+    assert shard_paths("train", opt) == [str(tmp_path / "data.train.0.bin")]
+
+    dataset = load_dataset("train", opt)
+    assert len(dataset) == 3
+    assert load_dataset("train", opt) is dataset
+
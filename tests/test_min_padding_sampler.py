@@ -0,0 +1,26 @@
+import pytest
+
+from onmt.inputters.input_aux import MinPaddingSampler
+from onmt.inputters.text_dataset import TextDataset
+
+
+def _dataset(tmp_path, lengths):
+    src, tgt = tmp_path / "src.diff", tmp_path / "tgt.msg"
+    src.write_text("".join(" ".join(["a"] * n) + "\n" for n in lengths))
+    tgt.write_text("b\n" * len(lengths))
+    return TextDataset(str(src), str(tgt))
+
+
+def test_tokens_batches_need_sorting(tmp_path):
+    dataset = _dataset(tmp_path, [3, 1, 4, 1, 5])
+    with pytest.raises(ValueError):
+        MinPaddingSampler(dataset, 8, shuffle_batches=False, batch_type="tokens")
+
+
+def test_sorted_tokens_batches_cap_the_padded_tokens(tmp_path):
+    lengths = [3, 1, 4, 1, 5, 9, 2, 6]
+    dataset = _dataset(tmp_path, lengths)
+    batches = list(MinPaddingSampler(dataset, 12, shuffle_batches=False, sort_globally=True, batch_type="tokens"))
+    assert sorted(sum(batches, [])) == list(range(len(lengths)))
+    # the source of a batch is padded to its longest example, plus EOS
+    assert all(len(batch) == 1 or (max(lengths[i] for i in batch) + 1) * len(batch) <= 12 for batch in batches)
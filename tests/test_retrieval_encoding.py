@@ -0,0 +1,43 @@
+import os
+
+import torch
+
+from onmt.encoders.rnn_encoder import RNNEncoder
+from onmt.inputters.vocabulary import Vocab
+from onmt.models.embeddings import Embeddings
+from onmt.retrieval.encoding import encode_range, max_pool
+
+WORDS = ["a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+def _encoder(vocab):
+    torch.manual_seed(0)
+    embeddings = Embeddings(8, len(vocab.itos), vocab.stoi["<blank>"])
+    encoder = RNNEncoder("LSTM", True, 1, 8, embeddings=embeddings)
+    encoder.eval()
+    return encoder
+
+
+def _encode(tmp_path, name, lines, encoder, vocabs, batch_size):
+    path = tmp_path / name
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return encode_range(encoder, vocabs, str(path), (0, os.path.getsize(path)), 100, batch_size)
+
+
+def test_max_pool_ignores_padding():
+    memory_bank = torch.tensor([[[-1.0], [-3.0]], [[-2.0], [0.0]]])
+    assert max_pool(memory_bank, torch.tensor([2, 1])).tolist() == [[-1.0], [-3.0]]
+
+
+def test_encoding_does_not_depend_on_the_batch(tmp_path):
+    vocab = Vocab(["<unk>", "<blank>", "<s>", "</s>"] + WORDS, 0)
+    vocabs = {"src": vocab, "tgt": vocab}
+    encoder = _encoder(vocab)
+    sentence = "a b c"
+
+    # alone in its batch, then padded to the length of longer diffs
+    alone = _encode(tmp_path, "alone.diff", [sentence, "d e f g h a b c d e f g h"], encoder, vocabs, 1)
+    padded = _encode(tmp_path, "padded.diff", ["d e f g h a b c d e f g h", "h g", sentence, "e f g h a b c"],
+                     encoder, vocabs, 4)
+
+    assert torch.allclose(alone[0], padded[2], atol=1e-6)
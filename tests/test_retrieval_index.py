@@ -0,0 +1,73 @@
+import argparse
+
+import pytest
+import torch
+
+from diff_trans import DiffTranslator
+from onmt.retrieval import StreamingFlatIndex, build_index, load_index
+from onmt.retrieval.embedding_store import EmbeddingStore
+
+
+def _translator(tmp_path, **options):
+    translator = DiffTranslator.__new__(DiffTranslator)
+    opt = {"sem_index": "ivfpq", "sem_index_path": str(tmp_path / "model.index"), "models": [str(tmp_path / "model.pt")],
+           "sem_index_nlist": 4, "sem_index_nprobe": 2, "sem_index_pq_m": 2,
+           "sem_index_hnsw_m": 4, "sem_index_ef_construction": 8, "sem_index_ef_search": 8}
+    opt.update(options)
+    translator.opt = argparse.Namespace(**opt)
+    return translator
+
+
+def _store(tmp_path):
+    (tmp_path / "model.pt").write_bytes(b"weights")
+    (tmp_path / "vocab.pt").write_bytes(b"vocab")
+    (tmp_path / "train.diff").write_text("".join("diff %d\n" % i for i in range(64)))
+    store = EmbeddingStore(str(tmp_path / "cache"), str(tmp_path / "model.pt"), str(tmp_path / "vocab.pt"), 100)
+    store.add(torch.randn(64, 8, generator=torch.Generator().manual_seed(0)))
+    store.commit(str(tmp_path / "train.diff"))
+    return store
+
+
+@pytest.mark.parametrize("kind, search_param, option", [("ivfpq", "nprobe", "sem_index_nprobe"),
+                                                        ("hnsw", "ef_search", "sem_index_ef_search")])
+def test_search_params_apply_to_the_loaded_index(tmp_path, kind, search_param, option):
+    store = _store(tmp_path)
+    built = _translator(tmp_path, sem_index=kind)._load_or_build_index(store, 0)
+
+    loaded = _translator(tmp_path, sem_index=kind, **{option: 3})._load_or_build_index(store, store.rows)
+    assert getattr(loaded, search_param) == 3
+    assert loaded.state_dict()["vectors" if kind == "hnsw" else "codes"].tolist() == \
+        built.state_dict()["vectors" if kind == "hnsw" else "codes"].tolist()
+
+
+def test_index_built_with_other_params_is_rebuilt(tmp_path):
+    store = _store(tmp_path)
+    _translator(tmp_path)._load_or_build_index(store, 0)
+    assert load_index(str(tmp_path / "model.index")).meta["params"] == {"nlist": 4, "m": 2}
+
+    index = _translator(tmp_path, sem_index_nlist=8)._load_or_build_index(store, store.rows)
+    assert index.nlist == 8
+    assert load_index(str(tmp_path / "model.index")).meta["params"] == {"nlist": 8, "m": 2}
+
+
+def test_set_search_params_rejects_build_params():
+    index = build_index("ivfpq", torch.randn(32, 8), nlist=4, m=2)
+    with pytest.raises(ValueError):
+        index.set_search_params(nlist=8)
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivfpq", "hnsw"])
+def test_index_without_vectors(kind):
+    with pytest.raises(ValueError):
+        build_index(kind, iter([]), training_vectors=torch.empty(0))
+    with pytest.raises(ValueError):
+        build_index(kind, torch.empty(0, 8))
+
+
+def test_streaming_flat_index_is_saved_in_place(tmp_path):
+    store = _store(tmp_path)
+    index = StreamingFlatIndex(store.files)
+    index.save(str(tmp_path / "flat.index"))
+    assert not (tmp_path / "flat.index").exists()
+    scores, ids = index.search(store.load()[:3], 1)
+    assert ids.view(-1).tolist() == [0, 1, 2]
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+
+def _retrieve(translator, tmp_path, sem_path):
+    translator.offline_semantic_retrieval(test_diff=str(tmp_path / "test.diff"), train_diff=str(tmp_path / "train.diff"),
+                                          train_msg=str(tmp_path / "train.msg"), batch_size=4, semantic_out_dir=sem_path)
+
+
+def test_retrieval_writes_the_samples_of_every_rank(translator_factory, tmp_path):
+    sem_path = str(tmp_path / "sem")
+    _retrieve(translator_factory("-sem_path", sem_path, "-sem_topk", "2"), tmp_path, sem_path)
+    assert sorted(os.listdir(sem_path)) == ["sem.diff", "sem.diff.1", "sem.msg", "sem.msg.1", "sem.topk"]
+    # the files are complete for the translation
+    translator_factory("-sem_path", sem_path, "-sem_topk", "2", "-sem_score", "cosine")
+
+
+def test_more_neighbours_than_training_diffs(translator_factory, tmp_path):
+    sem_path = str(tmp_path / "sem")
+    with pytest.raises(ValueError):
+        _retrieve(translator_factory("-sem_path", sem_path, "-sem_topk", "7"), tmp_path, sem_path)
+
+
+def test_missing_semantic_samples(translator_factory, tmp_path):
+    sem_path = str(tmp_path / "sem")
+    _retrieve(translator_factory("-sem_path", sem_path), tmp_path, sem_path)
+    with pytest.raises(AssertionError, match="sem.diff.1, sem.msg.1"):
+        translator_factory("-sem_path", sem_path, "-sem_topk", "2")
+
+    os.remove(os.path.join(sem_path, "sem.topk"))
+    translator_factory("-sem_path", sem_path)
+    with pytest.raises(AssertionError, match="sem.topk"):
+        translator_factory("-sem_path", sem_path, "-sem_score", "cosine")
+
+
+def test_empty_training_set(translator_factory, tmp_path):
+    (tmp_path / "train.diff").write_text("")
+    (tmp_path / "train.msg").write_text("")
+    sem_path = str(tmp_path / "sem")
+    with pytest.raises(ValueError, match="no training diffs"):
+        _retrieve(translator_factory("-sem_path", sem_path, "-sem_index", "ivfpq"), tmp_path, sem_path)
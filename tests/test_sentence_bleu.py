@@ -0,0 +1,33 @@
+import random
+
+import numpy as np
+import pytest
+
+from evaluate_res import batch_sentence_bleu, get_bleu
+
+
+def _sentences(rng, n):
+    words = ["fix", "add", "the", "bug", "in", "test", "update", "readme", "a", "of"]
+    return [[rng.choice(words) for _ in range(rng.randint(1, 12))] for _ in range(n)]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_sentence_bleu_matches_get_bleu(workers):
+    rng = random.Random(0)
+    references = _sentences(rng, 60)
+    # translations close to their reference, most of them share 4-grams with it
+    translations = [[word if rng.random() < 0.8 else "misc" for word in reference] + _sentences(rng, 1)[0][:2]
+                    for reference in references]
+    # exact matches, and pairs without a common 4-gram
+    translations[:3] = references[:3]
+    translations[3], references[3] = ["fix"], ["add"]
+
+    scores = batch_sentence_bleu(translations, references, workers=workers, chunk_size=8)
+    expected = [get_bleu([translation], [reference])[0] for translation, reference in zip(translations, references)]
+    assert np.allclose(scores, expected, rtol=1e-6, atol=0)
+    assert (scores > 0).sum() > 10
+    assert (scores[:3] == 1).all() and scores[3] == 0
+
+
+def test_batch_sentence_bleu_of_nothing():
+    assert len(batch_sentence_bleu([], [])) == 0
@@ -0,0 +1,54 @@
+import torch
+
+from onmt.inputters.input_aux import build_dataset_iter, dataset_lengths
+from onmt.inputters.text_dataset import SemTextDataset, TextDataset
+from onmt.inputters.vocabulary import Vocab
+
+
+def _write(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+
+def _baseline_pickle(tmp_path, cls, state):
+    """Pickle a dataset with the attributes the baseline preprocess saved, before lengths and interned texts"""
+    dataset = cls.__new__(cls)
+    dataset.__dict__.update(state)
+    path = str(tmp_path / "train.pt")
+    torch.save(dataset, path)
+    return torch.load(path)
+
+
+def test_baseline_text_dataset_pickle(tmp_path):
+    src = [["a", "b", "c"], ["d"], ["e", "f"]]
+    tgt = [["x"], ["y", "z"], ["w", "v", "u", "t"]]
+    dataset = _baseline_pickle(tmp_path, TextDataset, {
+        "transform": None, "target_transform": None, "indexes": [0, 1, 2], "sort_index": 3,
+        "src_path": "train.diff", "target_path": "train.msg", "src_texts": src, "target_texts": tgt})
+
+    assert dataset.lengths.tolist() == [[3, 1], [1, 2], [2, 4]]
+    assert dataset_lengths(dataset).tolist() == [[3, 1], [1, 2], [2, 4]]
+    assert dataset[1] == (["d"], ["y", "z"], 1, 1, 2)
+
+    vocab = Vocab(["<unk>", "<blank>", "<s>", "</s>", "a", "b", "c", "d", "e", "f", "x", "y", "z", "w", "v", "u", "t"], 0)
+    batches = list(build_dataset_iter(dataset, {"src": vocab, "tgt": vocab}, 2, shuffle_batches=False))
+    assert sorted(sum((batch["indexes"].tolist() for batch in batches), [])) == [0, 1, 2]
+
+
+def test_baseline_sem_text_dataset_pickle(tmp_path):
+    dataset = _baseline_pickle(tmp_path, SemTextDataset, {
+        "transform": None, "target_transform": None, "indexes": [0, 1], "sort_index": 4,
+        "src_path": "test.diff", "target_path": None, "src_texts": [["a", "b"], ["c"]], "target_texts": [],
+        "sem_path": "sem.diff", "sem_texts": [["d"], ["e", "f", "g"]]})
+
+    assert dataset.lengths.tolist() == [[2, 1], [1, 1]]
+    assert dataset[1] == (["c"], None, [["e", "f", "g"]], 1, 1, 1, [3])
+
+
+def test_text_dataset_pickle_round_trip(tmp_path):
+    dataset = TextDataset(_write(tmp_path / "a.diff", ["a b c", "d"]), _write(tmp_path / "a.msg", ["x y", "z"]))
+    path = str(tmp_path / "a.pt")
+    torch.save(dataset, path)
+    loaded = torch.load(path)
+    assert loaded.lengths.tolist() == [[3, 2], [1, 1]]
+    assert loaded[0] == dataset[0]
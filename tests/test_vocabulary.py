@@ -0,0 +1,42 @@
+import torch
+from torchtext.vocab import vocab as torchtext_vocab
+
+from onmt.inputters.input_aux import load_vocab
+from onmt.inputters.vocabulary import Vocab, as_vocab
+
+
+def _torchtext_vocab(tokens, default_token="<unk>"):
+    vocabulary = torchtext_vocab({token: 1 for token in tokens}, min_freq=1)
+    vocabulary.set_default_index(vocabulary[default_token])
+    return vocabulary
+
+
+def test_as_vocab_of_a_torchtext_vocab():
+    tokens = ["<unk>", "<blank>", "<s>", "</s>", "fix", "bug", "é"]
+    old = _torchtext_vocab(tokens)
+    vocabulary = as_vocab(old)
+
+    assert isinstance(vocabulary, Vocab)
+    assert vocabulary.get_itos() == old.get_itos()
+    assert vocabulary.get_stoi() == old.get_stoi()
+    assert vocabulary.get_default_index() == old.get_default_index()
+    words = ["fix", "unknown", "bug", "<blank>"]
+    assert vocabulary.lookup_indices(words) == old.lookup_indices(words)
+    assert vocabulary.vocab["unknown"] == old.vocab["unknown"]
+    assert vocabulary.lookup_tokens([4, 6, 0]) == old.lookup_tokens([4, 6, 0])
+    assert as_vocab(vocabulary) is vocabulary
+
+
+def test_load_vocab_of_an_older_vocab_file(tmp_path):
+    path = str(tmp_path / "vocab.pt")
+    torch.save({"src": _torchtext_vocab(["<unk>", "<blank>", "</s>", "a"]),
+                "tgt": _torchtext_vocab(["<unk>", "<blank>", "<s>", "</s>", "b"])}, path)
+    vocabs = load_vocab(path)
+    assert vocabs["src"].get_itos() == ["<unk>", "<blank>", "</s>", "a"]
+    assert vocabs["tgt"]["b"] == 4 and vocabs["tgt"]["a"] == 0
+
+    # the converted vocabularies pickle their tokens only
+    torch.save(vocabs, path)
+    reloaded = load_vocab(path)
+    assert reloaded["tgt"].get_itos() == vocabs["tgt"].get_itos()
+    assert reloaded["tgt"].get_default_index() == 0